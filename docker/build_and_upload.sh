@@ -41,6 +41,7 @@ if [ $REPO_URL == "null" ]; then
     fi
 fi
 
-BUILD_PATH=.
+# the native proxy image is built from ../services
+BUILD_PATH=${2-.}
 `aws ecr get-login --no-include-email`
 build_and_upload $REPO_URL:latest $BUILD_PATH
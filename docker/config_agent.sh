@@ -0,0 +1,44 @@
+#!/bin/sh
+# Polls the S3 pointer to the current config and reloads nginx in place
+# when it points to a new one. Configs failing `nginx -t` are rolled back.
+
+CONFIG=/etc/nginx/conf.d/default.conf
+POLL_INTERVAL=${CONFIG_POLL_INTERVAL-5}
+CONFIG_DIR=$(dirname $S3_CONFIG_POINTER)
+CURRENT=""
+
+apply_config() {
+    KEY=$1
+    aws s3 cp "$CONFIG_DIR/$KEY" $CONFIG.new || return 1
+    cp $CONFIG $CONFIG.old
+    mv $CONFIG.new $CONFIG
+    if ! nginx -t
+    then
+        echo "Config $KEY is invalid, keeping the previous one"
+        mv $CONFIG.old $CONFIG
+        return 1
+    fi
+    rm -f $CONFIG.old
+}
+
+while true
+do
+    KEY=$(aws s3 cp $S3_CONFIG_POINTER - 2> /dev/null)
+    if [ -n "$KEY" ] && [ "$KEY" != "$CURRENT" ]
+    then
+        echo "Applying config $KEY"
+        if apply_config $KEY
+        then
+            CURRENT=$KEY
+            [ "$1" = "--once" ] || nginx -s reload
+        elif [ "$1" = "--once" ]
+        then
+            exit 1
+        else
+            # don't retry a broken config until the pointer moves
+            CURRENT=$KEY
+        fi
+    fi
+    [ "$1" = "--once" ] && exit 0
+    sleep $POLL_INTERVAL
+done
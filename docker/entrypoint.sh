@@ -1,7 +1,12 @@
 #!/bin/sh
 set -ex
 
-if [ -n "$S3_CONFIG_PATH" ]
+if [ "$NGINX_HOT_RELOAD" = "true" ] && [ -n "$S3_CONFIG_POINTER" ]
+then
+    echo "Following $S3_CONFIG_POINTER for proxy config"
+    /config_agent.sh --once || echo "Failed to fetch current config, using default config"
+    /config_agent.sh &
+elif [ -n "$S3_CONFIG_PATH" ]
 then
     echo "Using $S3_CONFIG_PATH as proxy config"
     aws s3 cp $S3_CONFIG_PATH /etc/nginx/conf.d/default.conf
@@ -0,0 +1,101 @@
+"""
+Local stand-in for a Parity node, answering JSON-RPC with tunable latency,
+error rate and lag behind the head of a simulated chain
+"""
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+BLOCK_TIME = 15
+START_BLOCK = 7000000
+
+
+class FakeNode:
+    def __init__(self, latency=0.005, jitter=0.002, error_rate=0.0, block_lag=0,
+                 pause_rate=0.0, pause=0.2, started_at=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.block_lag = block_lag
+        # rare long stalls, like a node doing GC or catching up
+        self.pause_rate = pause_rate
+        self.pause = pause
+        self.started_at = started_at or time.time()
+        self.requests = 0
+
+    def block_number(self):
+        return START_BLOCK + int((time.time() - self.started_at) / BLOCK_TIME) - self.block_lag
+
+    def delay(self):
+        if random.random() < self.pause_rate:
+            return self.pause
+        return max(0.0, random.gauss(self.latency, self.jitter))
+
+    def answer(self, request):
+        method = request.get('method')
+        if method == 'eth_blockNumber':
+            result = hex(self.block_number())
+        elif method == 'eth_getBlockByNumber':
+            result = {
+                'number': hex(self.block_number()),
+                'hash': '0x' + '11' * 32,
+                'transactions': ['0x' + '22' * 32] * 100,
+            }
+        else:
+            result = '0x' + '00' * 32
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+    async def handle(self, request):
+        self.requests += 1
+        payload = json.loads(await request.read())
+        await asyncio.sleep(self.delay())
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                return web.Response(status=500, text='Internal Server Error')
+            error = {
+                'jsonrpc': '2.0', 'id': None,
+                'error': {'code': -32603, 'message': 'Internal error'},
+            }
+            return web.json_response(error)
+        if isinstance(payload, list):
+            return web.json_response([self.answer(item) for item in payload])
+        return web.json_response(self.answer(payload))
+
+
+async def start_node(node, host='127.0.0.1'):
+    app = web.Application()
+    app.router.add_post('/', node.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://{host}:{port}'
+
+
+def run_fleet(count, params, urls_queue, stop_event):
+    """
+    Runs `count` nodes in this process until `stop_event` is set, their urls
+    are put on `urls_queue`. The first node is the leader and never lags.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    started_at = time.time()
+    nodes = [
+        FakeNode(**dict(params, block_lag=0 if index == 0 else params.get('block_lag', 0)),
+                 started_at=started_at)
+        for index in range(count + 1)
+    ]
+    started = loop.run_until_complete(asyncio.gather(*[start_node(node) for node in nodes]))
+    urls_queue.put([url for _, url in started])
+
+    async def wait_for_stop():
+        while not stop_event.is_set():
+            await asyncio.sleep(0.1)
+
+    loop.run_until_complete(wait_for_stop())
+    for runner, _ in started:
+        loop.run_until_complete(runner.cleanup())
@@ -0,0 +1,107 @@
+"""
+Compares the codec in handlers/lib/json.py with the encoder it replaced
+
+    $ cd services && python -m benchmarks.json_codec
+"""
+import decimal
+import json as stdlib_json
+import random
+import timeit
+
+from handlers.lib import json
+
+ROUNDS = 200
+
+
+class LegacyEncoder(stdlib_json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, decimal.Decimal):
+            return float(o)
+        return super().default(o)
+
+
+def legacy_dumps_bytes(obj):
+    return stdlib_json.dumps(obj, cls=LegacyEncoder).encode('utf8')
+
+
+def legacy_loads(data):
+    return stdlib_json.loads(data.decode('utf8'))
+
+
+def backend_items(count=200):
+    # backend table as returned by a scan, numbers are Decimals
+    return [
+        {
+            'url': f'http://parity-{i}.example.com:8545',
+            'ws_url': f'ws://parity-{i}.example.com:8546',
+            'is_leader': i == 0,
+            'is_healthy': i % 7 != 0,
+            'pool': 'heavy' if i % 5 == 0 else 'default',
+            'block_number': decimal.Decimal(9000000 + random.randint(0, 20)),
+            'response_time': decimal.Decimal(random.randint(5, 500)),
+            'health_successes': decimal.Decimal(1),
+            'health_failures': decimal.Decimal(0),
+            'when_added': '2019-01-01T00:00:00.000000',
+        }
+        for i in range(count)
+    ]
+
+
+def block_payload(transactions=200):
+    # eth_getBlockByNumber response with full transactions
+    def quantity():
+        return hex(random.getrandbits(64))
+
+    def data(size):
+        return '0x' + ''.join(random.choice('0123456789abcdef') for _ in range(size * 2))
+
+    block = {
+        'number': quantity(), 'hash': data(32), 'parentHash': data(32), 'miner': data(20),
+        'logsBloom': data(256), 'gasUsed': quantity(), 'timestamp': quantity(),
+        'transactions': [
+            {
+                'hash': data(32), 'from': data(20), 'to': data(20), 'value': quantity(),
+                'gas': quantity(), 'gasPrice': quantity(), 'nonce': quantity(),
+                'input': data(random.randint(0, 300)), 'blockNumber': quantity(),
+                'transactionIndex': hex(index), 'v': '0x25', 'r': data(32), 's': data(32),
+            }
+            for index in range(transactions)
+        ],
+    }
+    return {'jsonrpc': '2.0', 'id': 1, 'result': block}
+
+
+def measure(name, call):
+    seconds = min(timeit.repeat(call, number=ROUNDS, repeat=3)) / ROUNDS
+    print(f'  {name:<24} {seconds * 1e6:10.1f} us')
+
+
+def main():
+    random.seed(1)
+    items = backend_items()
+    block = block_payload()
+    encoded_block = legacy_dumps_bytes(block)
+    backends = [
+        backend for backend, module in [
+            (json.ORJSON, json.orjson), (json.UJSON, json.ujson), (json.STDLIB, True)
+        ] if module is not None
+    ]
+
+    print(f'dumps backend list ({len(items)} items)')
+    measure('legacy encoder', lambda: legacy_dumps_bytes(items))
+    for backend in backends:
+        measure(backend, lambda: json.dumps_bytes(items, backend=backend))
+
+    print(f'dumps block ({len(encoded_block)} bytes)')
+    measure('legacy encoder', lambda: legacy_dumps_bytes(block))
+    for backend in backends:
+        measure(backend, lambda: json.dumps_bytes(block, backend=backend))
+
+    print(f'loads block ({len(encoded_block)} bytes)')
+    measure('legacy decoder', lambda: legacy_loads(encoded_block))
+    for backend in backends:
+        measure(backend, lambda: json.loads(encoded_block, backend=backend))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Drives the proxy or the health checks against a fleet of fake nodes at
+a target rate and reports latency percentiles, throughput and memory
+
+    $ cd services && python -m benchmarks.load_test --target proxy --nodes 3 --rps 500
+    $ cd services && python -m benchmarks.load_test --target health --nodes 100 --rps 200
+
+Settings of the proxy are taken from the environment, as in production,
+e.g. `PROXY_HEDGED_METHODS=eth_call`. With `--output` every run is appended
+as a JSON line, together with the commit it was run on, and compared with
+the last run with the same parameters found there.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+from os import path
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.fake_node import run_fleet
+
+if True:
+    sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 'handlers'))
+
+PARAMETERS = (
+    'target', 'url', 'nodes', 'rps', 'duration', 'method', 'batch', 'latency', 'jitter',
+    'error_rate', 'block_lag', 'pause_rate', 'pause',
+)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--target', choices=('proxy', 'health'), default='proxy')
+    parser.add_argument('--url', help='drive this endpoint (e.g. nginx) instead of an in-process proxy')
+    parser.add_argument('--nodes', type=int, default=3, help='nodes besides the leader')
+    parser.add_argument('--rps', type=float, default=200, help='requests (or probes) per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--method', default='eth_call')
+    parser.add_argument('--batch', type=int, default=0, help='send batches of this size')
+    parser.add_argument('--latency', type=float, default=5, help='mean node latency in ms')
+    parser.add_argument('--jitter', type=float, default=2, help='deviation of node latency in ms')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--block-lag', type=int, default=0, help='blocks the nodes lag the leader')
+    parser.add_argument('--pause-rate', type=float, default=0.0, help='chance of a long stall')
+    parser.add_argument('--pause', type=float, default=200, help='length of a stall in ms')
+    parser.add_argument('--output', help='append results to this JSON lines file')
+    return parser.parse_args(args)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def rpc_request(method, index, batch):
+    # distinct calls, so that the cache and coalescing don't hide the nodes
+    params = {
+        'eth_call': [{'to': '0x' + '33' * 20, 'data': '0x70a08231' + f'{index:064x}'}, 'latest'],
+        'eth_getBlockByNumber': ['latest', False],
+    }.get(method, [])
+    request = {'jsonrpc': '2.0', 'id': index, 'method': method, 'params': params}
+    if batch:
+        return json.dumps([dict(request, id=item) for item in range(batch)]).encode('utf8')
+    return json.dumps(request).encode('utf8')
+
+
+async def drive(rps, duration, send):
+    """
+    Open loop: calls are started on schedule whether or not the previous
+    ones finished, latency is measured from the scheduled start
+    """
+    loop = asyncio.get_event_loop()
+    latencies = []
+    errors = 0
+
+    async def one(index, scheduled):
+        nonlocal errors
+        try:
+            ok = await send(index)
+        except Exception:
+            ok = False
+        if ok:
+            latencies.append(loop.time() - scheduled)
+        else:
+            errors += 1
+
+    started_at = loop.time()
+    tasks = []
+    for index in range(int(rps * duration)):
+        scheduled = started_at + index / rps
+        await asyncio.sleep(max(0, scheduled - loop.time()))
+        tasks.append(asyncio.ensure_future(one(index, scheduled)))
+    await asyncio.gather(*tasks)
+    return latencies, errors, loop.time() - started_at
+
+
+async def drive_proxy(args, urls):
+    proxy = runner = None
+    url = args.url
+    if url is None:
+        from handlers.proxy import Proxy, make_app
+        backends = [
+            {'url': node_url, 'is_leader': index == 0, 'is_healthy': True, 'block_number': None}
+            for index, node_url in enumerate(urls)
+        ]
+        proxy = Proxy(load_backends=lambda: backends, save_circuit_state=lambda url, is_open: None)
+        runner = web.AppRunner(make_app(proxy), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/'
+
+    connector = aiohttp.TCPConnector(limit=1000)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def send(index):
+            body = rpc_request(args.method, index, args.batch)
+            async with session.post(url, data=body, headers={'Content-Type': 'application/json'}) as response:
+                payload = await response.read()
+                return response.status == 200 and b'"error"' not in payload
+
+        result = await drive(args.rps, args.duration, send)
+
+    if runner is not None:
+        await runner.cleanup()
+    return result
+
+
+async def drive_health(args, urls):
+    from eth_nodes import close_session, fetch_block_numbers, get_leader_block_number
+    from lib.health import check_passed, next_state
+
+    items = [
+        {'url': node_url, 'is_leader': index == 0, 'is_healthy': True}
+        for index, node_url in enumerate(urls)
+    ]
+
+    async def send(index):
+        # everything get_block_numbers does per cycle, except for the table
+        backends = await fetch_block_numbers(items)
+        leader_block_number = get_leader_block_number(backends)
+        now = int(time.time())
+        for backend in backends:
+            next_state(
+                {'is_healthy': backend['was_healthy']},
+                check_passed(backend['was_healthy'], backend['block_number'], leader_block_number),
+                now)
+        return all(backend['block_number'] for backend in backends)
+
+    # a cycle probes every node, so cycles per second follow from probes per second
+    result = await drive(args.rps / len(items), args.duration, send)
+    await close_session()
+    return result
+
+
+def report(args, latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    results = {
+        'commit': current_commit(),
+        'when': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'parameters': {name: getattr(args, name) for name in PARAMETERS},
+        'completed': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(ordered, 0.5) * 1000, 2) if ordered else None,
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 2) if ordered else None,
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 2) if ordered else None,
+        # the fake nodes run in their own process, this is the proxy alone
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    unit = 'cycles' if args.target == 'health' else 'requests'
+    print(f'{results["completed"]} {unit}, {errors} errors, {results["throughput"]}/s')
+    print(f'p50 {results["p50_ms"]} ms, p95 {results["p95_ms"]} ms, p99 {results["p99_ms"]} ms')
+    print(f'max RSS {results["max_rss_kb"]} KB')
+    return results
+
+
+def compare(results, output):
+    previous = None
+    if path.exists(output):
+        with open(output) as f:
+            for line in f:
+                run = json.loads(line)
+                if run['parameters'] == results['parameters']:
+                    previous = run
+    if previous is None:
+        return
+    print(f'compared with {previous["commit"]} from {previous["when"]}:')
+    for name in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'max_rss_kb'):
+        before, after = previous[name], results[name]
+        if before and after is not None:
+            print(f'  {name:<11} {before:>10} -> {after:<10} ({(after - before) / before:+.1%})')
+
+
+def main():
+    args = parse_args()
+    params = {
+        'latency': args.latency / 1000, 'jitter': args.jitter / 1000,
+        'error_rate': args.error_rate, 'block_lag': args.block_lag,
+        'pause_rate': args.pause_rate, 'pause': args.pause / 1000,
+    }
+    urls_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    fleet = multiprocessing.Process(
+        target=run_fleet, args=(args.nodes, params, urls_queue, stop_event), daemon=True)
+    fleet.start()
+    try:
+        urls = urls_queue.get(timeout=30)
+        loop = asyncio.get_event_loop()
+        driver = drive_health if args.target == 'health' else drive_proxy
+        latencies, errors, elapsed = loop.run_until_complete(driver(args, urls))
+    finally:
+        stop_event.set()
+        fleet.join(timeout=5)
+
+    results = report(args, latencies, errors, elapsed)
+    if args.output:
+        compare(results, args.output)
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import decimal
+import secrets
+from datetime import datetime
+from os import path, sys
+
+from schema import And, Optional, Or, Schema, SchemaError
+
+if True:
+    sys.path.append(path.dirname(path.abspath(__file__)))
+    from backends import error_response
+    from lib.db import get_api_keys_table, scan_items
+    from lib import json
+
+
+positive = And(Or(int, float), lambda value: value > 0)
+
+add_api_key_schema_request = Schema({
+    'name': str,
+    Optional('rate'): positive,
+    Optional('burst'): positive,
+    Optional('heavy_rate'): positive,
+    Optional('heavy_burst'): positive,
+    Optional('daily_quota'): And(int, lambda value: value > 0),
+})
+
+remove_api_key_schema_request = Schema({
+    'api_key': str,
+})
+
+
+def add_api_key(event, context):
+    try:
+        params = add_api_key_schema_request.validate(json.loads(event['body']))
+    except json.JSONDecodeError as e:
+        return error_response(400, e, error_type='parse_error')
+    except SchemaError as e:
+        return error_response(400, e, error_type='validation_error')
+
+    params.update({
+        'api_key': secrets.token_hex(16),
+        'enabled': True,
+        'when_added': datetime.utcnow().isoformat()
+    })
+    # DynamoDB doesn't take floats
+    item = {
+        key: decimal.Decimal(str(value)) if isinstance(value, float) else value
+        for key, value in params.items()
+    }
+    try:
+        get_api_keys_table().put_item(Item=item)
+    except Exception as e:
+        return error_response(500, e)
+    return {
+        'statusCode': 201,
+        'body': json.dumps(params)
+    }
+
+
+def list_api_keys(event, context):
+    items = scan_items(get_api_keys_table())
+    return {
+        'statusCode': 200,
+        'body': json.dumps(items)
+    }
+
+
+def remove_api_key(event, context):
+    try:
+        params = remove_api_key_schema_request.validate(json.loads(event['body']))
+    except json.JSONDecodeError as e:
+        return error_response(400, e, error_type='parse_error')
+    except SchemaError as e:
+        return error_response(400, e, error_type='validation_error')
+
+    try:
+        get_api_keys_table().delete_item(Key={'api_key': params['api_key']})
+    except Exception as e:
+        return error_response(500, e)
+    return {
+        'statusCode': 200,
+        'body': json.dumps(params)
+    }
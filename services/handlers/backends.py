@@ -1,17 +1,20 @@
 from datetime import datetime
 from os import path, sys
 
-from schema import Schema, SchemaError
+from schema import Optional, Or, Schema, SchemaError
 
 if True:
     sys.path.append(path.dirname(path.abspath(__file__)))
-    from lib.db import get_table
+    from lib.db import get_table, scan_items
     from lib import json
+    from lib.routing import DEFAULT_POOL, POOLS
 
 
 add_backend_schema_request = Schema({
     'url': str,
-    'is_leader': bool
+    'is_leader': bool,
+    Optional('pool', default=DEFAULT_POOL): Or(*POOLS),
+    Optional('ws_url'): str
 })
 
 
@@ -50,9 +53,8 @@ def add_backend(event, context):
 
 
 def list_backends(event, context):
-    table = get_table()
-    items = table.scan()
+    items = scan_items(get_table())
     return {
         'statusCode': 200,
-        'body': json.dumps(items['Items'])
+        'body': json.dumps(items)
     }
@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+import hashlib
 import logging
 import json
 import os
@@ -7,62 +8,201 @@ import time
 from os import path, sys
 
 import aiohttp
-import boto3
+from botocore.exceptions import ClientError
 
 if True:
     sys.path.append(path.dirname(path.abspath(__file__)))
-    from lib.db import get_table
+    from lib.aws import get_client
+    from lib.breaker import is_circuit_open
+    from lib.db import CONFIG_UPDATES_KEY, get_table, scan_items
+    from lib.health import (MAX_CONFIG_UPDATES, allow_config_update,
+                            check_passed, current_counters, next_state,
+                            quorum_block_number)
+    from lib.metrics import put_metrics
 
 
 logger = logging.getLogger(__name__)
 
 DIFF_TOLERANCE = int(os.environ.get('DIFF_TOLERANCE', 10))
+PROBE_POOL_SIZE = int(os.environ.get('PROBE_POOL_SIZE', 100))
+DNS_CACHE_TTL = int(os.environ.get('DNS_CACHE_TTL', 300))
+# probes are split by hash of url between this many probe_shard invocations
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1))
+PROBE_CONCURRENCY = int(os.environ.get('PROBE_CONCURRENCY', 50))
+# UpdateItem calls to the backend table in flight at once
+WRITE_CONCURRENCY = int(os.environ.get('WRITE_CONCURRENCY', 25))
+# response time is rewritten only when it moves by more than this fraction
+# and more than this many milliseconds
+RESPONSE_TIME_CHANGE = 0.5
+RESPONSE_TIME_MIN_CHANGE = 10
+THROTTLING_ERRORS = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+}
+
+
+# kept between warm invocations of the lambda
+_session = None
+_session_loop = None
+_cold_start = True
 
 
 def get_block_numbers(event, context):
+    global _cold_start
+    when_started = time.time()
     table = get_table()
-    items = table.scan()['Items']
+    get_client('cloudwatch')
+    get_client('lambda')
+    setup_stats = {
+        'setup_time': int((time.time() - when_started) * 1000),
+        'start': 'cold' if _cold_start else 'warm',
+    }
+    _cold_start = False
+
+    items = scan_items(table)
     loop = asyncio.get_event_loop()
-    backends = loop.run_until_complete(fetch_block_numbers(items))
+    if SHARD_COUNT > 1:
+        backends = loop.run_until_complete(fetch_sharded_block_numbers(items))
+    else:
+        backends = loop.run_until_complete(fetch_block_numbers(items))
 
     needs_global_update = False
     leader_block_number = get_leader_block_number(backends)
+    updates = []
+
+    now = int(time.time())
 
     for backend in backends:
-        block_number = backend['block_number']
         was_healthy = backend['was_healthy']
 
-        updates = {
-            ':vblockNumber': block_number or backend['previous_block_number'],
-        }
-        if not block_number:
-            is_healthy = False
-        elif leader_block_number:
-            is_healthy = (leader_block_number - block_number) < DIFF_TOLERANCE
-        else:
-            # all nodes are not healthy
-            is_healthy = False
-
-        updates[':vis_healthy'] = is_healthy
-        backend['is_healthy'] = is_healthy
-
-        if was_healthy is not is_healthy:
+        # an open circuit in the proxy means the node fails real traffic
+        circuit_open = backend['circuit_open']
+        passed = check_passed(was_healthy, backend['block_number'], leader_block_number)
+        backend.update(next_state(
+            {
+                'is_healthy': was_healthy,
+                'health_successes': backend['previous_health_successes'],
+                'health_failures': backend['previous_health_failures'],
+                'health_changed_at': backend['health_changed_at'],
+            },
+            passed and not circuit_open, now, force_unhealthy=circuit_open,
+        ))
+
+        if was_healthy is not backend['is_healthy']:
             needs_global_update = True
 
-        table.update_item(
-            Key={'url': backend['url']},
-            UpdateExpression='SET block_number = :vblockNumber, is_healthy = :vis_healthy',
-            ExpressionAttributeValues=updates)
+        if needs_write(backend):
+            updates.append(backend_update(table.name, backend))
+
+    # metrics of the probes don't depend on the writes, they are sent meanwhile
+    metrics_sent = loop.run_in_executor(
+        None, put_metrics, backend_metrics(backends, leader_block_number, setup_stats))
+    write_stats = loop.run_until_complete(write_updates(table, updates))
+    write_stats['skipped'] = len(backends) - len(updates)
+
+    request_service_update(table, needs_global_update)
+
+    put_metrics(write_metrics(write_stats))
+    loop.run_until_complete(metrics_sent)
 
-    if needs_global_update:
+
+def request_service_update(table, needed):
+    if not MAX_CONFIG_UPDATES:
+        if needed:
+            trigger_service_update()
+        return
+
+    key = {'url': CONFIG_UPDATES_KEY}
+    window = table.get_item(Key=key).get('Item', {})
+    # an update postponed by the cap is made up for in a later window
+    if not needed and not window.get('pending'):
+        return
+    allowed, window = allow_config_update(window, int(time.time()))
+    if allowed:
         trigger_service_update()
+    else:
+        logger.info('Limit of config updates reached, postponing update')
+    table.put_item(Item=dict(key, pending=not allowed, **window))
+
+
+def previous_counters(backend):
+    return current_counters({
+        'is_healthy': backend['was_healthy'],
+        'health_successes': backend['previous_health_successes'],
+        'health_failures': backend['previous_health_failures'],
+    })
+
+
+def needs_write(backend):
+    block_number = backend['block_number'] or backend['previous_block_number']
+    previous_response_time = float(backend['previous_response_time'] or 0)
+    return (
+        backend['was_healthy'] is not backend['is_healthy'] or
+        previous_counters(backend) != (backend['health_successes'], backend['health_failures']) or
+        block_number != backend['previous_block_number'] or
+        not previous_response_time or
+        abs(backend['elapsed'] - previous_response_time) > max(
+            RESPONSE_TIME_CHANGE * previous_response_time, RESPONSE_TIME_MIN_CHANGE)
+    )
+
+
+def backend_update(table_name, backend):
+    # table.meta.client takes care of converting values to DynamoDB types
+    return {
+        'TableName': table_name,
+        'Key': {'url': backend['url']},
+        'UpdateExpression': (
+            'SET block_number = :vblockNumber, is_healthy = :vis_healthy, '
+            'response_time = :vresponse_time, health_successes = :vhealth_successes, '
+            'health_failures = :vhealth_failures, health_changed_at = :vhealth_changed_at'
+        ),
+        # don't resurrect backends removed in the meantime
+        'ConditionExpression': 'attribute_exists(#url)',
+        'ExpressionAttributeNames': {'#url': 'url'},
+        'ExpressionAttributeValues': {
+            ':vblockNumber': backend['block_number'] or backend['previous_block_number'],
+            ':vis_healthy': backend['is_healthy'],
+            ':vresponse_time': backend['elapsed'],
+            ':vhealth_successes': backend['health_successes'],
+            ':vhealth_failures': backend['health_failures'],
+            ':vhealth_changed_at': backend['health_changed_at'],
+        },
+    }
+
+
+async def write_updates(table, updates):
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(WRITE_CONCURRENCY)
 
-    push_metrics(backends, leader_block_number)
+    async def write(update):
+        async with semaphore:
+            return await loop.run_in_executor(None, write_update, table.meta.client, update)
 
+    # independent writes, a backend removed meanwhile doesn't hold up the others
+    results = await asyncio.gather(*[write(update) for update in updates])
+    return {
+        'retries': sum(retries for retries, _ in results),
+        'throttled': sum(throttled for _, throttled in results),
+    }
 
-def push_metrics(backends, leader_block_number):
-    cloudwatch = boto3.client('cloudwatch')
-    namespace = os.environ['CLOUDWATCH_NAMESPACE']
+
+def write_update(client, update):
+    try:
+        response = client.update_item(**update)
+        return response['ResponseMetadata'].get('RetryAttempts', 0), 0
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        retries = e.response['ResponseMetadata'].get('RetryAttempts', 0)
+        if code in THROTTLING_ERRORS:
+            logger.warning(f'Throttled writing {update["Key"]["url"]}')
+            return retries, 1
+        if code != 'ConditionalCheckFailedException':
+            raise
+        return retries, 0
+
+
+def backend_metrics(backends, leader_block_number, setup_stats=None):
     now = datetime.datetime.now()
     metrics = []
     metrics.extend([
@@ -134,37 +274,148 @@ def push_metrics(backends, leader_block_number):
             if backend['block_number'] and not backend['is_leader']
         ])
 
-    cloudwatch.put_metric_data(Namespace=namespace, MetricData=metrics)
+    if setup_stats:
+        metrics.append(
+            {
+                'MetricName': 'Lambda setup time',
+                'Timestamp': now,
+                'Value': setup_stats['setup_time'],
+                'Unit': 'Milliseconds',
+                'StorageResolution': 60,
+                'Dimensions': [
+                    {
+                        'Name': 'Stack name',
+                        'Value': os.environ['STACK_NAME']
+                    },
+                    {
+                        'Name': 'Start',
+                        'Value': setup_stats['start']
+                    }
+                ]
+            }
+        )
+    return metrics
+
+
+def write_metrics(write_stats):
+    now = datetime.datetime.now()
+    return [
+        {
+            'MetricName': name,
+            'Timestamp': now,
+            'Value': write_stats[key],
+            'Unit': 'Count',
+            'StorageResolution': 60,
+            'Dimensions': [
+                {
+                    'Name': 'Stack name',
+                    'Value': os.environ['STACK_NAME']
+                }
+            ]
+        }
+        for name, key in [
+            ('Backend table write retries', 'retries'),
+            ('Backend table throttled writes', 'throttled'),
+            ('Backend table skipped writes', 'skipped'),
+        ]
+    ]
 
 
 def trigger_service_update():
     logger.info('Triggering update of service')
-    boto3.client('lambda').invoke(
+    get_client('lambda').invoke(
         FunctionName=os.environ['CF_UploadUnderscoreserviceUnderscoreconfigLambdaFunction'],
         InvocationType='Event',
     )
 
 
-def get_leader(backends):
-    try:
-        return [x for x in backends if x['is_leader']][0]
-    except IndexError:
-        return None
+def get_leader_block_number(backends):
+    leader_block_number = quorum_block_number(
+        [backend['block_number'] for backend in backends if backend['is_leader']],
+        [backend['block_number'] for backend in backends if not backend['is_leader']],
+    )
+    return leader_block_number or 0
 
 
-def get_leader_block_number(backends):
-    leader = get_leader(backends)
-    leader_block_number = leader and leader['block_number'] or None
-    if not leader_block_number:
-        leader_block_number = max(
-            [backend['block_number'] or 0 for backend in backends])
-    return leader_block_number
+def get_session():
+    global _session, _session_loop
+    loop = asyncio.get_event_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit=PROBE_POOL_SIZE, ttl_dns_cache=DNS_CACHE_TTL)
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+    return _session
+
+
+async def close_session():
+    if _session is not None:
+        await _session.close()
+
+
+def probe_shard(event, context):
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(probe_block_numbers(event['urls']))
+
+
+def shard_of(url):
+    return int(hashlib.sha1(url.encode('utf8')).hexdigest(), 16) % SHARD_COUNT
+
+
+def invoke_probe_shard(urls):
+    response = get_client('lambda').invoke(
+        FunctionName=os.environ['CF_ProbeUnderscoreshardLambdaFunction'],
+        InvocationType='RequestResponse',
+        Payload=json.dumps({'urls': urls}),
+    )
+    payload = response['Payload'].read()
+    if 'FunctionError' in response:
+        raise Exception(f'Probe shard failed: {payload}')
+    return json.loads(payload)
+
+
+async def fetch_sharded_block_numbers(backends):
+    loop = asyncio.get_event_loop()
+    shards = {}
+    for backend in backends:
+        shards.setdefault(shard_of(backend['url']), []).append(backend['url'])
+    results = await asyncio.gather(*[
+        loop.run_in_executor(None, invoke_probe_shard, urls) for urls in shards.values()
+    ], return_exceptions=True)
+
+    probes = {}
+    for result in results:
+        if isinstance(result, Exception):
+            # nodes of a failed shard keep their state until the next cycle
+            logger.error(f'Failed to probe shard: {result}')
+            continue
+        probes.update((probe['url'], probe) for probe in result)
+    return [
+        probe_result(backend, probe['block_number'], probe['elapsed'])
+        for backend, probe in (
+            (backend, probes[backend['url']]) for backend in backends if backend['url'] in probes
+        )
+    ]
 
 
 async def fetch_block_numbers(backends):
-    async with aiohttp.ClientSession() as session:
-        coros = [fetch_block_number(session, backend) for backend in backends]
-        return await asyncio.gather(*coros)
+    probes = await probe_block_numbers([backend['url'] for backend in backends])
+    return [
+        probe_result(backend, probe['block_number'], probe['elapsed'])
+        for backend, probe in zip(backends, probes)
+    ]
+
+
+async def probe_block_numbers(urls):
+    session = get_session()
+    semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+
+    async def probe(url):
+        # the probe timeout starts once a slot is free
+        async with semaphore:
+            block_number, elapsed = await probe_block_number(session, url)
+        return {'url': url, 'block_number': block_number, 'elapsed': elapsed}
+
+    return await asyncio.gather(*[probe(url) for url in urls])
 
 
 timeout = aiohttp.ClientTimeout(total=2)
@@ -178,6 +429,11 @@ async def decode_response(response):
 
 
 async def fetch_block_number(session, backend):
+    block_number, elapsed = await probe_block_number(session, backend['url'])
+    return probe_result(backend, block_number, elapsed)
+
+
+async def probe_block_number(session, url):
     data = {
         'jsonrpc': '2.0',
         'method': 'eth_blockNumber',
@@ -186,7 +442,6 @@ async def fetch_block_number(session, backend):
     }
     when_started = time.time()
     block_number = None
-    url = backend['url']
     try:
         async with session.post(url, json=data, timeout=timeout) as response:
             if response.status == 200:
@@ -198,11 +453,20 @@ async def fetch_block_number(session, backend):
 
     except Exception as e:
         logger.exception('Failed to get blockNumber', extra={'url': url})
+    return block_number, int((time.time() - when_started) * 1000)
+
+
+def probe_result(backend, block_number, elapsed):
     return {
-        'url': url,
+        'url': backend['url'],
         'previous_block_number': backend.get('block_number', 0),
+        'previous_response_time': backend.get('response_time'),
         'block_number': block_number,
         'is_leader': backend['is_leader'],
-        'elapsed': int((time.time() - when_started) * 1000),
-        'was_healthy': backend['is_healthy']
+        'elapsed': elapsed,
+        'was_healthy': backend['is_healthy'],
+        'circuit_open': is_circuit_open(backend, time.time()),
+        'previous_health_successes': backend.get('health_successes'),
+        'previous_health_failures': backend.get('health_failures'),
+        'health_changed_at': backend.get('health_changed_at'),
     }
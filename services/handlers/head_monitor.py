@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import os
+import time
+from os import path, sys
+
+import aiohttp
+from botocore.exceptions import ClientError
+
+if True:
+    sys.path.append(path.dirname(path.abspath(__file__)))
+    from eth_nodes import (fetch_block_number, get_leader_block_number,
+                           request_service_update)
+    from lib.breaker import is_circuit_open
+    from lib.db import get_table, scan_items
+    from lib.health import check_passed, next_state
+    from lib import json
+
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.environ.get('HEAD_MONITOR_POLL_INTERVAL', 5))
+RECONNECT_DELAY = float(os.environ.get('HEAD_MONITOR_RECONNECT_DELAY', 5))
+RELOAD_INTERVAL = float(os.environ.get('HEAD_MONITOR_RELOAD_INTERVAL', 60))
+
+# kept by get_block_numbers as well, the monitor moves it on with the same state machine
+HEALTH_STATE = ('is_healthy', 'health_successes', 'health_failures', 'health_changed_at')
+
+SUBSCRIBE_REQUEST = {
+    'jsonrpc': '2.0',
+    'id': 1,
+    'method': 'eth_subscribe',
+    'params': ['newHeads']
+}
+
+
+def parse_new_head(message):
+    if not isinstance(message, dict) or message.get('method') != 'eth_subscription':
+        return None
+    try:
+        return int(message['params']['result']['number'], 16)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class HeadMonitor:
+    """
+    Follows heads of all backends, over `eth_subscribe` for backends with
+    `ws_url` and by polling `eth_blockNumber` for the rest (and while a
+    subscription is down), and reports
+    health changes to `on_change` as soon as they happen
+    """
+
+    def __init__(self, session, on_change):
+        self.session = session
+        self.on_change = on_change
+        self.backends = {}
+        self.heads = {}
+        # the last observation counted as a health check of each backend
+        self.checked = {}
+        self.tasks = {}
+
+    def update_backends(self, backends):
+        urls = {backend['url'] for backend in backends}
+        for url in list(self.backends):
+            if url not in urls:
+                self.stop(url)
+
+        now = time.time()
+        for backend in backends:
+            url = backend['url']
+            current = self.backends.get(url)
+            if current is not None and current.get('ws_url') != backend.get('ws_url'):
+                self.stop(url)
+                current = None
+            if current is None:
+                self.backends[url] = dict(
+                    backend, circuit_open=is_circuit_open(backend, now))
+                self.tasks[url] = asyncio.ensure_future(self.watch(self.backends[url]))
+            else:
+                # someone else (the polling lambda) could have changed it meanwhile
+                for key in HEALTH_STATE:
+                    current[key] = backend.get(key)
+                current['is_leader'] = backend['is_leader']
+                current['circuit_open'] = is_circuit_open(backend, now)
+        self.evaluate()
+
+    def stop(self, url):
+        self.tasks.pop(url).cancel()
+        self.backends.pop(url)
+        self.heads.pop(url, None)
+        self.checked.pop(url, None)
+
+    async def watch(self, backend):
+        if backend.get('ws_url'):
+            await self.subscribe(backend)
+        else:
+            await self.poll(backend)
+
+    async def subscribe(self, backend):
+        url = backend['url']
+        while True:
+            try:
+                async with self.session.ws_connect(backend['ws_url'], heartbeat=30) as ws:
+                    await ws.send_str(json.dumps(SUBSCRIBE_REQUEST))
+                    async for message in ws:
+                        if message.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        block_number = parse_new_head(json.loads(message.data))
+                        if block_number is not None:
+                            self.set_head(url, block_number)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.warning(f'Subscription to {url} failed: {e!r}')
+            # the node can still be fine over HTTP, it is polled until the subscription is back
+            result = await fetch_block_number(self.session, backend)
+            self.set_head(url, result['block_number'])
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def poll(self, backend):
+        while True:
+            result = await fetch_block_number(self.session, backend)
+            self.set_head(backend['url'], result['block_number'])
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def set_head(self, url, block_number):
+        if url not in self.backends:
+            return
+        self.heads[url] = block_number
+        self.evaluate()
+
+    def evaluate(self):
+        leader_block_number = get_leader_block_number([
+            {
+                'is_leader': self.backends[url]['is_leader'],
+                'block_number': block_number
+            }
+            for url, block_number in self.heads.items()
+        ]) if self.heads else None
+
+        now = int(time.time())
+        changed = []
+        for url, block_number in self.heads.items():
+            backend = self.backends[url]
+            circuit_open = bool(backend.get('circuit_open'))
+            # one check per new head of the node or new reference height, every
+            # node reporting the same block mustn't count as checks in a row
+            observation = (block_number, leader_block_number, circuit_open)
+            if self.checked.get(url) == observation:
+                continue
+            self.checked[url] = observation
+
+            was_healthy = backend['is_healthy']
+            passed = check_passed(was_healthy, block_number, leader_block_number)
+            backend.update(next_state(
+                backend, passed and not circuit_open, now, force_unhealthy=circuit_open))
+            if backend['is_healthy'] is not was_healthy:
+                if block_number:
+                    backend['block_number'] = block_number
+                changed.append(dict(backend))
+        if changed:
+            self.on_change(changed)
+
+
+def save_health_changes(changed):
+    table = get_table()
+    for backend in changed:
+        logger.info(f'{backend["url"]} is now {"healthy" if backend["is_healthy"] else "unhealthy"}')
+        try:
+            table.update_item(
+                Key={'url': backend['url']},
+                UpdateExpression=(
+                    'SET block_number = :vblockNumber, is_healthy = :vis_healthy, '
+                    'health_successes = :vhealth_successes, health_failures = :vhealth_failures, '
+                    'health_changed_at = :vhealth_changed_at'
+                ),
+                # don't resurrect backends removed in the meantime
+                ConditionExpression='attribute_exists(#url)',
+                ExpressionAttributeNames={'#url': 'url'},
+                ExpressionAttributeValues={
+                    ':vblockNumber': backend.get('block_number') or 0,
+                    ':vis_healthy': backend['is_healthy'],
+                    ':vhealth_successes': backend['health_successes'],
+                    ':vhealth_failures': backend['health_failures'],
+                    ':vhealth_changed_at': backend['health_changed_at'],
+                })
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.info(f'{backend["url"]} was removed, skipping')
+    # the same cap on config regenerations as get_block_numbers
+    request_service_update(table, True)
+
+
+def log_failure(future):
+    if not future.cancelled() and future.exception():
+        # the table keeps the old state until the node changes again or the lambda runs
+        logger.error(f'Saving health changes failed: {future.exception()!r}')
+
+
+async def monitor_heads():
+    loop = asyncio.get_event_loop()
+
+    def on_change(changed):
+        future = loop.run_in_executor(None, save_health_changes, changed)
+        future.add_done_callback(log_failure)
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+        monitor = HeadMonitor(session, on_change)
+        while True:
+            try:
+                backends = await loop.run_in_executor(None, lambda: scan_items(get_table()))
+                monitor.update_backends(backends)
+            except Exception:
+                logger.exception('Failed to reload backends')
+            await asyncio.sleep(RELOAD_INTERVAL)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    asyncio.get_event_loop().run_until_complete(monitor_heads())
+
+
+if __name__ == '__main__':
+    main()
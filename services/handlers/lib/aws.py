@@ -0,0 +1,24 @@
+import os
+
+import boto3
+from botocore.config import Config
+
+# clients live as long as the lambda container, so connections are reused
+# across warm invocations
+MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 50))
+
+_clients = {}
+
+
+def client_config():
+    return Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+
+
+def get_client(service_name):
+    if service_name not in _clients:
+        _clients[service_name] = boto3.client(service_name, config=client_config())
+    return _clients[service_name]
+
+
+def reset_clients():
+    _clients.clear()
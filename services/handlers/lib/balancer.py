@@ -0,0 +1,39 @@
+from collections import defaultdict
+
+# weight of the newest sample in the moving average of latency
+EWMA_DECAY = 0.3
+
+
+class LeastOutstanding:
+    """
+    Prefers nodes with the least requests in flight, scaled by their
+    exponentially weighted moving average latency
+    """
+
+    def __init__(self, decay=EWMA_DECAY):
+        self.decay = decay
+        self.outstanding = defaultdict(int)
+        self.latency = {}
+
+    def seed(self, url, latency):
+        self.latency.setdefault(url, latency)
+
+    def score(self, url):
+        known = self.latency.values()
+        default = sum(known) / len(known) if known else 1.0
+        return (self.outstanding[url] + 1) * self.latency.get(url, default)
+
+    def order(self, urls):
+        # sort is stable, so ties keep the order they were given in
+        return sorted(urls, key=self.score)
+
+    def started(self, url):
+        self.outstanding[url] += 1
+
+    def finished(self, url, elapsed):
+        self.outstanding[url] -= 1
+        previous = self.latency.get(url)
+        if previous is None:
+            self.latency[url] = elapsed
+        else:
+            self.latency[url] = self.decay * elapsed + (1 - self.decay) * previous
@@ -0,0 +1,117 @@
+import os
+import time
+from collections import deque
+
+from . import json
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', 0.5))
+MIN_REQUESTS = int(os.environ.get('BREAKER_MIN_REQUESTS', 20))
+CONSECUTIVE_FAILURES = int(os.environ.get('BREAKER_CONSECUTIVE_FAILURES', 5))
+WINDOW = float(os.environ.get('BREAKER_WINDOW', 10))
+OPEN_DURATION = float(os.environ.get('BREAKER_OPEN_DURATION', 10))
+PROBES = int(os.environ.get('BREAKER_PROBES', 3))
+# open circuits saved to the backend table expire unless their proxy refreshes them,
+# so a proxy which went away doesn't keep the node unhealthy
+STATE_TTL = float(os.environ.get('BREAKER_STATE_TTL', 300))
+# JSON-RPC error codes which mean the node itself is in trouble
+ERROR_CODES = {
+    int(code) for code in os.environ.get('BREAKER_ERROR_CODES', '-32603').split(',') if code
+}
+
+
+class CircuitBreaker:
+    """
+    Ejects a node when too many of the recent requests to it fail, and
+    lets it back in only after `PROBES` probes in a row succeed
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.state = CLOSED
+        self.outcomes = deque()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_successes = 0
+
+    def allow(self):
+        return self.state == CLOSED
+
+    def record(self, success):
+        """
+        Records outcome of a request, returns True when it opened the circuit
+        """
+        if self.state != CLOSED:
+            return False
+        now = self.clock()
+        self.outcomes.append((now, success))
+        while self.outcomes[0][0] < now - WINDOW:
+            self.outcomes.popleft()
+        self.consecutive_failures = 0 if success else self.consecutive_failures + 1
+
+        failures = sum(1 for _, ok in self.outcomes if not ok)
+        if (
+            self.consecutive_failures >= CONSECUTIVE_FAILURES or
+            (len(self.outcomes) >= MIN_REQUESTS and failures / len(self.outcomes) >= ERROR_RATE)
+        ):
+            self.open()
+            return True
+        return False
+
+    def open(self):
+        self.state = OPEN
+        self.opened_at = self.clock()
+        self.outcomes.clear()
+        self.consecutive_failures = 0
+        self.probe_successes = 0
+
+    def should_probe(self):
+        if self.state == OPEN and self.clock() - self.opened_at >= OPEN_DURATION:
+            self.state = HALF_OPEN
+            return True
+        return False
+
+    def record_probe(self, success):
+        """
+        Records outcome of a probe, returns True when it closed the circuit
+        """
+        if self.state != HALF_OPEN:
+            return False
+        if not success:
+            self.open()
+            return False
+        self.probe_successes += 1
+        if self.probe_successes >= PROBES:
+            self.state = CLOSED
+            return True
+        return False
+
+
+def is_circuit_open(backend, now):
+    """
+    Whether a proxy saved an open circuit to the node which hasn't expired yet
+    """
+    opened_at = backend.get('circuit_opened_at')
+    return bool(backend.get('circuit_open')) and opened_at is not None and (
+        now - float(opened_at) < STATE_TTL)
+
+
+def is_node_failure(status, response):
+    if status >= 500:
+        return True
+    if b'"error"' not in response:
+        return False
+    # only parse responses which might carry an error
+    try:
+        decoded = json.loads(response)
+    except ValueError:
+        return True
+    responses = decoded if isinstance(decoded, list) else [decoded]
+    return any(
+        isinstance(item, dict) and isinstance(item.get('error'), dict) and
+        item['error'].get('code') in ERROR_CODES
+        for item in responses
+    )
@@ -0,0 +1,172 @@
+import time
+from collections import OrderedDict
+
+from . import json
+
+# per-entry bookkeeping on top of the raw key and value sizes
+ENTRY_OVERHEAD = 200
+
+# methods whose result never changes once its block is deep enough
+IMMUTABLE_METHODS = {
+    'eth_getBlockByNumber',
+    'eth_getBlockByHash',
+    'eth_getTransactionByHash',
+    'eth_getTransactionReceipt',
+}
+
+# methods answered from the current head, with the position of their block parameter
+HEAD_STATE_METHODS = {
+    'eth_blockNumber': None,
+    'eth_gasPrice': None,
+    'eth_call': 1,
+    'eth_estimateGas': 1,
+    'eth_getBalance': 1,
+    'eth_getCode': 1,
+    'eth_getStorageAt': 2,
+    'eth_getTransactionCount': 1,
+}
+
+
+class LRUCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        entry_size = len(key) + len(value) + ENTRY_OVERHEAD
+        if entry_size > self.max_bytes:
+            return
+        self.discard(key)
+        self.entries[key] = value
+        self.size += entry_size
+        while self.size > self.max_bytes:
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+
+    def discard(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.size -= len(key) + len(value) + ENTRY_OVERHEAD
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class HeadCache(LRUCache):
+    """
+    Cache of results which are valid only until the chain advances
+    """
+
+    def __init__(self, max_bytes, ttl, clock=time.monotonic):
+        super().__init__(max_bytes)
+        self.ttl = ttl
+        self.clock = clock
+        self.head = None
+        self.stored_at = {}
+
+    def set_head(self, block_number):
+        if block_number != self.head:
+            self.head = block_number
+            self.clear()
+
+    def get(self, key):
+        stored_at = self.stored_at.get(key)
+        if stored_at is not None and self.clock() - stored_at > self.ttl:
+            self.discard(key)
+        return super().get(key)
+
+    def set(self, key, value):
+        super().set(key, value)
+        if key in self.entries:
+            self.stored_at[key] = self.clock()
+
+    def discard(self, key):
+        super().discard(key)
+        self.stored_at.pop(key, None)
+
+    def clear(self):
+        super().clear()
+        self.stored_at.clear()
+
+
+def canonical(value):
+    # hex quantities and hashes are case insensitive
+    if isinstance(value, str) and value.startswith('0x'):
+        return value.lower()
+    if isinstance(value, list):
+        return [canonical(item) for item in value]
+    if isinstance(value, dict):
+        return {key: canonical(item) for key, item in value.items()}
+    return value
+
+
+def cache_key(method, params):
+    return method + ':' + json.dumps(canonical(params), sort_keys=True)
+
+
+def immutable_cache_key(payload):
+    method = payload.get('method')
+    params = payload.get('params', [])
+    if not isinstance(method, str) or not isinstance(params, list):
+        return None
+    if method not in IMMUTABLE_METHODS:
+        return None
+    if method == 'eth_getBlockByNumber' and not is_quantity(params and params[0]):
+        # block tags like `latest` point to a different block over time
+        return None
+    return cache_key(method, params)
+
+
+def head_cache_key(payload):
+    method = payload.get('method')
+    params = payload.get('params', [])
+    if not isinstance(method, str) or not isinstance(params, list):
+        return None
+    if method not in HEAD_STATE_METHODS:
+        return None
+    block_param = HEAD_STATE_METHODS[method]
+    if block_param is not None and len(params) > block_param and params[block_param] != 'latest':
+        return None
+    return cache_key(method, params)
+
+
+def is_quantity(value):
+    return isinstance(value, str) and value.startswith('0x')
+
+
+def result_block_number(result):
+    if not isinstance(result, dict):
+        return None
+    block_number = result.get('blockNumber') or result.get('number')
+    if not is_quantity(block_number):
+        # pending transactions and blocks have no number yet
+        return None
+    return int(block_number, 16)
+
+
+def is_finalized(result, finalized_block_number):
+    block_number = result_block_number(result)
+    return (
+        block_number is not None and
+        finalized_block_number is not None and
+        block_number <= finalized_block_number
+    )
+
@@ -0,0 +1,57 @@
+import asyncio
+
+from .cache import cache_key
+
+# read-only methods, identical concurrent calls get identical answers
+COALESCED_METHODS = {
+    'eth_blockNumber',
+    'eth_call',
+    'eth_chainId',
+    'eth_estimateGas',
+    'eth_gasPrice',
+    'eth_getBalance',
+    'eth_getBlockByHash',
+    'eth_getBlockByNumber',
+    'eth_getBlockTransactionCountByHash',
+    'eth_getBlockTransactionCountByNumber',
+    'eth_getCode',
+    'eth_getLogs',
+    'eth_getStorageAt',
+    'eth_getTransactionByBlockHashAndIndex',
+    'eth_getTransactionByBlockNumberAndIndex',
+    'eth_getTransactionByHash',
+    'eth_getTransactionCount',
+    'eth_getTransactionReceipt',
+    'eth_syncing',
+    'net_version',
+}
+
+
+def coalesce_key(payload):
+    method = payload.get('method')
+    params = payload.get('params', [])
+    if not isinstance(method, str) or method not in COALESCED_METHODS:
+        return None
+    return cache_key(method, params)
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, call):
+        """
+        Runs `call` unless the same key is already in flight, returns its
+        result and whether it was shared with an earlier caller
+        """
+        future = self.calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future), True
+
+        future = asyncio.ensure_future(call())
+        self.calls[key] = future
+        future.add_done_callback(lambda _: self.calls.pop(key, None))
+        # a cancelled caller must not cancel the call for everyone else
+        return await asyncio.shield(future), False
@@ -3,9 +3,33 @@ import time
 
 import boto3
 
+from .aws import client_config
 
-def get_table():
+# items which hold state of the proxy rather than a backend
+META_PREFIX = '#'
+CONFIG_UPDATES_KEY = META_PREFIX + 'config_updates'
+
+_tables = {}
+
+
+def get_table(table_name=None):
     local_endpoint = os.environ.get('DYNAMODB_LOCAL_ENDPOINT')
+    table_name = table_name or os.environ['DYNAMODB_TABLE']
+    key = (local_endpoint, table_name)
+    if key not in _tables:
+        _tables[key] = create_table(local_endpoint, table_name)
+    return _tables[key]
+
+
+def get_api_keys_table():
+    return get_table(os.environ['API_KEYS_TABLE'])
+
+
+def reset_tables():
+    _tables.clear()
+
+
+def create_table(local_endpoint, table_name):
     if local_endpoint:
         dynamodb = boto3.resource(
             'dynamodb',
@@ -13,8 +37,9 @@ def get_table():
             region_name='us-east-1',
             aws_access_key_id='anything',
             aws_secret_access_key='anything',
+            config=client_config(),
         )
-        table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
+        table = dynamodb.Table(table_name)
         for _ in range(3):
             try:
                 table.scan()
@@ -26,6 +51,15 @@ def get_table():
             raise Exception(f'Failed to get local db connection. {e}')
 
     else:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
+        dynamodb = boto3.resource('dynamodb', config=client_config())
+        table = dynamodb.Table(table_name)
     return table
+
+
+def scan_items(table):
+    response = table.scan()
+    items = response['Items']
+    while 'LastEvaluatedKey' in response:
+        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
+        items.extend(response['Items'])
+    return [item for item in items if not item.get('url', '').startswith(META_PREFIX)]
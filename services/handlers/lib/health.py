@@ -0,0 +1,131 @@
+import logging
+import os
+import statistics
+
+logger = logging.getLogger(__name__)
+
+# a healthy node is ejected when it lags the reference by at least EJECT_LAG blocks
+# in EJECT_AFTER checks in a row, an unhealthy one is re-admitted once it lags by
+# less than READMIT_LAG blocks in READMIT_AFTER checks in a row
+DIFF_TOLERANCE = int(os.environ.get('DIFF_TOLERANCE', 10))
+EJECT_LAG = int(os.environ.get('HEALTH_EJECT_LAG', DIFF_TOLERANCE))
+READMIT_LAG = int(os.environ.get('HEALTH_READMIT_LAG', DIFF_TOLERANCE))
+EJECT_AFTER = int(os.environ.get('HEALTH_EJECT_AFTER', 1))
+READMIT_AFTER = int(os.environ.get('HEALTH_READMIT_AFTER', 1))
+# seconds a node stays in its state before it can change again
+MIN_HOLD_TIME = float(os.environ.get('HEALTH_MIN_HOLD_TIME', 0))
+
+# leaders further than this from the agreed height are ignored
+LEADER_OUTLIER_TOLERANCE = int(os.environ.get('LEADER_OUTLIER_TOLERANCE', DIFF_TOLERANCE))
+# when our nodes outnumber the leaders, a reference further than this ahead of them is logged
+LEADER_MAX_LEAD = int(os.environ.get('LEADER_MAX_LEAD', 100))
+
+# at most MAX_CONFIG_UPDATES config regenerations per CONFIG_UPDATE_WINDOW seconds, 0 disables the cap
+MAX_CONFIG_UPDATES = int(os.environ.get('MAX_CONFIG_UPDATES', 0))
+CONFIG_UPDATE_WINDOW = float(os.environ.get('CONFIG_UPDATE_WINDOW', 300))
+
+
+def check_passed(is_healthy, block_number, reference_block_number):
+    if not block_number or not reference_block_number:
+        return False
+    lag = reference_block_number - block_number
+    return lag < (EJECT_LAG if is_healthy else READMIT_LAG)
+
+
+def initial_counters(is_healthy):
+    # nodes without counters are treated as settled in their state
+    if is_healthy:
+        return READMIT_AFTER, 0
+    return 0, EJECT_AFTER
+
+
+def current_counters(state):
+    """
+    `health_successes` and `health_failures` of a state, with the initial
+    counters standing in for the missing ones
+    """
+    successes, failures = initial_counters(state['is_healthy'])
+    if state.get('health_successes') is not None:
+        successes = int(state['health_successes'])
+    if state.get('health_failures') is not None:
+        failures = int(state['health_failures'])
+    return successes, failures
+
+
+def next_state(state, passed, now, force_unhealthy=False):
+    """
+    Moves the node state on by one check
+
+    `state` holds `is_healthy`, `health_successes`, `health_failures` and
+    `health_changed_at` (None when unknown), a new dict of them is returned
+    """
+    is_healthy = state['is_healthy']
+    successes, failures = current_counters(state)
+    changed_at = state.get('health_changed_at')
+
+    # counters are capped, so that they stop changing once a node settles
+    if passed:
+        successes, failures = min(successes + 1, READMIT_AFTER), 0
+    else:
+        successes, failures = 0, min(failures + 1, EJECT_AFTER)
+
+    held = changed_at is None or now - float(changed_at) >= MIN_HOLD_TIME
+    if is_healthy and (force_unhealthy or (failures >= EJECT_AFTER and held)):
+        is_healthy = False
+    elif not is_healthy and not force_unhealthy and successes >= READMIT_AFTER and held:
+        is_healthy = True
+
+    if is_healthy is not state['is_healthy']:
+        changed_at = now
+    return {
+        'is_healthy': is_healthy,
+        'health_successes': successes,
+        'health_failures': failures,
+        'health_changed_at': changed_at,
+    }
+
+
+def allow_config_update(window, now):
+    """
+    Counts a config regeneration against the cap, returns whether it may
+    happen and the new window state (`window_start`, `updates`)
+    """
+    window_start = window.get('window_start')
+    updates = int(window.get('updates') or 0)
+    if window_start is None or now - float(window_start) >= CONFIG_UPDATE_WINDOW:
+        window_start, updates = now, 0
+    if MAX_CONFIG_UPDATES and updates >= MAX_CONFIG_UPDATES:
+        return False, {'window_start': window_start, 'updates': updates}
+    return True, {'window_start': window_start, 'updates': updates + 1}
+
+
+def quorum_block_number(leader_block_numbers, node_block_numbers):
+    """
+    Reference height of the chain
+
+    Leaders vote with the median of their heights (the lower middle one of
+    an even vote) and the ones too far from it are rejected as outliers, the
+    highest of the rest is the reference. Our nodes only step in when no
+    leader answered, or when they outnumber the leaders and most of them are
+    ahead: then the leaders are stuck. They never lower the reference, a lead
+    of the leaders over them is only logged.
+    """
+    leader_block_numbers = sorted(number for number in leader_block_numbers if number)
+    node_block_numbers = [number for number in node_block_numbers if number]
+    if not leader_block_numbers:
+        return max(node_block_numbers, default=None)
+
+    # the lower height is the safer guess, it can't eject the whole fleet
+    median = leader_block_numbers[(len(leader_block_numbers) - 1) // 2]
+    reference = max(
+        number for number in leader_block_numbers
+        if abs(number - median) <= LEADER_OUTLIER_TOLERANCE
+    )
+    if len(node_block_numbers) > len(leader_block_numbers):
+        node_median = statistics.median_high(node_block_numbers)
+        if reference - node_median > LEADER_MAX_LEAD:
+            logger.warning(
+                f'Leaders at {reference} are {reference - node_median} blocks ahead of our nodes'
+            )
+        reference = max(reference, node_median)
+    return reference
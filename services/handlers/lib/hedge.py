@@ -0,0 +1,66 @@
+import fnmatch
+import os
+from collections import deque
+
+# hedging is opt-in, only listed read-only methods are hedged
+HEDGED_METHODS = [
+    method.strip()
+    for method in os.environ.get('PROXY_HEDGED_METHODS', '').split(',')
+    if method.strip()
+]
+# a duplicate is sent once the node is slower than this percentile of its latency
+HEDGE_PERCENTILE = float(os.environ.get('PROXY_HEDGE_PERCENTILE', 0.95))
+# at most this fraction of hedged methods is sent twice
+HEDGE_BUDGET = float(os.environ.get('PROXY_HEDGE_BUDGET', 0.05))
+HEDGE_MIN_DELAY = float(os.environ.get('PROXY_HEDGE_MIN_DELAY', 0.01))
+LATENCY_WINDOW = 100
+MIN_SAMPLES = 10
+BUDGET_BURST = 10
+
+
+def is_hedged(payload):
+    method = payload.get('method')
+    return isinstance(method, str) and any(
+        fnmatch.fnmatchcase(method, pattern) for pattern in HEDGED_METHODS)
+
+
+class LatencyTracker:
+    """
+    Latencies of the last `window` successful requests per node
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.samples = {}
+
+    def record(self, url, elapsed):
+        if url not in self.samples:
+            self.samples[url] = deque(maxlen=self.window)
+        self.samples[url].append(elapsed)
+
+    def percentile(self, url, percentile):
+        samples = self.samples.get(url)
+        if not samples or len(samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(percentile * len(ordered)), len(ordered) - 1)]
+
+
+class HedgeBudget:
+    """
+    Every eligible request earns `ratio` of a hedge, a hedge spends a whole one
+    """
+
+    def __init__(self, ratio=HEDGE_BUDGET, burst=BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+
+    def deposit(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
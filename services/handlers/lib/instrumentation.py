@@ -0,0 +1,138 @@
+import bisect
+import os
+import re
+
+# seconds, a bucket counts observations less than or equal to its bound
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# method names come from clients, past this many new ones are counted as `other`
+MAX_METHODS = int(os.environ.get('PROXY_METRICS_MAX_METHODS', 200))
+METHOD_PATTERN = re.compile(r'^[A-Za-z0-9_]{1,64}$')
+OTHER = 'other'
+BATCH = 'batch'
+# status of upstream requests cancelled by a hedge
+CANCELLED = 'cancelled'
+
+REQUEST_DURATION = 'jsonrpc_request_duration_seconds'
+UPSTREAM_DURATION = 'jsonrpc_upstream_duration_seconds'
+HELP = {
+    REQUEST_DURATION: 'Time to answer a client request by method and status',
+    UPSTREAM_DURATION: 'Time to get a response from a node by backend and status',
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last one is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, quantile):
+        """
+        Upper bound of the bucket holding the quantile, capped by the largest observation
+        """
+        if not self.count:
+            return None
+        rank = quantile * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Registry:
+    """
+    Histograms keyed by metric name and labels. Totals are kept for the
+    scrape endpoint, a window since the last roll-up for CloudWatch.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.window = {}
+        self.methods = set()
+
+    def method_label(self, method):
+        if not isinstance(method, str) or not METHOD_PATTERN.match(method):
+            return OTHER
+        if method not in self.methods:
+            if len(self.methods) >= MAX_METHODS:
+                return OTHER
+            self.methods.add(method)
+        return method
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+        for series in (self.totals, self.window):
+            histograms = series.setdefault(name, {})
+            if key not in histograms:
+                histograms[key] = Histogram()
+            histograms[key].observe(value)
+
+    def roll_up(self):
+        window, self.window = self.window, {}
+        return window
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+        for name, histograms in sorted(self.totals.items()):
+            if name in HELP:
+                lines.append(f'# HELP {name} {HELP[name]}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    bucket_labels = format_labels(labels + (('le', str(bound)),))
+                    lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for label, value in labels
+    )
+    return '{' + ','.join(f'{label}="{value}"' for label, value in escaped) + '}'
+
+
+def aggregate(histograms, label, where=None):
+    """
+    Merges histograms of a metric by the value of a single label
+    """
+    merged = {}
+    for labels, histogram in histograms.items():
+        labels = dict(labels)
+        if where is not None and not where(labels):
+            continue
+        value = labels.get(label, OTHER)
+        if value not in merged:
+            merged[value] = Histogram(histogram.buckets)
+        merged[value].merge(histogram)
+    return merged
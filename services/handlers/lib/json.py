@@ -1,18 +1,80 @@
 import decimal
 import json
+import os
 from json import JSONDecodeError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class Encoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, decimal.Decimal):
-            return float(o)
-        return super(DecimalEncoder, self).default(o)
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
+ORJSON = 'orjson'
+UJSON = 'ujson'
+STDLIB = 'json'
 
-def dumps(obj):
-    return json.dumps(obj, cls=Encoder)
 
+def default_backend():
+    if orjson is not None:
+        return ORJSON
+    if ujson is not None:
+        return UJSON
+    return STDLIB
 
-def loads(string):
-    return json.loads(string)
+
+BACKEND = os.environ.get('JSON_BACKEND') or default_backend()
+
+
+def plain(obj):
+    """
+    Copy of `obj` with the Decimals read from DynamoDB converted in one pass,
+    block numbers and counters stay integers
+    """
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, dict):
+        return {key: plain(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [plain(value) for value in obj]
+    return obj
+
+
+def dumps_bytes(obj, sort_keys=False, backend=None):
+    backend = backend or BACKEND
+    try:
+        if backend == ORJSON:
+            option = orjson.OPT_SORT_KEYS if sort_keys else 0
+            return orjson.dumps(obj, option=option)
+        if backend == UJSON:
+            return ujson.dumps(
+                obj, sort_keys=sort_keys, ensure_ascii=False,
+                escape_forward_slashes=False).encode('utf8')
+        return json.dumps(obj, sort_keys=sort_keys).encode('utf8')
+    except (TypeError, OverflowError):
+        # Decimals, or integers over 64 bits which orjson and ujson can't encode,
+        # the standard library handles both once the Decimals are converted
+        return json.dumps(plain(obj), sort_keys=sort_keys).encode('utf8')
+
+
+def dumps(obj, **kwargs):
+    if set(kwargs) - {'sort_keys'}:
+        # formatting options are only supported by the standard library
+        return json.dumps(plain(obj), **kwargs)
+    return dumps_bytes(obj, **kwargs).decode('utf8')
+
+
+def loads(data, backend=None):
+    backend = backend or BACKEND
+    if backend == ORJSON:
+        return orjson.loads(data)
+    if backend == UJSON:
+        try:
+            return ujson.loads(data)
+        except ValueError as e:
+            # keep JSONDecodeError the only error callers have to expect
+            raise JSONDecodeError(str(e), str(data), 0)
+    return json.loads(data)
@@ -0,0 +1,119 @@
+import datetime
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import json
+from .aws import get_client
+
+API = 'api'
+# CloudWatch embedded metric format, metrics are extracted from the log stream
+EMF = 'emf'
+METRICS_FORMAT = os.environ.get('METRICS_FORMAT', API)
+MAX_METRICS_PER_CALL = 20
+MAX_PARALLEL_CALLS = int(os.environ.get('METRICS_PARALLEL_CALLS', 8))
+# an EMF directive takes at most 100 metrics
+MAX_METRICS_PER_EVENT = 100
+
+
+def stack_metric(name, value, unit='None', timestamp=None, dimensions=None):
+    return {
+        'MetricName': name,
+        'Timestamp': timestamp or datetime.datetime.now(),
+        'Value': value,
+        'Unit': unit,
+        'StorageResolution': 60,
+        'Dimensions': [
+            {
+                'Name': 'Stack name',
+                'Value': os.environ['STACK_NAME']
+            }
+        ] + [
+            {'Name': dimension, 'Value': dimension_value}
+            for dimension, dimension_value in (dimensions or {}).items()
+        ]
+    }
+
+
+def statistic_set(metric, count, total, minimum, maximum):
+    """
+    Replaces the value of a metric with a summary of many observations
+    """
+    metric = dict(metric)
+    del metric['Value']
+    metric['StatisticValues'] = {
+        'SampleCount': count,
+        'Sum': total,
+        'Minimum': minimum,
+        'Maximum': maximum,
+    }
+    return metric
+
+
+def put_metrics(metrics, metrics_format=None):
+    if (metrics_format or METRICS_FORMAT) == EMF:
+        # EMF has no statistic sets, these still go through the API
+        print_emf([metric for metric in metrics if 'StatisticValues' not in metric])
+        metrics = [metric for metric in metrics if 'StatisticValues' in metric]
+    chunks = [
+        metrics[start:start + MAX_METRICS_PER_CALL]
+        for start in range(0, len(metrics), MAX_METRICS_PER_CALL)
+    ]
+    if len(chunks) <= 1:
+        for chunk in chunks:
+            put_chunk(chunk)
+        return
+    with ThreadPoolExecutor(max_workers=min(len(chunks), MAX_PARALLEL_CALLS)) as executor:
+        # list() raises the first failure
+        list(executor.map(put_chunk, chunks))
+
+
+def put_chunk(metrics):
+    namespace = os.environ['CLOUDWATCH_NAMESPACE']
+    get_client('cloudwatch').put_metric_data(Namespace=namespace, MetricData=metrics)
+
+
+def emf_events(metrics):
+    """
+    Groups metrics with the same dimensions and timestamp into EMF log events
+    """
+    namespace = os.environ['CLOUDWATCH_NAMESPACE']
+    groups = {}
+    for metric in metrics:
+        dimensions = tuple((d['Name'], d['Value']) for d in metric['Dimensions'])
+        groups.setdefault((metric['Timestamp'], dimensions), []).append(metric)
+
+    events = []
+    for (timestamp, dimensions), group in groups.items():
+        for start in range(0, len(group), MAX_METRICS_PER_EVENT):
+            directive = {
+                'Namespace': namespace,
+                'Dimensions': [[name for name, _ in dimensions]],
+                'Metrics': [],
+            }
+            event = dict(dimensions)
+            event['_aws'] = {
+                'Timestamp': int(timestamp.timestamp() * 1000),
+                'CloudWatchMetrics': [directive],
+            }
+            for metric in group[start:start + MAX_METRICS_PER_EVENT]:
+                name = metric['MetricName']
+                if name in event:
+                    # the same metric again becomes an array of values
+                    if not isinstance(event[name], list):
+                        event[name] = [event[name]]
+                    event[name].append(metric['Value'])
+                    continue
+                event[name] = metric['Value']
+                directive['Metrics'].append({
+                    'Name': name,
+                    'Unit': metric['Unit'],
+                    'StorageResolution': metric['StorageResolution'],
+                })
+            events.append(event)
+    return events
+
+
+def print_emf(metrics):
+    # Lambda sends stdout to CloudWatch Logs, which extracts the metrics
+    for event in emf_events(metrics):
+        print(json.dumps(event), flush=True)
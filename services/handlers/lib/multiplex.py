@@ -0,0 +1,134 @@
+import asyncio
+import itertools
+import logging
+import os
+
+import aiohttp
+
+from . import json
+
+logger = logging.getLogger(__name__)
+
+# send single requests over long-lived WebSockets to backends having `ws_url`
+UPSTREAM_WEBSOCKETS = os.environ.get('PROXY_UPSTREAM_WEBSOCKETS', 'false') == 'true'
+WS_CONNECTIONS = int(os.environ.get('PROXY_WS_CONNECTIONS', 2))
+WS_HEARTBEAT = 30
+
+
+class WebSocketConnection:
+    """
+    A single connection shared by many requests. Requests get ids unique
+    on the connection, responses are matched back by these ids.
+    """
+
+    def __init__(self, session, ws_url):
+        self.session = session
+        self.ws_url = ws_url
+        self.ws = None
+        self.reader = None
+        self.pending = {}
+        self.lock = asyncio.Lock()
+        self._ids = itertools.count(1)
+
+    async def connect(self):
+        async with self.lock:
+            if self.ws is None or self.ws.closed:
+                self.ws = await self.session.ws_connect(self.ws_url, heartbeat=WS_HEARTBEAT)
+                self.reader = asyncio.ensure_future(self.read(self.ws))
+        return self.ws
+
+    async def read(self, ws):
+        try:
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+                try:
+                    response = json.loads(message.data)
+                except ValueError:
+                    logger.warning(f'Invalid response from {self.ws_url}')
+                    continue
+                if not isinstance(response, dict) or not isinstance(response.get('id'), int):
+                    self.notify(response)
+                    continue
+                future = self.pending.pop(response['id'], None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f'Connection to {self.ws_url} failed: {e!r}')
+        finally:
+            # requests sent over this connection won't be answered
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(aiohttp.ServerDisconnectedError())
+            self.pending.clear()
+            if not ws.closed:
+                await ws.close()
+            self.disconnected()
+
+    def notify(self, message):
+        # subscription notifications are dropped unless a subclass wants them
+        pass
+
+    def disconnected(self):
+        pass
+
+    async def call(self, payload):
+        ws = await self.connect()
+        request_id = next(self._ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            await ws.send_str(json.dumps(dict(payload, id=request_id)))
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader is not None:
+            self.reader.cancel()
+
+
+class WebSocketPool:
+    """
+    `size` connections per backend, requests rotate over them
+    """
+
+    def __init__(self, session, size=WS_CONNECTIONS):
+        self.session = session
+        self.size = size
+        self.connections = {}
+        self._rotation = itertools.count()
+
+    def connection(self, ws_url):
+        if ws_url not in self.connections:
+            self.connections[ws_url] = [
+                WebSocketConnection(self.session, ws_url) for _ in range(self.size)
+            ]
+        connections = self.connections[ws_url]
+        return connections[next(self._rotation) % len(connections)]
+
+    async def call(self, ws_url, body):
+        """
+        Returns the response, or None when the body can't be multiplexed
+        """
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return None
+        # batches and notifications keep going over HTTP
+        if not isinstance(payload, dict) or 'id' not in payload:
+            return None
+        response = await self.connection(ws_url).call(payload)
+        response['id'] = payload['id']
+        return json.dumps_bytes(response)
+
+    async def retain(self, ws_urls):
+        # connections to removed backends are closed
+        for ws_url in set(self.connections) - set(ws_urls):
+            for connection in self.connections.pop(ws_url):
+                await connection.close()
+
+    async def close(self):
+        await self.retain([])
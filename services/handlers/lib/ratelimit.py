@@ -0,0 +1,125 @@
+import os
+import time
+from collections import Counter
+
+from .routing import DEFAULT_POOL, HEAVY_POOL
+
+# defaults for keys without their own limits, in requests per second
+DEFAULT_RATE = float(os.environ.get('API_KEY_RATE', 20))
+DEFAULT_BURST = float(os.environ.get('API_KEY_BURST', 100))
+DEFAULT_HEAVY_RATE = float(os.environ.get('API_KEY_HEAVY_RATE', 2))
+DEFAULT_HEAVY_BURST = float(os.environ.get('API_KEY_HEAVY_BURST', 10))
+
+ALLOWED = 'allowed'
+RATE_LIMITED = 'rate_limited'
+OVER_QUOTA = 'over_quota'
+BATCH_TOO_LARGE = 'batch_too_large'
+UNKNOWN_KEY = 'unknown_key'
+
+
+def usage_day(timestamp=None):
+    return time.strftime('%Y%m%d', time.gmtime(timestamp))
+
+
+def usage_attribute(day):
+    return f'usage_{day}'
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated_at = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return self.tokens
+
+
+def key_limits(item):
+    def limit(name, default):
+        value = item.get(name)
+        return float(value) if value is not None else default
+
+    return {
+        DEFAULT_POOL: (limit('rate', DEFAULT_RATE), limit('burst', DEFAULT_BURST)),
+        HEAVY_POOL: (limit('heavy_rate', DEFAULT_HEAVY_RATE), limit('heavy_burst', DEFAULT_HEAVY_BURST)),
+    }
+
+
+class RateLimiter:
+    """
+    Token buckets per API key and method class (pool), with a daily quota
+
+    Usage is only counted here, the proxy saves it to the table every now
+    and then and hands back the total of all proxies with `set_saved_usage`.
+    """
+
+    def __init__(self, clock=time.monotonic, today=usage_day):
+        self.clock = clock
+        self.today = today
+        self.keys = {}
+        self.buckets = {}
+        self.usage = Counter()
+        self.saved_usage = {}
+        self.rejected = Counter()
+
+    def update_keys(self, items):
+        keys = {item['api_key']: item for item in items if item.get('enabled', True)}
+        for api_key, pool in list(self.buckets):
+            item = keys.get(api_key)
+            bucket = self.buckets[api_key, pool]
+            # changed limits take effect right away
+            if item is None or key_limits(item)[pool] != (bucket.rate, bucket.burst):
+                del self.buckets[api_key, pool]
+        self.keys = keys
+
+    def bucket(self, api_key, pool):
+        if (api_key, pool) not in self.buckets:
+            rate, burst = key_limits(self.keys[api_key])[pool]
+            self.buckets[api_key, pool] = TokenBucket(rate, burst, self.clock)
+        return self.buckets[api_key, pool]
+
+    def check(self, api_key, counts):
+        """
+        Admits `counts` requests per pool for the key, all of them or none
+        """
+        item = self.keys.get(api_key)
+        if item is None:
+            self.rejected[UNKNOWN_KEY] += 1
+            return UNKNOWN_KEY
+
+        buckets = [(self.bucket(api_key, pool), count) for pool, count in counts.items() if count]
+        if any(count > bucket.burst for bucket, count in buckets):
+            # the bucket never holds enough tokens, waiting wouldn't help
+            self.rejected[BATCH_TOO_LARGE] += 1
+            return BATCH_TOO_LARGE
+
+        total = sum(counts.values())
+        quota = item.get('daily_quota')
+        if quota is not None and self.used_today(api_key) + total > int(quota):
+            self.rejected[OVER_QUOTA] += 1
+            return OVER_QUOTA
+
+        if any(bucket.refill() < count for bucket, count in buckets):
+            self.rejected[RATE_LIMITED] += 1
+            return RATE_LIMITED
+        for bucket, count in buckets:
+            bucket.tokens -= count
+        self.usage[api_key] += total
+        return ALLOWED
+
+    def used_today(self, api_key):
+        day, saved = self.saved_usage.get(api_key, (None, 0))
+        return (saved if day == self.today() else 0) + self.usage[api_key]
+
+    def drain_usage(self):
+        usage, self.usage = self.usage, Counter()
+        return usage
+
+    def set_saved_usage(self, api_key, day, total):
+        self.saved_usage[api_key] = (day, total)
@@ -0,0 +1,97 @@
+import fnmatch
+import os
+import re
+
+ROUND_ROBIN = 'round_robin'
+WEIGHTED = 'weighted'
+LEAST_CONN = 'least_conn'
+BALANCING_MODE = os.environ.get('BALANCING_MODE', ROUND_ROBIN)
+MAX_WEIGHT = 10
+
+DEFAULT_POOL = 'default'
+HEAVY_POOL = 'heavy'
+POOLS = (DEFAULT_POOL, HEAVY_POOL)
+
+HEAVY_METHODS = [
+    method.strip()
+    for method in os.environ.get(
+        'HEAVY_METHODS', 'eth_getLogs,trace_*,debug_traceTransaction').split(',')
+    if method.strip()
+]
+
+
+def select_upstreams(backends):
+    leaders = []
+    nodes = []
+    for backend in backends:
+        if not backend['is_healthy']:
+            continue
+        if backend['is_leader']:
+            leaders.append(backend['url'])
+        else:
+            nodes.append(backend['url'])
+
+    if nodes:
+        return nodes
+    # nothing of ours is up, fall back to the first healthy leader (if any)
+    return leaders[:1]
+
+
+def backend_pool(backend):
+    pool = backend.get('pool')
+    return pool if pool in POOLS else DEFAULT_POOL
+
+
+def select_pools(backends):
+    pools = {pool: [] for pool in POOLS}
+    for backend in backends:
+        if backend['is_healthy'] and not backend['is_leader']:
+            pools[backend_pool(backend)].append(backend['url'])
+
+    # an empty pool borrows nodes from the other one before falling back to the leader
+    fallback = pools[DEFAULT_POOL] or pools[HEAVY_POOL] or select_upstreams(backends)
+    return {pool: urls or fallback for pool, urls in pools.items()}
+
+
+def select_weights(backends):
+    # faster and better synced nodes get more traffic, the best one gets MAX_WEIGHT
+    latencies = {
+        backend['url']: max(float(backend.get('response_time') or 0), 1.0)
+        for backend in backends
+    }
+    block_numbers = {
+        backend['url']: int(backend.get('block_number') or 0) for backend in backends
+    }
+    if not latencies:
+        return {}
+    fastest = min(latencies.values())
+    top = max(block_numbers.values())
+    return {
+        url: max(1, round(MAX_WEIGHT * fastest / latency / (1 + top - block_numbers[url])))
+        for url, latency in latencies.items()
+    }
+
+
+def method_pool(method):
+    if any(fnmatch.fnmatchcase(method, pattern) for pattern in HEAVY_METHODS):
+        return HEAVY_POOL
+    return DEFAULT_POOL
+
+
+def request_pool(payload):
+    requests = payload if isinstance(payload, list) else [payload]
+    methods = [
+        request.get('method') for request in requests if isinstance(request, dict)
+    ]
+    if any(isinstance(method, str) and method_pool(method) == HEAVY_POOL for method in methods):
+        return HEAVY_POOL
+    return DEFAULT_POOL
+
+
+def heavy_methods_regex():
+    # nginx flavoured regex matching `"method": "<heavy method>"` in a request body
+    alternatives = '|'.join(
+        '[^"]*'.join(re.escape(part) for part in pattern.split('*'))
+        for pattern in HEAVY_METHODS
+    )
+    return f'"method"\\s*:\\s*"({alternatives})"'
@@ -0,0 +1,34 @@
+from . import json
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+LIMIT_EXCEEDED = -32005
+
+
+def rpc_result(request_id, result):
+    # `result` is already serialized, only the envelope is built here
+    return b''.join([
+        b'{"jsonrpc": "2.0", "id": ', json.dumps_bytes(request_id),
+        b', "result": ', result, b'}'
+    ])
+
+
+def rpc_error(request_id, code, message):
+    return json.dumps_bytes({
+        'jsonrpc': '2.0',
+        'id': request_id,
+        'error': {'code': code, 'message': message}
+    })
+
+
+def with_id(response, request_id):
+    try:
+        decoded = json.loads(response)
+    except ValueError:
+        return response
+    if not isinstance(decoded, dict) or decoded.get('id') == request_id:
+        return response
+    decoded['id'] = request_id
+    return json.dumps_bytes(decoded)
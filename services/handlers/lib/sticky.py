@@ -0,0 +1,91 @@
+import bisect
+import hashlib
+import os
+import re
+
+# methods depending on state kept by a single node, pinned to one node per client
+STICKY_METHODS = [
+    method.strip()
+    for method in os.environ.get(
+        'STICKY_METHODS',
+        'eth_newFilter,eth_newBlockFilter,eth_newPendingTransactionFilter,'
+        'eth_getFilterChanges,eth_getFilterLogs,eth_uninstallFilter,'
+        'eth_sendRawTransaction,eth_sendTransaction').split(',')
+    if method.strip()
+]
+# pinned only when asked about the `pending` block, the node's own mempool
+PENDING_STATE_METHODS = {'eth_getTransactionCount': 1}
+FILTER_CREATING_METHODS = {'eth_newFilter', 'eth_newBlockFilter', 'eth_newPendingTransactionFilter'}
+# methods taking the filter id as the first parameter
+FILTER_METHODS = {'eth_getFilterChanges', 'eth_getFilterLogs', 'eth_uninstallFilter'}
+PENDING = 'pending'
+RING_REPLICAS = 100
+
+
+def is_sticky(payload):
+    method = payload.get('method')
+    if not isinstance(method, str):
+        return False
+    if method in STICKY_METHODS:
+        return True
+    params = payload.get('params')
+    if method in PENDING_STATE_METHODS and isinstance(params, list):
+        position = PENDING_STATE_METHODS[method]
+        return len(params) > position and params[position] == PENDING
+    return False
+
+
+def filter_id(payload):
+    params = payload.get('params')
+    if payload.get('method') not in FILTER_METHODS or not isinstance(params, list) or not params:
+        return None
+    return params[0] if isinstance(params[0], str) else None
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to nodes, when a node goes away only the keys
+    it owned move, each to the next node on the ring
+    """
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = sorted(set(nodes))
+        points = sorted(
+            (ring_hash(f'{node}#{replica}'), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def walk(self, key):
+        """
+        All nodes, starting with the owner of the key
+        """
+        if not self.nodes:
+            return []
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        order = []
+        for index in range(start, start + len(self.owners)):
+            node = self.owners[index % len(self.owners)]
+            if node not in order:
+                order.append(node)
+                if len(order) == len(self.nodes):
+                    break
+        return order
+
+
+def sticky_methods_regex():
+    # nginx flavoured regex matching a request body calling a sticky method
+    methods = '|'.join(re.escape(method) for method in STICKY_METHODS)
+    pending = '|'.join(
+        f'"method"\\s*:\\s*"{re.escape(method)}".*"{PENDING}"|'
+        f'"{PENDING}".*"method"\\s*:\\s*"{re.escape(method)}"'
+        for method in PENDING_STATE_METHODS
+    )
+    alternatives = [f'"method"\\s*:\\s*"({methods})"'] if methods else []
+    return '|'.join(alternatives + [pending])
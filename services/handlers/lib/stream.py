@@ -0,0 +1,78 @@
+import fnmatch
+import os
+import re
+
+from . import json
+from .breaker import is_node_failure
+from .routing import DEFAULT_POOL, HEAVY_POOL, heavy_methods_regex
+
+# responses of these methods are passed to the client as they arrive
+STREAMED_METHODS = [
+    method.strip()
+    for method in os.environ.get(
+        'PROXY_STREAMED_METHODS', 'eth_getLogs,trace_*,debug_trace*').split(',')
+    if method.strip()
+]
+# requests bigger than this (or without Content-Length) are streamed to the node
+STREAM_REQUEST_SIZE = int(os.environ.get('PROXY_STREAM_REQUEST_SIZE', 1024 * 1024))
+STREAM_CHUNK_SIZE = 64 * 1024
+# bytes kept from both ends of a streamed response
+SCAN_SIZE = 64 * 1024
+
+ID_VALUE = rb'("(?:[^"\\]|\\.)*"|-?\d+|null)'
+HEAD_ID = re.compile(
+    rb'^\s*\{\s*(?:"jsonrpc"\s*:\s*"2\.0"\s*,\s*)?"id"\s*:\s*' + ID_VALUE)
+TAIL_ID = re.compile(rb'"id"\s*:\s*' + ID_VALUE + rb'\s*\}\s*$')
+
+
+def is_streamed(payload):
+    method = payload.get('method')
+    return isinstance(method, str) and any(
+        fnmatch.fnmatchcase(method, pattern) for pattern in STREAMED_METHODS)
+
+
+def prefix_pool(prefix):
+    # the method of a streamed request is looked up in its first bytes only
+    if re.search(heavy_methods_regex().encode('utf8'), prefix):
+        return HEAVY_POOL
+    return DEFAULT_POOL
+
+
+class ResponseScanner:
+    """
+    Keeps the first and the last `scan_size` bytes of a response fed in
+    chunks, which is where the top-level `id` and `error` of a JSON-RPC
+    response are. Error responses are small, so they are kept whole.
+    """
+
+    def __init__(self, scan_size=SCAN_SIZE):
+        self.scan_size = scan_size
+        self.head = bytearray()
+        self.tail = b''
+        self.size = 0
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if len(self.head) < self.scan_size:
+            self.head += chunk[:self.scan_size - len(self.head)]
+        self.tail = (self.tail + chunk)[-self.scan_size:]
+
+    @property
+    def is_complete(self):
+        return self.size <= self.scan_size
+
+    def response_id(self):
+        if self.is_complete:
+            try:
+                response = json.loads(bytes(self.head))
+            except ValueError:
+                return None
+            return response.get('id') if isinstance(response, dict) else None
+        match = HEAD_ID.match(self.head) or TAIL_ID.search(self.tail)
+        return json.loads(match.group(1)) if match else None
+
+    def is_node_failure(self, status):
+        if status >= 500:
+            return True
+        # a large response is a result
+        return self.is_complete and is_node_failure(status, bytes(self.head))
@@ -0,0 +1,250 @@
+import asyncio
+import itertools
+import logging
+import os
+import secrets
+
+import aiohttp
+
+from . import json
+from .multiplex import WebSocketConnection
+
+logger = logging.getLogger(__name__)
+
+# notifications waiting for a slow client, it is disconnected past this
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('PROXY_SUBSCRIBER_QUEUE_SIZE', 1000))
+RESUBSCRIBE_DELAY = float(os.environ.get('PROXY_RESUBSCRIBE_DELAY', 1))
+SUBSCRIBE_TIMEOUT = 10
+
+
+class SubscriptionError(Exception):
+    """
+    The node refused the subscription, `error` is its JSON-RPC error
+    """
+
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+class NoNodeError(Exception):
+    pass
+
+
+def subscription_key(params):
+    # `logs` with the same filter in a different key order is the same subscription
+    return json.dumps(params, sort_keys=True)
+
+
+def notification(subscription_id, result):
+    # `result` is already serialized, it is shared by all subscribers
+    return b''.join([
+        b'{"jsonrpc": "2.0", "method": "eth_subscription", "params": {"subscription": ',
+        json.dumps_bytes(subscription_id), b', "result": ', result, b'}}'
+    ])
+
+
+class Subscriber:
+    """
+    A client connection, notifications are queued for its writer
+    """
+
+    def __init__(self, on_overflow, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.on_overflow = on_overflow
+        self.queue = asyncio.Queue(queue_size)
+        self.subscriptions = set()
+        self.overflowed = False
+
+    def send(self, message):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            self.on_overflow()
+
+
+class SharedSubscription:
+    """
+    One node-side subscription fanned out to every client with the same params
+    """
+
+    def __init__(self, key, params):
+        self.key = key
+        self.params = params
+        self.subscribers = {}
+        self.connection = None
+        self.upstream_id = None
+        # the first subscription at a node, and moving to another one
+        self.attached = None
+        self.moving = None
+
+    def publish(self, result):
+        result = json.dumps_bytes(result)
+        for subscription_id, subscriber in list(self.subscribers.items()):
+            subscriber.send(notification(subscription_id, result))
+
+
+class NodeConnection(WebSocketConnection):
+    def __init__(self, session, url, ws_url, on_lost):
+        super().__init__(session, ws_url)
+        self.url = url
+        self.on_lost = on_lost
+        self.subscriptions = {}
+
+    async def subscribe(self, shared):
+        response = await asyncio.wait_for(self.call(
+            {'jsonrpc': '2.0', 'method': 'eth_subscribe', 'params': shared.params}),
+            SUBSCRIBE_TIMEOUT)
+        if 'error' in response:
+            raise SubscriptionError(response['error'])
+        self.subscriptions[response['result']] = shared
+        return response['result']
+
+    async def unsubscribe(self, upstream_id):
+        self.subscriptions.pop(upstream_id, None)
+        if self.ws is None or self.ws.closed:
+            # the node dropped it along with the connection
+            return
+        await self.call(
+            {'jsonrpc': '2.0', 'method': 'eth_unsubscribe', 'params': [upstream_id]})
+
+    def notify(self, message):
+        if not isinstance(message, dict) or message.get('method') != 'eth_subscription':
+            return
+        params = message.get('params')
+        if not isinstance(params, dict) or not isinstance(params.get('subscription'), str):
+            return
+        shared = self.subscriptions.get(params['subscription'])
+        if shared is not None:
+            shared.publish(params.get('result'))
+
+    def disconnected(self):
+        lost, self.subscriptions = list(self.subscriptions.values()), {}
+        self.on_lost(self, lost)
+
+
+class SubscriptionHub:
+    """
+    Deduplicates client subscriptions. Each distinct subscription lives on
+    a single healthy node and moves to another one when its node goes away,
+    clients keep their subscription ids.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.nodes = {}
+        self.connections = {}
+        self.shared = {}
+        self.by_id = {}
+        self._rotation = itertools.count()
+
+    def update_nodes(self, nodes):
+        """
+        `nodes` maps urls of healthy nodes to their `ws_url`
+        """
+        self.nodes = dict(nodes)
+        for url in list(self.connections):
+            if self.nodes.get(url) != self.connections[url].ws_url:
+                connection = self.connections.pop(url)
+                lost, connection.subscriptions = list(connection.subscriptions.values()), {}
+                asyncio.ensure_future(connection.close())
+                self.migrate(lost)
+
+    def connection(self, url):
+        if url not in self.connections:
+            self.connections[url] = NodeConnection(
+                self.session, url, self.nodes[url], self.connection_lost)
+        return self.connections[url]
+
+    def connection_lost(self, connection, lost):
+        if self.connections.get(connection.url) is connection:
+            del self.connections[connection.url]
+        self.migrate(lost)
+
+    def migrate(self, lost):
+        for shared in lost:
+            shared.connection = shared.upstream_id = None
+            if self.shared.get(shared.key) is shared:
+                logger.info(f'Moving subscription {shared.key} to another node')
+                shared.moving = asyncio.ensure_future(self.reattach(shared))
+
+    async def attach(self, shared):
+        urls = list(self.nodes)
+        if not urls:
+            raise NoNodeError()
+        start = next(self._rotation) % len(urls)
+        error = None
+        for url in urls[start:] + urls[:start]:
+            connection = self.connection(url)
+            try:
+                shared.upstream_id = await connection.subscribe(shared)
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError) as e:
+                logger.warning(f'Subscribing at {url} failed: {e!r}')
+                error = e
+                continue
+            shared.connection = connection
+            return
+        raise error
+
+    async def reattach(self, shared):
+        while self.shared.get(shared.key) is shared:
+            try:
+                await self.attach(shared)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, NoNodeError,
+                    SubscriptionError) as e:
+                logger.warning(f'Moving subscription {shared.key} failed: {e!r}')
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
+
+    async def subscribe(self, subscriber, params):
+        key = subscription_key(params)
+        shared = self.shared.get(key)
+        if shared is None:
+            shared = self.shared[key] = SharedSubscription(key, params)
+            shared.attached = asyncio.ensure_future(self.attach(shared))
+        try:
+            # concurrent subscribers wait for the same node-side subscription,
+            # a subscription being moved is joined right away
+            await asyncio.shield(shared.attached)
+        except Exception:
+            if self.shared.get(key) is shared and not shared.subscribers:
+                del self.shared[key]
+            raise
+        subscription_id = '0x' + secrets.token_hex(16)
+        shared.subscribers[subscription_id] = subscriber
+        self.by_id[subscription_id] = shared
+        subscriber.subscriptions.add(subscription_id)
+        return subscription_id
+
+    def unsubscribe(self, subscriber, subscription_id):
+        shared = self.by_id.get(subscription_id)
+        if shared is None or shared.subscribers.get(subscription_id) is not subscriber:
+            return False
+        del self.by_id[subscription_id]
+        del shared.subscribers[subscription_id]
+        subscriber.subscriptions.discard(subscription_id)
+        if not shared.subscribers:
+            del self.shared[shared.key]
+            if shared.connection is not None:
+                future = asyncio.ensure_future(shared.connection.unsubscribe(shared.upstream_id))
+                future.add_done_callback(ignore_failure)
+            for task in (shared.attached, shared.moving):
+                if task is not None:
+                    task.cancel()
+        return True
+
+    def drop(self, subscriber):
+        for subscription_id in list(subscriber.subscriptions):
+            self.unsubscribe(subscriber, subscription_id)
+
+    async def close(self):
+        for connection in list(self.connections.values()):
+            await connection.close()
+        self.connections = {}
+
+
+def ignore_failure(future):
+    if not future.cancelled() and future.exception():
+        logger.warning(f'Unsubscribing failed: {future.exception()!r}')
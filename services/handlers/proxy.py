@@ -0,0 +1,947 @@
+import asyncio
+import datetime
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+from os import path, sys
+
+import aiohttp
+from aiohttp import WSCloseCode, web
+
+if True:
+    sys.path.append(path.dirname(path.abspath(__file__)))
+    from eth_nodes import DIFF_TOLERANCE, get_leader_block_number
+    from lib.db import get_api_keys_table, get_table, scan_items
+    from lib import json
+    from lib.balancer import LeastOutstanding
+    from lib.breaker import (HALF_OPEN, OPEN, STATE_TTL, CircuitBreaker,
+                             is_node_failure)
+    from lib.cache import (HeadCache, LRUCache, head_cache_key,
+                           immutable_cache_key, is_finalized)
+    from lib.coalesce import SingleFlight, coalesce_key
+    from lib.hedge import (HEDGE_MIN_DELAY, HEDGE_PERCENTILE, HEDGED_METHODS,
+                           HedgeBudget, LatencyTracker, is_hedged)
+    from lib.instrumentation import (BATCH, CANCELLED, OTHER, REQUEST_DURATION,
+                                     UPSTREAM_DURATION, Registry, aggregate)
+    from lib.metrics import put_metrics, stack_metric, statistic_set
+    from lib.multiplex import UPSTREAM_WEBSOCKETS, WS_HEARTBEAT, WebSocketPool
+    from lib.ratelimit import (ALLOWED, BATCH_TOO_LARGE, OVER_QUOTA, RATE_LIMITED, UNKNOWN_KEY,
+                               RateLimiter, usage_attribute, usage_day)
+    from lib.routing import (BALANCING_MODE, DEFAULT_POOL, ROUND_ROBIN,
+                             request_pool, select_pools)
+    from lib.rpc import (INTERNAL_ERROR, INVALID_PARAMS, INVALID_REQUEST,
+                         LIMIT_EXCEEDED, PARSE_ERROR, rpc_error, rpc_result,
+                         with_id)
+    from lib.sticky import (FILTER_CREATING_METHODS, HashRing, filter_id,
+                            is_sticky)
+    from lib.stream import (STREAM_CHUNK_SIZE, STREAM_REQUEST_SIZE,
+                            ResponseScanner, is_streamed, prefix_pool)
+    from lib.subscriptions import (NoNodeError, Subscriber, SubscriptionError,
+                                   SubscriptionHub)
+
+
+logger = logging.getLogger(__name__)
+
+PROXY_PORT = int(os.environ.get('PROXY_PORT', 80))
+REFRESH_INTERVAL = float(os.environ.get('PROXY_REFRESH_INTERVAL', 5))
+POOL_SIZE = int(os.environ.get('PROXY_POOL_SIZE', 100))
+# 0 lets a single node take the whole pool
+POOL_SIZE_PER_HOST = int(os.environ.get('PROXY_POOL_SIZE_PER_HOST', 0))
+KEEPALIVE_TIMEOUT = float(os.environ.get('PROXY_KEEPALIVE_TIMEOUT', 60))
+UPSTREAM_TIMEOUT = float(os.environ.get('PROXY_UPSTREAM_TIMEOUT', 30))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 64 * 1024 * 1024))
+HEAD_CACHE_SIZE = int(os.environ.get('HEAD_CACHE_SIZE', 16 * 1024 * 1024))
+HEAD_CACHE_TTL = float(os.environ.get('HEAD_CACHE_TTL', 2))
+BATCH_MAX_SIZE = int(os.environ.get('PROXY_BATCH_MAX_SIZE', 50))
+PROBE_INTERVAL = float(os.environ.get('PROXY_PROBE_INTERVAL', 1))
+METRICS_INTERVAL = float(os.environ.get('PROXY_METRICS_INTERVAL', 60))
+# scrape endpoint, the port is not published by the task definition, 0 disables it
+METRICS_PORT = int(os.environ.get('PROXY_METRICS_PORT', 9100))
+# requests without a known API key are refused when enabled
+API_KEYS_ENABLED = os.environ.get('PROXY_API_KEYS', 'false') == 'true'
+USAGE_FLUSH_INTERVAL = float(os.environ.get('PROXY_USAGE_FLUSH_INTERVAL', 60))
+API_KEY_HEADER = 'X-Api-Key'
+# filter ids remembered with the node which created them
+MAX_PINNED_FILTERS = int(os.environ.get('PROXY_MAX_PINNED_FILTERS', 100000))
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+PROBE_TIMEOUT = aiohttp.ClientTimeout(total=2)
+PROBE_BODY = b'{"jsonrpc": "2.0", "id": 1, "method": "eth_blockNumber", "params": []}'
+SUBSCRIPTION_METHODS = ('eth_subscribe', 'eth_unsubscribe')
+OPENMETRICS_HEADERS = {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+# histogram, label, CloudWatch dimension and metric name of the roll-ups
+ROLL_UPS = (
+    (REQUEST_DURATION, 'method', 'Method', 'Requests'),
+    (UPSTREAM_DURATION, 'backend', 'Node URL', 'Upstream requests'),
+)
+ROLL_UP_PERCENTILES = (50, 99)
+
+
+class NoUpstreamError(Exception):
+    pass
+
+
+def scan_backends():
+    return scan_items(get_table())
+
+
+def save_circuit_state(url, is_open):
+    # get_block_numbers keeps nodes with open circuit unhealthy until the state expires
+    get_table().update_item(
+        Key={'url': url},
+        UpdateExpression=(
+            'SET circuit_open = :vcircuit_open, circuit_opened_at = :vcircuit_opened_at'),
+        ConditionExpression='attribute_exists(#url)',
+        ExpressionAttributeNames={'#url': 'url'},
+        ExpressionAttributeValues={
+            ':vcircuit_open': is_open,
+            ':vcircuit_opened_at': int(time.time()),
+        })
+
+
+def scan_api_keys():
+    return scan_items(get_api_keys_table())
+
+
+def save_usage(api_key, count, day):
+    """
+    Adds usage of this proxy to the key, returns usage of all proxies today
+    """
+    previous_day = (
+        datetime.datetime.strptime(day, '%Y%m%d') - datetime.timedelta(days=1)
+    ).strftime('%Y%m%d')
+    response = get_api_keys_table().update_item(
+        Key={'api_key': api_key},
+        UpdateExpression='ADD #today :vcount REMOVE #yesterday',
+        ConditionExpression='attribute_exists(api_key)',
+        ExpressionAttributeNames={
+            '#today': usage_attribute(day),
+            '#yesterday': usage_attribute(previous_day),
+        },
+        ExpressionAttributeValues={':vcount': count},
+        ReturnValues='UPDATED_NEW',
+    )
+    return int(response['Attributes'][usage_attribute(day)])
+
+
+def reference_block_number(backends):
+    if not backends:
+        return None
+    return get_leader_block_number([
+        {
+            'is_leader': backend['is_leader'],
+            'block_number': int(backend.get('block_number') or 0) or None
+        }
+        for backend in backends
+    ]) or None
+
+
+def upstream_error(error):
+    return 'timeout' if isinstance(error, asyncio.TimeoutError) else 'error'
+
+
+def is_failed(labels):
+    return labels.get('status') not in ('200', CANCELLED)
+
+
+def client_key(request):
+    # the load balancer adds the client address to X-Forwarded-For
+    return (
+        request.headers.get(API_KEY_HEADER) or request.query.get('api_key') or
+        request.headers.get('X-Forwarded-For', '').split(',')[0].strip() or request.remote
+    )
+
+
+def request_counts(payload):
+    requests = payload if isinstance(payload, list) and payload else [payload]
+    counts = {}
+    for request in requests:
+        pool = request_pool(request if isinstance(request, dict) else [])
+        counts[pool] = counts.get(pool, 0) + 1
+    return counts
+
+
+class Proxy:
+    def __init__(self, load_backends=scan_backends, save_circuit_state=save_circuit_state,
+                 load_api_keys=None, save_usage=save_usage):
+        self.load_backends = load_backends
+        self.save_circuit_state = save_circuit_state
+        self.load_api_keys = load_api_keys
+        self.save_usage = save_usage
+        self.limiter = RateLimiter() if load_api_keys else None
+        self.breakers = {}
+        # when open circuits were last saved, they are refreshed before they expire
+        self.saved_circuits = {}
+        self.pools = {}
+        self.finalized_block_number = None
+        self.cache = LRUCache(RESPONSE_CACHE_SIZE)
+        self.head_cache = HeadCache(HEAD_CACHE_SIZE, HEAD_CACHE_TTL)
+        self.single_flight = SingleFlight()
+        self.balancer = LeastOutstanding()
+        self.latencies = LatencyTracker()
+        self.hedge_budget = HedgeBudget()
+        self.hedged = 0
+        self.hedges_won = 0
+        self.instruments = Registry()
+        self.ws_urls = {}
+        self.websockets = None
+        self.subscriptions = None
+        self.ring = HashRing([])
+        self.filters = OrderedDict()
+        self.session = None
+        self._round_robin = itertools.count()
+        self._reported = {}
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=POOL_SIZE, limit_per_host=POOL_SIZE_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=UPSTREAM_TIMEOUT))
+        if UPSTREAM_WEBSOCKETS:
+            self.websockets = WebSocketPool(self.session)
+        self.subscriptions = SubscriptionHub(self.session)
+        await self.refresh()
+
+    async def close(self):
+        if self.websockets:
+            await self.websockets.close()
+        if self.subscriptions:
+            await self.subscriptions.close()
+        if self.session:
+            await self.session.close()
+
+    def update_backends(self, backends):
+        pools = select_pools(backends)
+        if pools != self.pools:
+            logger.info(f'Switching upstreams to {pools}')
+        # a single assignment, requests in flight keep their own snapshot
+        self.pools = pools
+        self.ws_urls = {
+            backend['url']: backend['ws_url'] for backend in backends if backend.get('ws_url')
+        }
+        self.ring = HashRing(pools[DEFAULT_POOL])
+        for pinned_filter, url in list(self.filters.items()):
+            # the filter is gone with its node, the client gets re-pinned by its key
+            if url not in self.ring.nodes:
+                del self.filters[pinned_filter]
+        if self.subscriptions is not None:
+            # subscriptions on nodes which are gone move to the remaining ones
+            self.subscriptions.update_nodes({
+                url: self.ws_urls[url] for url in pools[DEFAULT_POOL] if url in self.ws_urls
+            })
+
+        for backend in backends:
+            if backend.get('response_time'):
+                # table keeps milliseconds
+                self.balancer.seed(backend['url'], float(backend['response_time']) / 1000)
+
+        block_number = reference_block_number(backends)
+        if block_number:
+            self.finalized_block_number = block_number - DIFF_TOLERANCE
+            self.head_cache.set_head(block_number)
+
+    async def refresh(self):
+        loop = asyncio.get_event_loop()
+        backends = await loop.run_in_executor(None, self.load_backends)
+        self.update_backends(backends)
+        if self.websockets is not None:
+            await self.websockets.retain(self.ws_urls.values())
+        if self.limiter is not None:
+            self.limiter.update_keys(await loop.run_in_executor(None, self.load_api_keys))
+
+    async def flush_usage(self):
+        loop = asyncio.get_event_loop()
+        day = usage_day()
+        for api_key, count in self.limiter.drain_usage().items():
+            try:
+                total = await loop.run_in_executor(None, self.save_usage, api_key, count, day)
+            except Exception:
+                logger.exception('Failed to save usage of API key')
+                if api_key in self.limiter.keys:
+                    # counted again with the next flush
+                    self.limiter.usage[api_key] += count
+                continue
+            self.limiter.set_saved_usage(api_key, day, total)
+
+    async def watch_usage(self):
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            await self.flush_usage()
+
+    async def watch_backends(self):
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception('Failed to refresh backends')
+
+    def breaker(self, url):
+        if url not in self.breakers:
+            self.breakers[url] = CircuitBreaker()
+        return self.breakers[url]
+
+    def upstream_order(self, pool=DEFAULT_POOL):
+        upstreams = self.pools.get(pool)
+        if not upstreams:
+            raise NoUpstreamError()
+        # if every circuit is open, trying them is still better than failing right away
+        upstreams = [url for url in upstreams if self.breaker(url).allow()] or upstreams
+        start = next(self._round_robin) % len(upstreams)
+        upstreams = upstreams[start:] + upstreams[:start]
+        if BALANCING_MODE != ROUND_ROBIN:
+            upstreams = self.balancer.order(upstreams)
+        return upstreams
+
+    async def forward(self, body, pool=DEFAULT_POOL, upstreams=None):
+        # same semantics as `proxy_next_upstream error timeout` in nginx config
+        error = None
+        for url in upstreams or self.upstream_order(pool):
+            try:
+                return await self.forward_to(url, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+        raise error
+
+    async def forward_to(self, url, body):
+        self.balancer.started(url)
+        when_started = time.monotonic()
+        # left as it is when a hedge cancels the request
+        label = CANCELLED
+        try:
+            status, payload = await self.send(url, body)
+            label = status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f'Upstream {url} failed: {e!r}')
+            label = upstream_error(e)
+            self.record_outcome(url, success=False)
+            raise
+        finally:
+            elapsed = time.monotonic() - when_started
+            self.balancer.finished(url, elapsed)
+            self.instruments.observe(UPSTREAM_DURATION, elapsed, backend=url, status=label)
+        self.latencies.record(url, elapsed)
+        self.record_outcome(url, success=not is_node_failure(status, payload))
+        return status, payload
+
+    async def send(self, url, body):
+        ws_url = self.ws_urls.get(url)
+        if self.websockets is not None and ws_url:
+            response = await asyncio.wait_for(
+                self.websockets.call(ws_url, body), UPSTREAM_TIMEOUT)
+            if response is not None:
+                return 200, response
+        async with self.session.post(url, data=body, headers=JSON_HEADERS) as response:
+            return response.status, await response.read()
+
+    def sticky_order(self, payload, client_key):
+        upstreams = self.ring.walk(client_key or '')
+        if not upstreams:
+            raise NoUpstreamError()
+        pinned = self.filters.get(filter_id(payload))
+        if pinned in upstreams:
+            upstreams.remove(pinned)
+            upstreams.insert(0, pinned)
+        return [url for url in upstreams if self.breaker(url).allow()] or upstreams
+
+    async def sticky_forward(self, payload, body, client_key):
+        """
+        Sends state dependent methods to the node owning the filter or the client
+        """
+        error = None
+        for url in self.sticky_order(payload, client_key):
+            try:
+                status, response = await self.forward_to(url, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                continue
+            if status == 200:
+                self.pin_filter(payload, response, url)
+            return status, response
+        raise error
+
+    def pin_filter(self, payload, response, url):
+        method = payload.get('method')
+        if method == 'eth_uninstallFilter':
+            self.filters.pop(filter_id(payload), None)
+            return
+        if method not in FILTER_CREATING_METHODS:
+            return
+        try:
+            created = json.loads(response).get('result')
+        except (ValueError, AttributeError):
+            return
+        if isinstance(created, str):
+            self.filters[created] = url
+            while len(self.filters) > MAX_PINNED_FILTERS:
+                self.filters.popitem(last=False)
+
+    async def hedged_forward(self, body, pool=DEFAULT_POOL):
+        """
+        Sends a duplicate to the next node when the first one is slower than
+        usual, the first answer wins and the other request is cancelled
+        """
+        upstreams = self.upstream_order(pool)
+        self.hedge_budget.deposit()
+        delay = self.latencies.percentile(upstreams[0], HEDGE_PERCENTILE)
+        if len(upstreams) < 2 or delay is None:
+            return await self.forward(body, pool, upstreams)
+
+        primary = asyncio.ensure_future(self.forward_to(upstreams[0], body))
+        done, _ = await asyncio.wait([primary], timeout=max(delay, HEDGE_MIN_DELAY))
+        if done or not self.hedge_budget.withdraw():
+            try:
+                return await primary
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return await self.forward(body, pool, upstreams[1:])
+
+        self.hedged += 1
+        hedge = asyncio.ensure_future(self.forward_to(upstreams[1], body))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is hedge:
+                            self.hedges_won += 1
+                        return future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+        if len(upstreams) > 2:
+            return await self.forward(body, pool, upstreams[2:])
+        raise primary.exception()
+
+    def record_outcome(self, url, success):
+        if self.breaker(url).record(success):
+            logger.warning(f'Circuit to {url} opened')
+            self.circuit_changed(url, is_open=True)
+
+    def circuit_changed(self, url, is_open):
+        if is_open:
+            self.saved_circuits[url] = time.monotonic()
+        else:
+            self.saved_circuits.pop(url, None)
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(None, self.save_circuit_state, url, is_open)
+        future.add_done_callback(log_failure)
+
+    async def probe(self, url):
+        breaker = self.breaker(url)
+        if not breaker.should_probe():
+            return
+        while breaker.state == HALF_OPEN:
+            try:
+                async with self.session.post(
+                        url, data=PROBE_BODY, headers=JSON_HEADERS, timeout=PROBE_TIMEOUT) as response:
+                    success = not is_node_failure(response.status, await response.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                success = False
+            if breaker.record_probe(success):
+                logger.info(f'Circuit to {url} closed')
+                self.circuit_changed(url, is_open=False)
+
+    def refresh_circuits(self):
+        now = time.monotonic()
+        for url, saved_at in list(self.saved_circuits.items()):
+            if now - saved_at >= STATE_TTL / 2:
+                self.circuit_changed(url, is_open=True)
+
+    async def watch_breakers(self):
+        while True:
+            await asyncio.sleep(PROBE_INTERVAL)
+            self.refresh_circuits()
+            await asyncio.gather(*[
+                self.probe(url) for url, breaker in list(self.breakers.items())
+                if breaker.state == OPEN
+            ])
+
+    def cache_for(self, payload):
+        key = immutable_cache_key(payload)
+        if key:
+            return self.cache, key
+        key = head_cache_key(payload)
+        if key:
+            return self.head_cache, key
+        return None, None
+
+    async def call(self, payload, body, client_key=None):
+        if is_sticky(payload):
+            return await self.sticky_forward(payload, body, client_key)
+        # notifications get no response, they go to the node like any other call
+        cache, key = self.cache_for(payload) if 'id' in payload else (None, None)
+        if cache is not None:
+            result = cache.get(key)
+            if result is not None:
+                return 200, rpc_result(payload['id'], result)
+
+        pool = request_pool(payload)
+        forward = self.hedged_forward if is_hedged(payload) else self.forward
+        flight_key = coalesce_key(payload)
+        if flight_key is None:
+            status, response = await forward(body, pool)
+        else:
+            (status, response), shared = await self.single_flight.do(
+                flight_key, lambda: forward(body, pool))
+            if shared:
+                response = with_id(response, payload.get('id'))
+
+        if cache is not None and status == 200:
+            try:
+                self.store_result(cache, key, json.loads(response))
+            except ValueError:
+                pass
+        return status, response
+
+    def store_result(self, cache, key, response):
+        if not isinstance(response, dict) or 'result' not in response:
+            # errors are not cached
+            return
+        result = response['result']
+        if cache is self.head_cache or is_finalized(result, self.finalized_block_number):
+            cache.set(key, json.dumps_bytes(result))
+
+    async def call_batch(self, payloads, client_key=None):
+        responses = [None] * len(payloads)
+        pending = {}
+        sticky = []
+        for index, payload in enumerate(payloads):
+            if not isinstance(payload, dict):
+                responses[index] = rpc_error(None, INVALID_REQUEST, 'Invalid Request')
+                continue
+            if is_sticky(payload):
+                sticky.append(index)
+                continue
+            cache, key = self.cache_for(payload)
+            result = cache.get(key) if cache is not None else None
+            if result is not None:
+                # notifications get no response, even when answered from the cache
+                if 'id' in payload:
+                    responses[index] = rpc_result(payload['id'], result)
+            else:
+                pending.setdefault(request_pool(payload), []).append(index)
+
+        # forward() rotates over the pool, so the sub-batches land on different nodes
+        await asyncio.gather(*[
+            self.call_sub_batch(payloads, responses, pool, indexes[start:start + BATCH_MAX_SIZE])
+            for pool, indexes in pending.items()
+            for start in range(0, len(indexes), BATCH_MAX_SIZE)
+        ] + [
+            self.call_sticky_in_batch(payloads, responses, index, client_key)
+            for index in sticky
+        ])
+        responses = [response for response in responses if response is not None]
+        if not responses:
+            # a batch of notifications gets no response at all
+            return 204, b''
+        return 200, b'[' + b', '.join(responses) + b']'
+
+    async def call_sticky_in_batch(self, payloads, responses, index, client_key):
+        payload = payloads[index]
+        try:
+            status, response = await self.sticky_forward(
+                payload, json.dumps_bytes(payload), client_key)
+        except (aiohttp.ClientError, asyncio.TimeoutError, NoUpstreamError) as e:
+            logger.warning(f'Batched {payload.get("method")} failed: {e!r}')
+            status = None
+        if 'id' not in payload:
+            return
+        if status != 200:
+            response = rpc_error(payload['id'], INTERNAL_ERROR, 'Upstream error')
+        responses[index] = response
+
+    async def call_sub_batch(self, payloads, responses, pool, indexes):
+        # ids are replaced with positions in the batch, clients can reuse ids
+        body = json.dumps_bytes([
+            dict(payloads[index], id=index) if 'id' in payloads[index] else payloads[index]
+            for index in indexes
+        ])
+        try:
+            status, response = await self.forward(body, pool)
+            decoded = json.loads(response) if status == 200 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f'Sub-batch failed: {e!r}')
+            decoded = None
+        if not isinstance(decoded, list):
+            decoded = []
+        by_index = {
+            response['id']: response
+            for response in decoded
+            if isinstance(response, dict) and isinstance(response.get('id'), int)
+        }
+
+        for index in indexes:
+            payload = payloads[index]
+            if 'id' not in payload:
+                # notifications get no response
+                continue
+            response = by_index.get(index)
+            if response is None:
+                responses[index] = rpc_error(payload['id'], INTERNAL_ERROR, 'Upstream error')
+                continue
+            response['id'] = payload['id']
+            responses[index] = json.dumps_bytes(response)
+            cache, key = self.cache_for(payload)
+            if cache is not None:
+                self.store_result(cache, key, response)
+
+    def limit(self, request, counts):
+        if self.limiter is None:
+            return None
+        api_key = request.headers.get(API_KEY_HEADER) or request.query.get('api_key')
+        result = self.limiter.check(api_key, counts)
+        if result == ALLOWED:
+            return None
+        if result == UNKNOWN_KEY:
+            return web.Response(status=401, body=rpc_error(
+                None, INVALID_REQUEST, 'Missing or unknown API key'), headers=JSON_HEADERS)
+        if result == BATCH_TOO_LARGE:
+            return web.Response(status=413, body=rpc_error(
+                None, INVALID_REQUEST, 'Batch exceeds the burst of the API key'), headers=JSON_HEADERS)
+        message = 'Daily quota exceeded' if result == OVER_QUOTA else 'Rate limit exceeded'
+        return web.Response(
+            status=429, body=rpc_error(None, LIMIT_EXCEEDED, message), headers=JSON_HEADERS)
+
+    async def handle(self, request):
+        if request.content_length is None or request.content_length > STREAM_REQUEST_SIZE:
+            return await self.handle_stream(request)
+        body = await request.read()
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            # let the node answer with a proper JSON-RPC parse error
+            payload = None
+        if isinstance(payload, dict):
+            request['rpc_method'] = self.instruments.method_label(payload.get('method'))
+        elif isinstance(payload, list):
+            request['rpc_method'] = BATCH
+        rejected = self.limit(request, request_counts(payload))
+        if rejected is not None:
+            return rejected
+        if isinstance(payload, dict) and is_streamed(payload):
+            return await self.stream(request, body, request_pool(payload))
+        try:
+            if isinstance(payload, dict):
+                status, payload = await self.call(payload, body, client_key(request))
+            elif isinstance(payload, list) and payload:
+                status, payload = await self.call_batch(payload, client_key(request))
+            else:
+                status, payload = await self.forward(body, request_pool(payload or []))
+        except NoUpstreamError:
+            return web.Response(status=404)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return web.Response(status=502)
+        return web.Response(status=status, body=payload, headers=JSON_HEADERS)
+
+    async def handle_stream(self, request):
+        prefix = b''
+        while len(prefix) < STREAM_CHUNK_SIZE and not request.content.at_eof():
+            chunk = await request.content.read(STREAM_CHUNK_SIZE - len(prefix))
+            if not chunk:
+                break
+            prefix += chunk
+        rejected = self.limit(request, {prefix_pool(prefix): 1})
+        if rejected is not None:
+            return rejected
+
+        async def body():
+            yield prefix
+            async for chunk in request.content.iter_chunked(STREAM_CHUNK_SIZE):
+                yield chunk
+
+        return await self.stream(request, body(), prefix_pool(prefix))
+
+    async def stream(self, request, body, pool):
+        """
+        Passes the response to the client as it arrives. A request body given
+        as bytes can be retried on another node until the response starts,
+        a streamed one is sent to a single node.
+        """
+        try:
+            upstreams = self.upstream_order(pool)
+        except NoUpstreamError:
+            return web.Response(status=404)
+        for url in upstreams:
+            self.balancer.started(url)
+            when_started = time.monotonic()
+            try:
+                upstream = await self.session.post(url, data=body, headers=JSON_HEADERS)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f'Upstream {url} failed: {e!r}')
+                elapsed = time.monotonic() - when_started
+                self.balancer.finished(url, elapsed)
+                self.instruments.observe(
+                    UPSTREAM_DURATION, elapsed, backend=url, status=upstream_error(e))
+                self.record_outcome(url, success=False)
+                if not isinstance(body, bytes):
+                    break
+                continue
+            try:
+                return await self.stream_response(request, url, upstream)
+            finally:
+                upstream.release()
+                elapsed = time.monotonic() - when_started
+                self.balancer.finished(url, elapsed)
+                self.instruments.observe(
+                    UPSTREAM_DURATION, elapsed, backend=url, status=upstream.status)
+        return web.Response(status=502)
+
+    async def stream_response(self, request, url, upstream):
+        response = web.StreamResponse(status=upstream.status, headers=JSON_HEADERS)
+        await response.prepare(request)
+        scanner = ResponseScanner()
+        try:
+            async for chunk in upstream.content.iter_chunked(STREAM_CHUNK_SIZE):
+                scanner.feed(chunk)
+                await response.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # the response has started, all we can do is to drop the connection
+            logger.warning(f'Upstream {url} failed while streaming: {e!r}')
+            self.record_outcome(url, success=False)
+            raise
+        failed = scanner.is_node_failure(upstream.status)
+        if failed:
+            logger.warning(f'Upstream {url} failed request {scanner.response_id()!r}')
+        self.record_outcome(url, success=not failed)
+        await response.write_eof()
+        return response
+
+    async def handle_get(self, request):
+        if request.headers.get('Upgrade', '').lower() == 'websocket':
+            return await self.handle_websocket(request)
+        # target group health check expects 404, same as nginx
+        return web.Response(status=404)
+
+    async def handle_websocket(self, request):
+        rejected = self.limit(request, {DEFAULT_POOL: 1})
+        if rejected is not None:
+            return rejected
+        ws = web.WebSocketResponse(heartbeat=WS_HEARTBEAT)
+        await ws.prepare(request)
+
+        def too_slow():
+            logger.warning('Disconnecting a client not keeping up with notifications')
+            asyncio.ensure_future(ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b'Too slow'))
+
+        subscriber = Subscriber(on_overflow=too_slow)
+        writer = asyncio.ensure_future(self.write_messages(ws, subscriber))
+        try:
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+                response = await self.ws_call(request, subscriber, message.data.encode('utf8'))
+                if response:
+                    subscriber.send(response)
+        finally:
+            writer.cancel()
+            self.subscriptions.drop(subscriber)
+        return ws
+
+    async def write_messages(self, ws, subscriber):
+        # responses and notifications share the queue, so they keep their order
+        while True:
+            message = await subscriber.queue.get()
+            try:
+                await ws.send_str(message.decode('utf8'))
+            except (aiohttp.ClientError, ConnectionError, RuntimeError):
+                return
+
+    async def ws_call(self, request, subscriber, body):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return rpc_error(None, PARSE_ERROR, 'Parse error')
+        rejected = self.limit(request, request_counts(payload))
+        if rejected is not None:
+            return rejected.body
+        if isinstance(payload, dict) and payload.get('method') in SUBSCRIPTION_METHODS:
+            return await self.subscription_call(subscriber, payload)
+        try:
+            if isinstance(payload, dict):
+                _, response = await self.call(payload, body, client_key(request))
+            elif isinstance(payload, list) and payload:
+                _, response = await self.call_batch(payload, client_key(request))
+            else:
+                return rpc_error(None, INVALID_REQUEST, 'Invalid Request')
+        except (NoUpstreamError, aiohttp.ClientError, asyncio.TimeoutError):
+            if isinstance(payload, dict):
+                return rpc_error(payload.get('id'), INTERNAL_ERROR, 'Upstream error')
+            # every call of the batch failed, notifications get no response
+            errors = [
+                rpc_error(item['id'], INTERNAL_ERROR, 'Upstream error') if isinstance(item, dict)
+                else rpc_error(None, INVALID_REQUEST, 'Invalid Request')
+                for item in payload if not isinstance(item, dict) or 'id' in item
+            ]
+            return b'[' + b', '.join(errors) + b']' if errors else None
+        return response
+
+    async def subscription_call(self, subscriber, payload):
+        request_id = payload.get('id')
+        params = payload.get('params')
+        if not isinstance(params, list) or not params:
+            return rpc_error(request_id, INVALID_PARAMS, 'Invalid params')
+        if payload['method'] == 'eth_unsubscribe':
+            found = isinstance(params[0], str) and self.subscriptions.unsubscribe(
+                subscriber, params[0])
+            return rpc_result(request_id, b'true' if found else b'false')
+        try:
+            subscription_id = await self.subscriptions.subscribe(subscriber, params)
+        except SubscriptionError as e:
+            return json.dumps_bytes({'jsonrpc': '2.0', 'id': request_id, 'error': e.error})
+        except (NoNodeError, aiohttp.ClientError, asyncio.TimeoutError):
+            return rpc_error(request_id, INTERNAL_ERROR, 'No node available for subscriptions')
+        return rpc_result(request_id, json.dumps_bytes(subscription_id))
+
+    @web.middleware
+    async def instrument(self, request, handler):
+        if request.method != 'POST':
+            return await handler(request)
+        when_started = time.monotonic()
+        # client went away or the handler failed
+        status = 'error'
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        finally:
+            self.instruments.observe(
+                REQUEST_DURATION, time.monotonic() - when_started,
+                method=request.get('rpc_method', OTHER), status=status)
+
+    async def handle_metrics(self, request):
+        return web.Response(
+            body=self.instruments.render().encode('utf8'), headers=OPENMETRICS_HEADERS)
+
+    def collect_metrics(self):
+        caches = {'Response cache': self.cache, 'Head cache': self.head_cache}
+        counters = {}
+        for name, cache in caches.items():
+            counters[f'{name} hits'] = cache.hits
+            counters[f'{name} misses'] = cache.misses
+            counters[f'{name} evictions'] = cache.evictions
+        counters['Coalesced requests'] = self.single_flight.coalesced
+        if HEDGED_METHODS:
+            counters['Hedged requests'] = self.hedged
+            counters['Hedges won'] = self.hedges_won
+        if self.limiter is not None:
+            counters['Rate limited requests'] = self.limiter.rejected[RATE_LIMITED]
+            counters['Requests over quota'] = self.limiter.rejected[OVER_QUOTA]
+            counters['Requests with unknown API key'] = self.limiter.rejected[UNKNOWN_KEY]
+            counters['Batches over burst'] = self.limiter.rejected[BATCH_TOO_LARGE]
+        metrics = [
+            stack_metric(name, value - self._reported.get(name, 0), unit='Count')
+            for name, value in counters.items()
+        ]
+        metrics.extend(
+            stack_metric(f'{name} size', cache.size, unit='Bytes')
+            for name, cache in caches.items()
+        )
+        self._reported = counters
+        metrics.extend(self.roll_up_metrics())
+        return metrics
+
+    def roll_up_metrics(self):
+        # one set of metrics per method and node, statuses are folded into errors
+        window = self.instruments.roll_up()
+        metrics = []
+        for name, label, dimension, title in ROLL_UPS:
+            histograms = window.get(name, {})
+            failed = aggregate(histograms, label, where=is_failed)
+            for value, histogram in sorted(aggregate(histograms, label).items()):
+                dimensions = {dimension: value}
+                metrics.append(stack_metric(
+                    title, histogram.count, unit='Count', dimensions=dimensions))
+                errors = failed[value].count if value in failed else 0
+                metrics.append(stack_metric(
+                    f'{title} errors', errors, unit='Count', dimensions=dimensions))
+                # average, minimum and maximum come from the statistic set
+                metrics.append(statistic_set(
+                    stack_metric(f'{title} latency', None, unit='Milliseconds',
+                                 dimensions=dimensions),
+                    histogram.count, histogram.sum * 1000,
+                    histogram.min * 1000, histogram.max * 1000))
+                metrics.extend(
+                    stack_metric(
+                        f'{title} p{percentile} latency',
+                        histogram.quantile(percentile / 100) * 1000,
+                        unit='Milliseconds', dimensions=dimensions)
+                    for percentile in ROLL_UP_PERCENTILES
+                )
+        return metrics
+
+    async def report_metrics(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            try:
+                await loop.run_in_executor(None, put_metrics, self.collect_metrics())
+            except Exception:
+                logger.exception('Failed to push metrics')
+
+    async def on_startup(self, app):
+        await self.start()
+        app['backends_watcher'] = asyncio.ensure_future(self.watch_backends())
+        app['breakers_watcher'] = asyncio.ensure_future(self.watch_breakers())
+        if 'CLOUDWATCH_NAMESPACE' in os.environ:
+            app['metrics_reporter'] = asyncio.ensure_future(self.report_metrics())
+        if self.limiter is not None:
+            app['usage_watcher'] = asyncio.ensure_future(self.watch_usage())
+
+    async def on_cleanup(self, app):
+        app['backends_watcher'].cancel()
+        app['breakers_watcher'].cancel()
+        if 'metrics_reporter' in app:
+            app['metrics_reporter'].cancel()
+        if 'usage_watcher' in app:
+            app['usage_watcher'].cancel()
+            await self.flush_usage()
+        await self.close()
+
+    async def start_metrics_site(self, app):
+        runner = web.AppRunner(make_metrics_app(self))
+        await runner.setup()
+        await web.TCPSite(runner, port=app['metrics_port']).start()
+        app['metrics_runner'] = runner
+
+    async def stop_metrics_site(self, app):
+        await app['metrics_runner'].cleanup()
+
+
+def log_failure(future):
+    if future.exception():
+        logger.error(f'Background call failed: {future.exception()!r}')
+
+
+def make_app(proxy, metrics_port=None):
+    app = web.Application(middlewares=[proxy.instrument])
+    app.router.add_post('/', proxy.handle)
+    app.router.add_get('/', proxy.handle_get)
+    app.on_startup.append(proxy.on_startup)
+    app.on_cleanup.append(proxy.on_cleanup)
+    if metrics_port:
+        # kept off the public port, the load balancer forwards every path
+        app['metrics_port'] = metrics_port
+        app.on_startup.append(proxy.start_metrics_site)
+        app.on_cleanup.append(proxy.stop_metrics_site)
+    return app
+
+
+def make_metrics_app(proxy):
+    app = web.Application()
+    app.router.add_get('/metrics', proxy.handle_metrics)
+    return app
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    proxy = Proxy(load_api_keys=scan_api_keys if API_KEYS_ENABLED else None)
+    web.run_app(make_app(proxy, metrics_port=METRICS_PORT), port=PROXY_PORT)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,29 @@
+import hashlib
 import logging
 import os
 import textwrap
 from os import path, sys
 from urllib.parse import urlparse
 
-import boto3
+from botocore.exceptions import ClientError
 
 if True:
     sys.path.append(path.dirname(path.abspath(__file__)))
-    from lib.db import get_table
+    from lib.aws import get_client
+    from lib.db import get_table, scan_items
+    from lib.routing import (BALANCING_MODE, DEFAULT_POOL, HEAVY_POOL,
+                             LEAST_CONN, ROUND_ROBIN, heavy_methods_regex,
+                             select_pools, select_weights)
+    from lib.sticky import STICKY_METHODS, sticky_methods_regex
 
 logger = logging.getLogger(__name__)
+# containers follow the pointer and reload nginx in place instead of being redeployed
+NGINX_HOT_RELOAD = os.environ.get('NGINX_HOT_RELOAD', 'false') == 'true'
+CONFIG_POINTER_KEY = 'current_config'
+# the native proxy reads the backend table itself, its task is never redeployed for a config
+NATIVE_PROXY = os.environ.get('PROXY_MODE', 'nginx') == 'native'
+# idle connections to the nodes each nginx worker keeps open, 0 disables reuse
+UPSTREAM_KEEPALIVE = int(os.environ.get('NGINX_UPSTREAM_KEEPALIVE', 32))
 PASSTHROUGH_ATTRIBUTES = [
     'family',
     'taskRoleArn',
@@ -31,23 +44,38 @@ def update_service(event, context):
     bucket_name = s3_event['bucket']['name']
     key = s3_event['object']['key']
     full_path = f's3://{bucket_name}/{key}'
+
+    logger.info(f'Handling event of upload of config {full_path}')
+    if NGINX_HOT_RELOAD:
+        logger.info('Hot reload is enabled, containers pick up the config themselves')
+        return
+    if NATIVE_PROXY:
+        logger.info('Native proxy is deployed, skipping update')
+        return
+
     task_definition_family = os.environ['TASK_DEFINITION_FAMILY']
     cluster_arn = os.environ['CLUSTER_ARN']
     service_arn = os.environ['CF_Service']
 
-    logger.info(f'Handling event of upload of config {full_path}')
-
-    ecs = boto3.client('ecs')
+    ecs = get_client('ecs')
     logger.info('Getting old task definition')
     task_definition = ecs.describe_task_definition(
         taskDefinition=task_definition_family,
     )['taskDefinition']
+    if deployed_config_path(task_definition) == full_path:
+        logger.info('Config is already deployed, skipping update')
+        return
     old_arn = task_definition.pop('taskDefinitionArn')
 
     logger.info('Last ARN is {old_task_definition_arn}')
 
-    new_env = [{'name': 'S3_CONFIG_PATH', 'value': full_path}]
-    task_definition['containerDefinitions'][0]['environment'] = new_env
+    container = task_definition['containerDefinitions'][0]
+    new_env = [
+        variable for variable in container.get('environment', [])
+        if variable['name'] != 'S3_CONFIG_PATH'
+    ]
+    new_env.append({'name': 'S3_CONFIG_PATH', 'value': full_path})
+    container['environment'] = new_env
     new_task_definition = {
         key: task_definition[key]
         for key in PASSTHROUGH_ATTRIBUTES
@@ -77,39 +105,81 @@ def update_service(event, context):
         )
 
 
+def deployed_config_path(task_definition):
+    for container in task_definition['containerDefinitions']:
+        for variable in container.get('environment', []):
+            if variable['name'] == 'S3_CONFIG_PATH':
+                return variable['value']
+    return None
+
+
+def config_file_name(body):
+    # identical configs end up under the same key
+    return hashlib.sha256(body).hexdigest() + '_nginx.conf'
+
+
 def upload_service_config(event, context):
-    backends = get_table().scan()['Items']
-    file_name = f'{context.aws_request_id}_nginx.conf'
-    body = generate_nginx_config(backends)
+    logging.basicConfig(level=logging.INFO)
+    backends = scan_items(get_table())
+    body = bytes(generate_nginx_config(backends), 'utf8')
+    bucket_name = os.environ['NGINX_CONFIG_BUCKET_NAME']
+    file_name = config_file_name(body)
+
+    if current_config_path(bucket_name) == f's3://{bucket_name}/{file_name}':
+        logger.info(f'Config {file_name} is already deployed, skipping upload')
+        return
 
-    response = boto3.client('s3').put_object(
-        Bucket=os.environ['NGINX_CONFIG_BUCKET_NAME'],
-        Body=bytes(body, 'utf8'),
+    logger.info(f'Uploading config {file_name}')
+    s3 = get_client('s3')
+    s3.put_object(
+        Bucket=bucket_name,
+        Body=body,
         Key=file_name,
     )
+    # written after the config, so that containers never follow it to a missing file
+    s3.put_object(
+        Bucket=bucket_name,
+        Body=bytes(file_name, 'utf8'),
+        Key=CONFIG_POINTER_KEY,
+    )
+
+
+def current_config_path(bucket_name):
+    if NGINX_HOT_RELOAD:
+        try:
+            response = get_client('s3').get_object(Bucket=bucket_name, Key=CONFIG_POINTER_KEY)
+        except ClientError as e:
+            # without s3:ListBucket S3 answers AccessDenied for a missing key
+            if e.response['Error']['Code'] not in ('NoSuchKey', 'AccessDenied'):
+                raise
+            return None
+        file_name = response['Body'].read().decode('utf8')
+        return f's3://{bucket_name}/{file_name}'
+    task_definition = get_client('ecs').describe_task_definition(
+        taskDefinition=os.environ['TASK_DEFINITION_FAMILY'],
+    )['taskDefinition']
+    return deployed_config_path(task_definition)
 
 
 def generate_nginx_config(backends):
-    leaders = []
-    nodes = []
-    for backend in backends:
-        if not backend['is_healthy']:
-            continue
-        if backend['is_leader']:
-            leaders.append(backend)
-        else:
-            nodes.append(backend)
-
-    if not nodes:
-        if not leaders:
-            # nothing is up, just return something which will not fail
-            return empty_config()
-        else:
-            return single_host_config(leaders[0]['url'])
-    if len(nodes) == 1:
-        return single_host_config(nodes[0]['url'])
+    pools = select_pools(backends)
+    urls = pools[DEFAULT_POOL]
+    if not urls:
+        # nothing is up, just return something which will not fail
+        return empty_config()
+    weights = None
+    if BALANCING_MODE != ROUND_ROBIN:
+        selected = set(urls) | set(pools[HEAVY_POOL])
+        weights = select_weights([
+            backend for backend in backends if backend['url'] in selected
+        ])
+    least_conn = BALANCING_MODE == LEAST_CONN
+    if pools[HEAVY_POOL] != urls:
+        return method_routing_config(urls, pools[HEAVY_POOL], weights, least_conn)
+    if len(urls) == 1:
+        return single_host_config(urls[0])
     else:
-        return load_balancing_config([node['url'] for node in nodes])
+        return load_balancing_config(urls, weights, least_conn)
 
 
 def empty_config():
@@ -126,20 +196,69 @@ def empty_config():
 
 
 def single_host_config(url):
+    # an upstream block is needed for keepalive, so the host is given explicitly
+    parsed = urlparse(url)
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    servers = upstream_servers([f'{parsed.scheme}://{parsed.hostname}:{port}'])
+    tls = ''
+    if parsed.scheme == 'https':
+        tls = f'''
+            proxy_ssl_server_name on;
+            proxy_ssl_name {parsed.hostname};'''
     return textwrap.dedent(
         f'''
+        upstream single {{
+          {servers}
+        }}
+
         server {{
           listen 80;
           location / {{
-            proxy_pass {url};
+            proxy_pass {parsed.scheme}://single{parsed.path};
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+            proxy_set_header Host {parsed.netloc};{tls}
           }}
         }}
         '''
     )
 
 
-def load_balancing_config(urls):
-    servers = '\n          '.join(f'server {urlparse(url).netloc};' for url in urls)
+def upstream_servers(urls, weights=None, least_conn=False, hash_key=None):
+    weights = weights or {}
+    servers = [
+        f'server {urlparse(url).netloc} weight={weights[url]};'
+        if url in weights else f'server {urlparse(url).netloc};'
+        for url in urls
+    ]
+    if least_conn:
+        servers.insert(0, 'least_conn;')
+    if hash_key:
+        servers.insert(0, f'hash {hash_key} consistent;')
+    if UPSTREAM_KEEPALIVE:
+        # has to follow the balancing method
+        servers.append(f'keepalive {UPSTREAM_KEEPALIVE};')
+    return '\n          '.join(servers)
+
+
+def sticky_servers(urls):
+    # without weights, they follow latency and would move clients between nodes
+    return upstream_servers(urls, hash_key='$sticky_key')
+
+
+# stateful methods are pinned by API key, or by the client address added by the load balancer
+STICKY_KEY_MAP = '''
+        map "$http_x_api_key$arg_api_key" $sticky_key {
+          default "$http_x_api_key$arg_api_key";
+          '' $http_x_forwarded_for;
+        }
+'''
+
+
+def load_balancing_config(urls, weights=None, least_conn=False):
+    servers = upstream_servers(urls, weights, least_conn)
+    if STICKY_METHODS:
+        return sticky_routing_config(servers, sticky_servers(urls))
     return textwrap.dedent(
         f'''
         upstream service {{
@@ -151,9 +270,107 @@ def load_balancing_config(urls):
 
           location / {{
             proxy_pass http://service;
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+            proxy_redirect off;
+            proxy_next_upstream error timeout;
+          }}
+        }}
+        '''
+    )
+
+
+def sticky_routing_config(servers, sticky_servers):
+    sticky_methods = sticky_methods_regex()
+    return textwrap.dedent(
+        f'''
+        map $request_body $rpc_pool {{
+          default service;
+          '~{sticky_methods}' sticky;
+        }}
+        {STICKY_KEY_MAP}
+        upstream service {{
+          {servers}
+        }}
+
+        upstream sticky {{
+          {sticky_servers}
+        }}
+
+        server {{
+          listen 80;
+          client_body_buffer_size 1m;
+          client_body_in_single_buffer on;
+
+          location / {{
+            mirror /_read_body;
+            mirror_request_body on;
+            proxy_pass http://$rpc_pool;
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+            proxy_redirect off;
+            proxy_next_upstream error timeout;
+          }}
+
+          location = /_read_body {{
+            internal;
+            return 204;
+          }}
+        }}
+        '''
+    )
+
+
+def method_routing_config(urls, heavy_urls, weights=None, least_conn=False):
+    servers = upstream_servers(urls, weights, least_conn)
+    heavy_servers = upstream_servers(heavy_urls, weights, least_conn)
+    heavy_methods = heavy_methods_regex()
+    sticky_routes = sticky_upstream = ''
+    if STICKY_METHODS:
+        # regexes are tried in order, state dependent methods come first
+        sticky_routes = f'''
+          '~{sticky_methods_regex()}' sticky;'''
+        sticky_upstream = STICKY_KEY_MAP + f'''
+        upstream sticky {{
+          {sticky_servers(urls)}
+        }}
+'''
+    # mirror_request_body makes nginx read the body before proxy_pass
+    # is evaluated, so that $request_body can be used to pick the pool
+    return textwrap.dedent(
+        f'''
+        map $request_body $rpc_pool {{
+          default service;{sticky_routes}
+          '~{heavy_methods}' heavy;
+        }}
+        {sticky_upstream}
+        upstream service {{
+          {servers}
+        }}
+
+        upstream heavy {{
+          {heavy_servers}
+        }}
+
+        server {{
+          listen 80;
+          client_body_buffer_size 1m;
+          client_body_in_single_buffer on;
+
+          location / {{
+            mirror /_read_body;
+            mirror_request_body on;
+            proxy_pass http://$rpc_pool;
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
             proxy_redirect off;
             proxy_next_upstream error timeout;
           }}
+
+          location = /_read_body {{
+            internal;
+            return 204;
+          }}
         }}
         '''
     )
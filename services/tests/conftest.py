@@ -1,8 +1,45 @@
+import asyncio
+from os import path, sys
+
 import pytest
 
 
+class Clock:
+    now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
 @pytest.fixture(autouse=True)
 def environ(monkeypatch):
     monkeypatch.setenv('DYNAMODB_TABLE', 'jsonrpc-proxy-dev')
+    monkeypatch.setenv('API_KEYS_TABLE', 'jsonrpc-proxy-dev-api-keys')
     monkeypatch.setenv('CLOUDWATCH_NAMESPACE',  'test')
     monkeypatch.setenv('STACK_NAME',  'jsonrpc-proxy-dev')
+
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    # handlers import lib both as a package and from their own directory
+    sys.path.append(path.join(path.dirname(path.dirname(path.abspath(__file__))), 'handlers'))
+    from handlers.lib import aws, db
+    from lib import aws as lib_aws, db as lib_db
+    for module in (aws, lib_aws):
+        module.reset_clients()
+    for module in (db, lib_db):
+        module.reset_tables()
+    yield
+    for module in (aws, lib_aws):
+        module.reset_clients()
+    for module in (db, lib_db):
+        module.reset_tables()
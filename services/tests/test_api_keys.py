@@ -0,0 +1,39 @@
+import json
+
+from handlers import api_keys
+
+
+def add(body):
+    return api_keys.add_api_key({'body': json.dumps(body)}, context={})
+
+
+def test_add_api_key():
+    response = add({'name': 'dapp', 'rate': 5.5, 'daily_quota': 1000})
+    assert response['statusCode'] == 201, response
+
+    params = json.loads(response['body'])
+    entry = api_keys.get_api_keys_table().get_item(Key={'api_key': params['api_key']})['Item']
+    assert entry['name'] == 'dapp'
+    assert float(entry['rate']) == 5.5
+    assert entry['daily_quota'] == 1000
+    assert entry['enabled'] is True
+
+
+def test_add_api_key_validates():
+    response = add({'name': 'dapp', 'rate': -1})
+    assert response['statusCode'] == 400
+    assert json.loads(response['body'])['type'] == 'validation_error'
+
+    response = api_keys.add_api_key({'body': '{'}, context={})
+    assert json.loads(response['body'])['type'] == 'parse_error'
+
+
+def test_list_and_remove_api_keys():
+    api_key = json.loads(add({'name': 'removed'})['body'])['api_key']
+    listed = json.loads(api_keys.list_api_keys({}, context={})['body'])
+    assert api_key in [item['api_key'] for item in listed]
+
+    response = api_keys.remove_api_key({'body': json.dumps({'api_key': api_key})}, context={})
+    assert response['statusCode'] == 200
+    listed = json.loads(api_keys.list_api_keys({}, context={})['body'])
+    assert api_key not in [item['api_key'] for item in listed]
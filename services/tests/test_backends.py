@@ -30,4 +30,5 @@ def test_add_backend(event, body):
     db = backends.get_table()
     entry = db.get_item(Key={'url': body['url']})
     assert entry['Item']['is_leader'] is False
+    assert entry['Item']['pool'] == 'default'
     assert type(from_iso(entry['Item']['when_added'])) is datetime
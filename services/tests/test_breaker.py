@@ -0,0 +1,83 @@
+import pytest
+from handlers.lib import breaker as breaker_module
+from handlers.lib.breaker import (CLOSED, HALF_OPEN, OPEN, CircuitBreaker,
+                                  is_circuit_open, is_node_failure)
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker(clock=clock)
+
+
+def test_opens_after_consecutive_failures(breaker):
+    for _ in range(breaker_module.CONSECUTIVE_FAILURES - 1):
+        assert breaker.record(False) is False
+    assert breaker.record(True) is False
+    for _ in range(breaker_module.CONSECUTIVE_FAILURES - 1):
+        breaker.record(False)
+    assert breaker.record(False) is True
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+
+def test_opens_on_error_rate(breaker, monkeypatch):
+    monkeypatch.setattr(breaker_module, 'MIN_REQUESTS', 4)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.record(False) is True
+
+
+def test_error_rate_counts_only_recent_requests(breaker, clock, monkeypatch):
+    monkeypatch.setattr(breaker_module, 'MIN_REQUESTS', 4)
+    breaker.record(False)
+    breaker.record(False)
+    clock.now = breaker_module.WINDOW + 1
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.record(True) is False
+    assert len(breaker.outcomes) == 3
+
+
+def test_half_open_probing(breaker, clock, monkeypatch):
+    monkeypatch.setattr(breaker_module, 'PROBES', 2)
+    breaker.open()
+    assert breaker.should_probe() is False
+
+    clock.now = breaker_module.OPEN_DURATION
+    assert breaker.should_probe() is True
+    assert breaker.state == HALF_OPEN
+    assert breaker.record_probe(True) is False
+    assert breaker.record_probe(False) is False
+    assert breaker.state == OPEN
+
+    clock.now = 2 * breaker_module.OPEN_DURATION
+    assert breaker.should_probe() is True
+    assert breaker.record_probe(True) is False
+    assert breaker.record_probe(True) is True
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+@pytest.mark.parametrize('status,response,failure', [
+    (200, b'{"result": "0x1"}', False),
+    (502, b'Bad gateway', True),
+    (200, b'{"error": {"code": -32603, "message": "Internal error"}}', True),
+    (200, b'{"error": {"code": -32000, "message": "execution reverted"}}', False),
+    (200, b'[{"result": "0x1"}, {"error": {"code": -32603}}]', True),
+    (200, b'{"error"', True),
+])
+def test_is_node_failure(status, response, failure):
+    assert is_node_failure(status, response) is failure
+
+
+@pytest.mark.parametrize('backend,expected', [
+    ({'circuit_open': True, 'circuit_opened_at': 1000}, True),
+    ({'circuit_open': True, 'circuit_opened_at': 1000 - breaker_module.STATE_TTL}, False),
+    ({'circuit_open': False, 'circuit_opened_at': 1000}, False),
+    # saved before states expired, nothing would ever close it
+    ({'circuit_open': True}, False),
+    ({}, False),
+])
+def test_is_circuit_open(backend, expected):
+    assert is_circuit_open(backend, now=1000) is expected
@@ -0,0 +1,108 @@
+import pytest
+from handlers.lib.cache import (ENTRY_OVERHEAD, HeadCache, LRUCache,
+                                cache_key, head_cache_key, immutable_cache_key,
+                                is_finalized)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=3 * (ENTRY_OVERHEAD + 2))
+    cache.set('a', b'1')
+    cache.set('b', b'2')
+    cache.set('c', b'3')
+    assert cache.get('a') == b'1'
+
+    cache.set('d', b'4')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1'
+    assert cache.get('d') == b'4'
+    assert cache.evictions == 1
+    assert cache.hits == 3
+    assert cache.misses == 1
+    assert cache.size == 3 * (ENTRY_OVERHEAD + 2)
+
+
+def test_lru_skips_entries_over_limit():
+    cache = LRUCache(max_bytes=ENTRY_OVERHEAD + 10)
+    cache.set('a', b'x' * 100)
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_lru_replaces_entry():
+    cache = LRUCache(max_bytes=1000)
+    cache.set('a', b'1')
+    cache.set('a', b'22')
+    assert cache.get('a') == b'22'
+    assert cache.size == ENTRY_OVERHEAD + 3
+
+
+def test_cache_key_is_canonical():
+    assert cache_key('eth_getBlockByNumber', ['0x1A', True]) == \
+        cache_key('eth_getBlockByNumber', ['0x1a', True])
+    assert cache_key('m', [{'b': 1, 'a': 2}]) == cache_key('m', [{'a': 2, 'b': 1}])
+    assert cache_key('m', ['0x1', True]) != cache_key('m', ['0x1', False])
+
+
+@pytest.mark.parametrize('payload,cacheable', [
+    ({'method': 'eth_getBlockByNumber', 'params': ['0x10', False]}, True),
+    ({'method': 'eth_getBlockByNumber', 'params': ['latest', False]}, False),
+    ({'method': 'eth_getBlockByNumber', 'params': []}, False),
+    ({'method': 'eth_getTransactionReceipt', 'params': ['0xabc']}, True),
+    ({'method': 'eth_getBlockByHash', 'params': ['0xabc', True]}, True),
+    ({'method': 'eth_getBlockByHash', 'params': {'hash': '0xabc'}}, False),
+    ({'method': 'eth_blockNumber', 'params': []}, False),
+])
+def test_immutable_cache_key(payload, cacheable):
+    assert (immutable_cache_key(payload) is not None) is cacheable
+
+
+@pytest.mark.parametrize('result,finalized', [
+    ({'number': '0x10'}, True),
+    ({'blockNumber': '0x10'}, True),
+    ({'blockNumber': '0x11'}, False),
+    ({'blockNumber': None}, False),
+    (None, False),
+])
+def test_is_finalized(result, finalized):
+    assert is_finalized(result, 16) is finalized
+
+
+@pytest.mark.parametrize('payload,cacheable', [
+    ({'method': 'eth_blockNumber', 'params': []}, True),
+    ({'method': 'eth_blockNumber'}, True),
+    ({'method': 'eth_call', 'params': [{'to': '0x1'}, 'latest']}, True),
+    ({'method': 'eth_call', 'params': [{'to': '0x1'}]}, True),
+    ({'method': 'eth_call', 'params': [{'to': '0x1'}, '0x10']}, False),
+    ({'method': 'eth_getTransactionCount', 'params': ['0x1', 'pending']}, False),
+    ({'method': 'eth_getStorageAt', 'params': ['0x1', '0x0', 'latest']}, True),
+    ({'method': 'eth_sendRawTransaction', 'params': ['0x1']}, False),
+    ({'method': ['eth_blockNumber']}, False),
+])
+def test_head_cache_key(payload, cacheable):
+    assert (head_cache_key(payload) is not None) is cacheable
+
+
+def test_head_cache_invalidated_by_new_head(clock):
+    cache = HeadCache(max_bytes=1000, ttl=10, clock=clock)
+    cache.set_head(10)
+    cache.set('a', b'1')
+
+    cache.set_head(10)
+    assert cache.get('a') == b'1'
+
+    cache.set_head(11)
+    assert cache.get('a') is None
+    assert cache.size == 0
+
+
+def test_head_cache_expires(clock):
+    cache = HeadCache(max_bytes=1000, ttl=10, clock=clock)
+    cache.set('a', b'1')
+
+    clock.now = 10
+    assert cache.get('a') == b'1'
+
+    clock.now = 11
+    assert cache.get('a') is None
+    assert cache.stored_at == {}
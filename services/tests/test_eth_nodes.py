@@ -1,10 +1,14 @@
 import asyncio
+import io
+import json
+import time
 from unittest import mock
 
 import pytest
 from aioresponses import aioresponses
-from handlers.eth_nodes import get_block_numbers
-from handlers.lib.db import get_table
+from botocore.exceptions import ClientError
+from handlers.eth_nodes import get_block_numbers, shard_of, write_updates
+from handlers.lib.db import get_table, scan_items
 
 url1 = 'http://url1'
 url2 = 'http://url2'
@@ -33,6 +37,18 @@ def set_state(url, block_number, leader=False, is_healthy=True):
     )
 
 
+def sent_metrics(mock_cloudwatch):
+    return [
+        metric
+        for call in mock_cloudwatch.return_value.put_metric_data.call_args_list
+        for metric in call[1]['MetricData']
+    ]
+
+
+def metric_key(metric):
+    return metric['MetricName'], metric['Dimensions'][0]['Value']
+
+
 def expect(url, healthy, block_number):
     item = get_table().get_item(Key={'url': url})
     assert item['Item']['is_healthy'] is healthy, item['Item']
@@ -69,6 +85,7 @@ def test_get_block_numbers_timeout(mock_trigger_service):
 
     expect(url1, healthy=True, block_number=15)
     expect(url2, healthy=False, block_number=5)
+    assert 'response_time' in get_table().get_item(Key={'url': url1})['Item']
 
     assert mock_trigger_service.called
 
@@ -156,9 +173,9 @@ def test_get_block_doesnt_update_when_no_need(mock_trigger_service, mock_cloudwa
 
     assert not mock_trigger_service.called
 
-    assert mock_cloudwatch.return_value.put_metric_data.called
-    assert mock_cloudwatch.return_value.put_metric_data.call_args == mock.call(
-        MetricData=[
+    calls = mock_cloudwatch.return_value.put_metric_data.call_args_list
+    assert {call[1]['Namespace'] for call in calls} == {'test'}
+    assert sorted(sent_metrics(mock_cloudwatch), key=metric_key) == sorted([
             {
                 'MetricName': 'ETH node block number',
                 'Timestamp': mock.ANY,
@@ -214,5 +231,226 @@ def test_get_block_doesnt_update_when_no_need(mock_trigger_service, mock_cloudwa
                 'Unit': 'None',
                 'StorageResolution': 60,
                 'Dimensions': [{'Name': 'Node URL', 'Value': 'http://url1'}]
+            },
+            {
+                'MetricName': 'Backend table write retries',
+                'Timestamp': mock.ANY,
+                'Value': 0,
+                'Unit': 'Count',
+                'StorageResolution': 60,
+                'Dimensions': [{'Name': 'Stack name', 'Value': 'jsonrpc-proxy-dev'}]
+            },
+            {
+                'MetricName': 'Backend table throttled writes',
+                'Timestamp': mock.ANY,
+                'Value': 0,
+                'Unit': 'Count',
+                'StorageResolution': 60,
+                'Dimensions': [{'Name': 'Stack name', 'Value': 'jsonrpc-proxy-dev'}]
+            },
+            {
+                'MetricName': 'Backend table skipped writes',
+                'Timestamp': mock.ANY,
+                'Value': 0,
+                'Unit': 'Count',
+                'StorageResolution': 60,
+                'Dimensions': [{'Name': 'Stack name', 'Value': 'jsonrpc-proxy-dev'}]
+            },
+            {
+                'MetricName': 'Lambda setup time',
+                'Timestamp': mock.ANY,
+                'Value': mock.ANY,
+                'Unit': 'Milliseconds',
+                'StorageResolution': 60,
+                'Dimensions': [
+                    {'Name': 'Stack name', 'Value': 'jsonrpc-proxy-dev'},
+                    {'Name': 'Start', 'Value': mock.ANY}
+                ]
             }
-        ], Namespace='test')
+        ], key=metric_key)
+
+
+def test_get_block_numbers_open_circuit_keeps_node_unhealthy(mock_trigger_service):
+    clear_all_items()
+    set_state(url1, block_number=25, leader=True)
+    set_state(url2, block_number=25, leader=False)
+    get_table().update_item(
+        Key={'url': url2},
+        UpdateExpression='SET circuit_open = :v, circuit_opened_at = :t',
+        ExpressionAttributeValues={':v': True, ':t': int(time.time())})
+    with aioresponses() as responses:
+        responses.post(url1, payload={'result': hex(25)})
+        responses.post(url2, payload={'result': hex(25)})
+
+        get_block_numbers(event={}, context={})
+
+    expect(url1, healthy=True, block_number=25)
+    expect(url2, healthy=False, block_number=25)
+
+    assert mock_trigger_service.called
+
+
+def test_get_block_numbers_ignores_expired_circuit(mock_trigger_service):
+    clear_all_items()
+    set_state(url1, block_number=25, leader=True)
+    set_state(url2, block_number=25, leader=False)
+    # the proxy which opened it went away without closing it
+    get_table().update_item(
+        Key={'url': url2},
+        UpdateExpression='SET circuit_open = :v, circuit_opened_at = :t',
+        ExpressionAttributeValues={':v': True, ':t': int(time.time()) - 3600})
+    with aioresponses() as responses:
+        responses.post(url1, payload={'result': hex(25)})
+        responses.post(url2, payload={'result': hex(25)})
+
+        get_block_numbers(event={}, context={})
+
+    expect(url2, healthy=True, block_number=25)
+
+
+def test_get_block_numbers_skips_unchanged_backends(mock_trigger_service, mock_cloudwatch):
+    clear_all_items()
+    set_state(url1, block_number=25, leader=True)
+    set_state(url2, block_number=20, leader=False)
+    table = get_table()
+    for url in (url1, url2):
+        table.update_item(
+            Key={'url': url},
+            UpdateExpression='SET response_time = :v',
+            ExpressionAttributeValues={':v': 5})
+    with aioresponses() as responses:
+        responses.post(url1, payload={'result': hex(25)})
+        responses.post(url2, payload={'result': hex(21)})
+
+        get_block_numbers(event={}, context={})
+
+    expect(url1, healthy=True, block_number=25)
+    expect(url2, healthy=True, block_number=21)
+    metrics = sent_metrics(mock_cloudwatch)
+    skipped = [m for m in metrics if m['MetricName'] == 'Backend table skipped writes']
+    assert skipped[0]['Value'] == 1
+
+
+def test_get_block_numbers_doesnt_resurrect_removed_backends(mock_trigger_service):
+    clear_all_items()
+    set_state(url1, block_number=25, leader=True)
+    set_state(url2, block_number=20, leader=False)
+
+    def remove_url2(backends):
+        get_table().delete_item(Key={'url': url2})
+        return backends
+
+    with aioresponses() as responses, \
+            mock.patch('handlers.eth_nodes.get_leader_block_number',
+                       side_effect=lambda backends: remove_url2(backends) and 25):
+        responses.post(url1, payload={'result': hex(26)})
+        responses.post(url2, payload={'result': hex(21)})
+
+        get_block_numbers(event={}, context={})
+
+    expect(url1, healthy=True, block_number=26)
+    assert 'Item' not in get_table().get_item(Key={'url': url2})
+
+
+def test_get_block_numbers_reuses_clients_when_warm(mock_trigger_service, mock_cloudwatch):
+    clear_all_items()
+    set_state(url1, block_number=25, leader=True)
+    with aioresponses() as responses:
+        responses.post(url1, payload={'result': hex(25)}, repeat=True)
+        get_block_numbers(None, None)
+        get_block_numbers(None, None)
+
+    assert mock_cloudwatch.call_count == 2  # cloudwatch and lambda, created once
+    metrics = sent_metrics(mock_cloudwatch)
+    setup = [m for m in metrics if m['MetricName'] == 'Lambda setup time']
+    assert setup[0]['Dimensions'][1] == {'Name': 'Start', 'Value': 'warm'}
+
+
+def test_get_block_numbers_ejects_after_consecutive_failures(monkeypatch, mock_trigger_service):
+    monkeypatch.setattr('lib.health.EJECT_AFTER', 2)
+    clear_all_items()
+    set_state(url1, block_number=25, leader=True)
+    set_state(url2, block_number=25, leader=False)
+    with aioresponses() as responses:
+        responses.post(url1, payload={'result': hex(40)}, repeat=True)
+        responses.post(url2, payload={'result': hex(25)}, repeat=True)
+
+        get_block_numbers(event={}, context={})
+        expect(url2, healthy=True, block_number=25)
+        assert not mock_trigger_service.called
+
+        get_block_numbers(event={}, context={})
+        expect(url2, healthy=False, block_number=25)
+        assert mock_trigger_service.called
+
+
+def test_get_block_numbers_caps_config_updates(monkeypatch, mock_trigger_service):
+    monkeypatch.setattr('handlers.eth_nodes.MAX_CONFIG_UPDATES', 1)
+    monkeypatch.setattr('lib.health.MAX_CONFIG_UPDATES', 1)
+    clear_all_items()
+    set_state(url1, block_number=25, leader=True)
+    set_state(url2, block_number=25, leader=False)
+    with aioresponses() as responses:
+        responses.post(url1, payload={'result': hex(40)})
+        responses.post(url2, payload={'result': hex(25)})
+        responses.post(url1, payload={'result': hex(40)})
+        responses.post(url2, payload={'result': hex(40)})
+
+        get_block_numbers(event={}, context={})
+        get_block_numbers(event={}, context={})
+
+    assert mock_trigger_service.call_count == 1
+    window = get_table().get_item(Key={'url': '#config_updates'})['Item']
+    assert window['pending'] is True
+    assert sorted(item['url'] for item in scan_items(get_table())) == [url1, url2]
+
+
+def test_get_block_numbers_sharded(monkeypatch, mock_trigger_service, mock_cloudwatch):
+    monkeypatch.setattr('handlers.eth_nodes.SHARD_COUNT', 2)
+    monkeypatch.setenv('CF_ProbeUnderscoreshardLambdaFunction', 'probe-shard')
+    monkeypatch.setattr('handlers.eth_nodes.shard_of', lambda url: [url1, url2].index(url))
+    clear_all_items()
+    set_state(url1, block_number=10, leader=True)
+    set_state(url2, block_number=5, leader=False)
+
+    def invoke(FunctionName, InvocationType, Payload):
+        urls = json.loads(Payload)['urls']
+        if url2 in urls:
+            raise Exception('shard is down')
+        return {'Payload': io.BytesIO(bytes(json.dumps([
+            {'url': url, 'block_number': 15, 'elapsed': 10} for url in urls
+        ]), 'utf8'))}
+
+    mock_cloudwatch.return_value.invoke.side_effect = invoke
+    get_block_numbers(event={}, context={})
+
+    expect(url1, healthy=True, block_number=15)
+    # nodes of a failed shard keep their state
+    expect(url2, healthy=True, block_number=5)
+
+
+def test_shard_of_is_stable(monkeypatch):
+    monkeypatch.setattr('handlers.eth_nodes.SHARD_COUNT', 4)
+    assert shard_of(url1) == shard_of(url1)
+    assert {shard_of(f'http://node{i}') for i in range(100)} == {0, 1, 2, 3}
+
+
+def test_write_updates_counts_throttled_and_skips_removed_backends():
+    def update_item(Key, **kwargs):
+        code = {
+            url1: 'ProvisionedThroughputExceededException',
+            url2: 'ConditionalCheckFailedException',
+        }.get(Key['url'])
+        if code:
+            raise ClientError(
+                {'Error': {'Code': code}, 'ResponseMetadata': {'RetryAttempts': 2}}, 'UpdateItem')
+        return {'ResponseMetadata': {'RetryAttempts': 1}}
+
+    table = mock.Mock()
+    table.meta.client.update_item.side_effect = update_item
+    updates = [{'Key': {'url': url}} for url in (url1, url2, 'http://url3')]
+
+    stats = asyncio.get_event_loop().run_until_complete(write_updates(table, updates))
+
+    assert stats == {'retries': 5, 'throttled': 1}
+    assert table.meta.client.update_item.call_count == 3
@@ -0,0 +1,214 @@
+import asyncio
+import json
+from unittest import mock
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from aioresponses import aioresponses
+from handlers.head_monitor import (HeadMonitor, log_failure, parse_new_head,
+                                   save_health_changes)
+from handlers.lib.db import get_table
+
+from .conftest import run
+
+url1 = 'http://url1'
+url2 = 'http://url2'
+
+
+def backend(url, is_leader=False, is_healthy=True, ws_url=None):
+    return {
+        'url': url,
+        'is_leader': is_leader,
+        'is_healthy': is_healthy,
+        'block_number': 10,
+        'ws_url': ws_url
+    }
+
+
+def new_head(block_number):
+    return {
+        'jsonrpc': '2.0',
+        'method': 'eth_subscription',
+        'params': {'subscription': '0x1', 'result': {'number': hex(block_number)}}
+    }
+
+
+@pytest.mark.parametrize('message,expected', [
+    (new_head(16), 16),
+    ({'jsonrpc': '2.0', 'id': 1, 'result': '0x1'}, None),
+    ({'method': 'eth_subscription', 'params': {'result': {}}}, None),
+    ([], None),
+])
+def test_parse_new_head(message, expected):
+    assert parse_new_head(message) == expected
+
+
+@pytest.fixture
+def changes():
+    return []
+
+
+@pytest.fixture
+def monitor(changes):
+    monitor = HeadMonitor(session=None, on_change=changes.extend)
+    monitor.backends = {
+        url1: backend(url1, is_leader=True),
+        url2: backend(url2),
+    }
+    return monitor
+
+
+def test_set_head_reports_changes_immediately(monitor, changes):
+    monitor.set_head(url1, 100)
+    monitor.set_head(url2, 100)
+    assert changes == []
+
+    monitor.set_head(url1, 110)
+    assert [(c['url'], c['is_healthy'], c['block_number']) for c in changes] == [
+        (url2, False, 100)
+    ]
+
+    monitor.set_head(url2, 109)
+    assert changes[-1]['url'] == url2
+    assert changes[-1]['is_healthy'] is True
+
+
+def test_set_head_follows_health_hysteresis(monkeypatch, monitor, changes):
+    # handlers import their libraries as top level `lib`
+    monkeypatch.setattr('lib.health.EJECT_AFTER', 2)
+    monitor.set_head(url1, 100)
+    monitor.set_head(url2, 100)
+    monitor.set_head(url1, 110)
+    # the same observation again is not another check
+    monitor.set_head(url1, 110)
+    assert changes == []
+    assert monitor.backends[url2]['health_failures'] == 1
+
+    monitor.set_head(url2, 100)
+    monitor.set_head(url2, 99)
+    assert [(c['url'], c['is_healthy'], c['health_failures']) for c in changes] == [
+        (url2, False, 2)
+    ]
+
+
+def test_open_circuit_ejects_right_away(monitor, changes):
+    monitor.set_head(url1, 100)
+    monitor.set_head(url2, 100)
+    monitor.backends[url2]['circuit_open'] = True
+    monitor.set_head(url2, 101)
+    assert [(c['url'], c['is_healthy']) for c in changes] == [(url2, False)]
+
+
+@pytest.mark.parametrize('probe,head,expected', [
+    # the node answers over HTTP, it stays in
+    ({'payload': {'result': hex(100)}}, 100, []),
+    ({'exception': aiohttp.ClientConnectionError()}, None, [(url2, False)]),
+])
+def test_lost_subscription_falls_back_to_polling(monitor, changes, probe, head, expected):
+    async def scenario():
+        async with aiohttp.ClientSession() as session:
+            monitor.session = session
+            monitor.heads = {url1: 100}
+            monitor.backends[url2]['ws_url'] = 'ws://url2'
+            task = asyncio.ensure_future(monitor.watch(monitor.backends[url2]))
+            await asyncio.sleep(0.1)
+            task.cancel()
+
+    with aioresponses() as responses:
+        # the subscription is refused, aioresponses doesn't know the ws url
+        responses.post(url2, **probe)
+        run(scenario())
+
+    assert monitor.heads[url2] == head
+    assert [(c['url'], c['is_healthy']) for c in changes] == expected
+
+
+def test_set_head_ignores_removed_backends(monitor, changes):
+    monitor.set_head('http://gone', 1)
+    assert 'http://gone' not in monitor.heads
+
+
+def test_poll_without_ws(changes):
+    async def scenario():
+        async with aiohttp.ClientSession() as session:
+            monitor = HeadMonitor(session, changes.extend)
+            monitor.update_backends([backend(url1, is_leader=True), backend(url2)])
+            await asyncio.sleep(0.1)
+            for url in list(monitor.backends):
+                monitor.stop(url)
+            return monitor
+
+    with aioresponses() as responses:
+        responses.post(url1, payload={'result': hex(30)})
+        responses.post(url2, payload={'result': hex(10)})
+        run(scenario())
+
+    assert [(c['url'], c['is_healthy']) for c in changes] == [(url2, False)]
+
+
+def test_subscribe_over_ws(changes):
+    async def handle_ws(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        request = json.loads((await ws.receive()).data)
+        assert request['method'] == 'eth_subscribe'
+        await ws.send_json({'jsonrpc': '2.0', 'id': request['id'], 'result': '0x1'})
+        await ws.send_json(new_head(100))
+        await ws.send_json(new_head(120))
+        await asyncio.sleep(1)
+        return ws
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/', handle_ws)
+        server = TestServer(app)
+        await server.start_server()
+        ws_url = str(server.make_url('/')).replace('http', 'ws')
+        async with aiohttp.ClientSession() as session:
+            monitor = HeadMonitor(session, changes.extend)
+            monitor.backends = {url1: backend(url1, is_leader=True)}
+            monitor.heads = {url1: 120}
+            monitor.backends[url2] = backend(url2, ws_url=ws_url)
+            task = asyncio.ensure_future(monitor.watch(monitor.backends[url2]))
+            await asyncio.sleep(0.2)
+            task.cancel()
+        await server.close()
+        return monitor
+
+    monitor = run(scenario())
+
+    assert monitor.heads[url2] == 120
+    # unhealthy on the first head, back in sync on the second one
+    assert [(c['url'], c['is_healthy']) for c in changes] == [
+        (url2, False), (url2, True)
+    ]
+
+
+def test_save_health_changes_skips_removed_backends():
+    table = get_table()
+    table.put_item(Item=backend(url1))
+    table.delete_item(Key={'url': url2})
+    changed = [
+        dict(backend(url1), is_healthy=False, block_number=90, health_successes=0,
+             health_failures=1, health_changed_at=1000),
+        dict(backend(url2), is_healthy=False, block_number=90, health_successes=0,
+             health_failures=1, health_changed_at=1000),
+    ]
+    with mock.patch('handlers.head_monitor.request_service_update') as request_update:
+        save_health_changes(changed)
+    request_update.assert_called_once_with(table, True)
+
+    item = table.get_item(Key={'url': url1})['Item']
+    assert item['is_healthy'] is False
+    assert (item['health_failures'], item['health_changed_at']) == (1, 1000)
+    assert 'Item' not in table.get_item(Key={'url': url2})
+    table.delete_item(Key={'url': url1})
+
+
+def test_failed_save_is_logged(caplog):
+    future = asyncio.get_event_loop().create_future()
+    future.set_exception(Exception('throttled'))
+    log_failure(future)
+    assert 'Saving health changes failed' in caplog.text
@@ -0,0 +1,121 @@
+import pytest
+from handlers.lib.health import (allow_config_update, check_passed,
+                                 next_state, quorum_block_number)
+
+
+@pytest.fixture
+def hysteresis(monkeypatch):
+    monkeypatch.setattr('handlers.lib.health.EJECT_LAG', 10)
+    monkeypatch.setattr('handlers.lib.health.READMIT_LAG', 3)
+    monkeypatch.setattr('handlers.lib.health.EJECT_AFTER', 3)
+    monkeypatch.setattr('handlers.lib.health.READMIT_AFTER', 2)
+    monkeypatch.setattr('handlers.lib.health.MIN_HOLD_TIME', 60)
+
+
+def healthy(is_healthy=True, **kwargs):
+    return dict({'is_healthy': is_healthy}, **kwargs)
+
+
+def test_defaults_follow_every_check():
+    assert next_state(healthy(), False, now=0)['is_healthy'] is False
+    assert next_state(healthy(False), True, now=0)['is_healthy'] is True
+    assert check_passed(True, 91, 100) is True
+    assert check_passed(True, 90, 100) is False
+    assert check_passed(True, None, 100) is False
+
+
+def test_separate_eject_and_readmit_lag(hysteresis):
+    assert check_passed(True, 95, 100) is True
+    assert check_passed(False, 95, 100) is False
+    assert check_passed(False, 98, 100) is True
+
+
+def test_ejects_after_consecutive_failures(hysteresis):
+    state = healthy()
+    state = next_state(state, False, now=100)
+    state = next_state(state, False, now=101)
+    assert state['is_healthy'] is True
+    # a success in between starts the count again
+    state = next_state(state, True, now=102)
+    for now in (103, 104):
+        state = next_state(state, False, now=now)
+        assert state['is_healthy'] is True
+    state = next_state(state, False, now=105)
+    assert state == {
+        'is_healthy': False,
+        'health_successes': 0,
+        'health_failures': 3,
+        'health_changed_at': 105,
+    }
+
+
+def test_holds_state_for_minimum_time(hysteresis):
+    state = healthy(False, health_changed_at=100)
+    state = next_state(state, True, now=110)
+    state = next_state(state, True, now=120)
+    assert state['is_healthy'] is False
+    state = next_state(state, True, now=160)
+    assert state['is_healthy'] is True
+    assert state['health_changed_at'] == 160
+
+
+def test_open_circuit_ejects_immediately(hysteresis):
+    state = next_state(healthy(health_changed_at=100), False, now=101, force_unhealthy=True)
+    assert state['is_healthy'] is False
+
+
+def test_counters_settle():
+    state = healthy()
+    assert next_state(state, True, now=0) == next_state(next_state(state, True, now=0), True, now=0)
+
+
+def test_config_update_cap(monkeypatch):
+    monkeypatch.setattr('handlers.lib.health.MAX_CONFIG_UPDATES', 2)
+    monkeypatch.setattr('handlers.lib.health.CONFIG_UPDATE_WINDOW', 60)
+    allowed, window = allow_config_update({}, now=100)
+    assert allowed
+    allowed, window = allow_config_update(window, now=110)
+    assert allowed
+    allowed, window = allow_config_update(window, now=120)
+    assert not allowed
+    allowed, window = allow_config_update(window, now=160)
+    assert allowed
+    assert window == {'window_start': 160, 'updates': 1}
+
+
+def test_quorum_single_leader_is_authoritative():
+    assert quorum_block_number([100], [80]) == 100
+    assert quorum_block_number([100], [150]) == 100
+    assert quorum_block_number([None], [80, 90]) == 90
+    assert quorum_block_number([], []) is None
+
+
+def test_quorum_rejects_leader_outliers():
+    assert quorum_block_number([100, 102, 5000], []) == 102
+    assert quorum_block_number([100, 101, 3], [90]) == 101
+
+
+def test_quorum_stuck_leader_outvoted_by_nodes():
+    assert quorum_block_number([100], [120, 121, 90]) == 120
+
+
+def test_quorum_even_leaders_take_the_lower_median():
+    assert quorum_block_number([100, 9999], [100]) == 100
+    assert quorum_block_number([100, 9999], [9998]) == 100
+    assert quorum_block_number([100, 9999], []) == 100
+    assert quorum_block_number([100, 105], []) == 105
+
+
+def test_quorum_lagging_nodes_dont_lower_the_reference():
+    assert quorum_block_number([1000], [800] * 3) == 1000
+    assert quorum_block_number([1000] * 3, [800] * 4) == 1000
+    assert quorum_block_number([1000, 1001], [800] * 3) == 1001
+    assert quorum_block_number([130], [100, 100, 100]) == 130
+
+
+def test_quorum_suspicious_lead_is_logged(caplog):
+    quorum_block_number([9999], [100] * 3)
+    assert 'Leaders at 9999 are 9899 blocks ahead of our nodes' in caplog.text
+    caplog.clear()
+    quorum_block_number([130], [100] * 3)
+    assert not caplog.text
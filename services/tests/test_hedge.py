@@ -0,0 +1,37 @@
+from handlers.lib.hedge import HedgeBudget, LatencyTracker, is_hedged
+
+
+def test_percentile_needs_enough_samples():
+    tracker = LatencyTracker(window=100)
+    for elapsed in range(9):
+        tracker.record('http://url1', elapsed)
+    assert tracker.percentile('http://url1', 0.95) is None
+    assert tracker.percentile('http://url2', 0.95) is None
+    for elapsed in range(9, 100):
+        tracker.record('http://url1', elapsed)
+    assert tracker.percentile('http://url1', 0.95) == 95
+    assert tracker.percentile('http://url1', 0.5) == 50
+
+
+def test_percentile_follows_recent_latency():
+    tracker = LatencyTracker(window=10)
+    for _ in range(10):
+        tracker.record('http://url1', 1.0)
+    for _ in range(10):
+        tracker.record('http://url1', 0.1)
+    assert tracker.percentile('http://url1', 0.99) == 0.1
+
+
+def test_budget_caps_hedges():
+    budget = HedgeBudget(ratio=0.05, burst=10)
+    hedges = 0
+    for _ in range(1000):
+        budget.deposit()
+        hedges += budget.withdraw()
+    assert hedges == 50
+
+
+def test_is_hedged(monkeypatch):
+    monkeypatch.setattr('handlers.lib.hedge.HEDGED_METHODS', ['eth_call'])
+    assert is_hedged({'method': 'eth_call'})
+    assert not is_hedged({'method': 'eth_sendRawTransaction'})
@@ -0,0 +1,91 @@
+import pytest
+from handlers.lib import instrumentation
+from handlers.lib.instrumentation import (OTHER, REQUEST_DURATION, Histogram,
+                                          Registry, aggregate)
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(2.65)
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1
+    assert histogram.quantile(0.99) == 2
+    assert Histogram().quantile(0.5) is None
+
+
+def test_quantile_is_capped_by_largest_observation():
+    histogram = Histogram(buckets=(0.1, 1))
+    histogram.observe(0.3)
+    assert histogram.quantile(0.99) == 0.3
+
+
+def test_method_label_is_bounded(monkeypatch):
+    monkeypatch.setattr(instrumentation, 'MAX_METHODS', 2)
+    registry = Registry()
+    assert registry.method_label('eth_call') == 'eth_call'
+    assert registry.method_label('eth_getLogs') == 'eth_getLogs'
+    assert registry.method_label('eth_chainId') == OTHER
+    assert registry.method_label('eth_call') == 'eth_call'
+    assert registry.method_label('eth_call"} 1') == OTHER
+    assert registry.method_label(None) == OTHER
+
+
+def test_roll_up_resets_window_but_not_totals():
+    registry = Registry()
+    registry.observe(REQUEST_DURATION, 0.02, method='eth_call', status=200)
+    window = registry.roll_up()
+    assert window[REQUEST_DURATION][(('method', 'eth_call'), ('status', '200'))].count == 1
+    assert registry.roll_up() == {}
+    assert registry.totals[REQUEST_DURATION][(('method', 'eth_call'), ('status', '200'))].count == 1
+
+
+def test_aggregate_merges_by_label():
+    registry = Registry()
+    registry.observe(REQUEST_DURATION, 0.02, method='eth_call', status=200)
+    registry.observe(REQUEST_DURATION, 0.3, method='eth_call', status=502)
+    registry.observe(REQUEST_DURATION, 0.01, method='eth_chainId', status=200)
+    histograms = registry.roll_up()[REQUEST_DURATION]
+
+    merged = aggregate(histograms, 'method')
+    assert {method: h.count for method, h in merged.items()} == {'eth_call': 2, 'eth_chainId': 1}
+    assert (merged['eth_call'].min, merged['eth_call'].max) == (0.02, 0.3)
+    failed = aggregate(histograms, 'method', where=lambda labels: labels['status'] != '200')
+    assert {method: h.count for method, h in failed.items()} == {'eth_call': 1}
+
+
+def test_render_exposition_format():
+    registry = Registry()
+    registry.observe(REQUEST_DURATION, 0.02, method='eth_call', status=200)
+    registry.observe(REQUEST_DURATION, 60, method='eth_call', status=200)
+    lines = registry.render().splitlines()
+    assert lines[:2] == [
+        '# HELP jsonrpc_request_duration_seconds '
+        'Time to answer a client request by method and status',
+        '# TYPE jsonrpc_request_duration_seconds histogram',
+    ]
+    assert (
+        'jsonrpc_request_duration_seconds_bucket{method="eth_call",status="200",le="0.01"} 0'
+        in lines
+    )
+    assert (
+        'jsonrpc_request_duration_seconds_bucket{method="eth_call",status="200",le="0.025"} 1'
+        in lines
+    )
+    assert (
+        'jsonrpc_request_duration_seconds_bucket{method="eth_call",status="200",le="+Inf"} 2'
+        in lines
+    )
+    assert lines[-2:] == [
+        'jsonrpc_request_duration_seconds_sum{method="eth_call",status="200"} 60.02',
+        'jsonrpc_request_duration_seconds_count{method="eth_call",status="200"} 2',
+    ]
+
+
+def test_render_escapes_label_values():
+    registry = Registry()
+    registry.observe(REQUEST_DURATION, 0.02, method='a"b\\c', status=200)
+    assert 'method="a\\"b\\\\c"' in registry.render()
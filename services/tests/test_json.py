@@ -0,0 +1,55 @@
+import decimal
+
+import pytest
+from handlers.lib import json
+
+BACKENDS = [
+    backend for backend, module in [
+        (json.ORJSON, json.orjson), (json.UJSON, json.ujson), (json.STDLIB, True)
+    ] if module is not None
+]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_dumps_decimals(backend):
+    item = {'url': 'http://url1', 'block_number': decimal.Decimal(25), 'load': decimal.Decimal('0.5')}
+    assert json.loads(json.dumps_bytes(item, backend=backend)) == {
+        'url': 'http://url1', 'block_number': 25, 'load': 0.5
+    }
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_dumps_nested_decimals(backend):
+    items = [{'url': 'http://url1', 'weights': (decimal.Decimal(1), {'load': decimal.Decimal('0.25')})}]
+    assert json.loads(json.dumps_bytes(items, backend=backend)) == [
+        {'url': 'http://url1', 'weights': [1, {'load': 0.25}]}
+    ]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_dumps_big_integers(backend):
+    # e.g. uint256 values of a decoded log
+    assert json.loads(json.dumps_bytes({'value': 2 ** 200}, backend=backend)) == {'value': 2 ** 200}
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_sort_keys(backend):
+    encoded = json.dumps_bytes({'b': 1, 'a': [1, 'x']}, sort_keys=True, backend=backend)
+    assert encoded.replace(b' ', b'') == b'{"a":[1,"x"],"b":1}'
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_loads_bytes_and_errors(backend):
+    assert json.loads(b'{"result": "0x1"}', backend=backend) == {'result': '0x1'}
+    assert json.loads('[1, 2]', backend=backend) == [1, 2]
+    with pytest.raises(json.JSONDecodeError):
+        json.loads(b'{"result', backend=backend)
+
+
+def test_unknown_types_fail():
+    with pytest.raises(TypeError):
+        json.dumps({'when': object()})
+
+
+def test_dumps_with_formatting_options():
+    assert json.dumps({'n': decimal.Decimal(1)}, indent=1) == '{\n "n": 1\n}'
@@ -0,0 +1,83 @@
+import datetime
+import json
+from unittest import mock
+
+import pytest
+from handlers.lib.metrics import (EMF, emf_events, put_metrics, stack_metric,
+                                  statistic_set)
+
+when = datetime.datetime(2026, 1, 1)
+
+
+@pytest.fixture
+def mock_cloudwatch():
+    with mock.patch('boto3.client') as m:
+        yield m.return_value.put_metric_data
+
+
+def test_put_metrics_is_chunked(mock_cloudwatch):
+    metrics = [stack_metric(f'Metric {i}', i) for i in range(45)]
+    put_metrics(metrics)
+
+    calls = mock_cloudwatch.call_args_list
+    assert sorted(len(call[1]['MetricData']) for call in calls) == [5, 20, 20]
+    assert {call[1]['Namespace'] for call in calls} == {'test'}
+    sent = [metric for call in calls for metric in call[1]['MetricData']]
+    assert sorted(sent, key=lambda m: m['Value']) == metrics
+
+
+def test_statistic_set():
+    metric = statistic_set(stack_metric('Latency', None, unit='Milliseconds'), 3, 30, 5, 20)
+    assert 'Value' not in metric
+    assert metric['StatisticValues'] == {
+        'SampleCount': 3, 'Sum': 30, 'Minimum': 5, 'Maximum': 20}
+
+
+def test_emf_groups_metrics_by_dimensions():
+    events = emf_events([
+        stack_metric('Requests', 2, unit='Count', timestamp=when),
+        stack_metric('Errors', 1, unit='Count', timestamp=when),
+        stack_metric('Requests', 3, unit='Count', timestamp=when, dimensions={'Method': 'eth_call'}),
+        stack_metric('Requests', 4, unit='Count', timestamp=when, dimensions={'Method': 'eth_call'}),
+    ])
+    assert events == [
+        {
+            'Stack name': 'jsonrpc-proxy-dev',
+            'Requests': 2,
+            'Errors': 1,
+            '_aws': {
+                'Timestamp': int(when.timestamp() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': 'test',
+                    'Dimensions': [['Stack name']],
+                    'Metrics': [
+                        {'Name': 'Requests', 'Unit': 'Count', 'StorageResolution': 60},
+                        {'Name': 'Errors', 'Unit': 'Count', 'StorageResolution': 60},
+                    ],
+                }],
+            },
+        },
+        {
+            'Stack name': 'jsonrpc-proxy-dev',
+            'Method': 'eth_call',
+            'Requests': [3, 4],
+            '_aws': {
+                'Timestamp': int(when.timestamp() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': 'test',
+                    'Dimensions': [['Stack name', 'Method']],
+                    'Metrics': [{'Name': 'Requests', 'Unit': 'Count', 'StorageResolution': 60}],
+                }],
+            },
+        },
+    ]
+
+
+def test_emf_writes_to_log(mock_cloudwatch, capsys):
+    latency = statistic_set(stack_metric('Latency', None, timestamp=when), 3, 30, 5, 20)
+    put_metrics([stack_metric('Requests', 2, timestamp=when), latency], metrics_format=EMF)
+
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [event['Requests'] for event in events] == [2]
+    # statistic sets can't be expressed in EMF
+    assert mock_cloudwatch.call_args == mock.call(Namespace='test', MetricData=[latency])
@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from handlers.lib.multiplex import WebSocketPool
+
+from .conftest import run
+
+
+def ws_node(received, batch=2):
+    # answers in reverse order once `batch` requests arrived
+    async def handle_ws(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        waiting = []
+        async for message in ws:
+            payload = json.loads(message.data)
+            received.append(payload)
+            waiting.append(payload)
+            if len(waiting) == batch:
+                for payload in reversed(waiting):
+                    await ws.send_json(
+                        {'jsonrpc': '2.0', 'id': payload['id'], 'result': payload['params'][0]})
+                waiting = []
+        return ws
+
+    app = web.Application()
+    app.router.add_get('/', handle_ws)
+    return TestServer(app)
+
+
+def test_responses_are_matched_by_id():
+    received = []
+
+    async def scenario():
+        server = ws_node(received)
+        await server.start_server()
+        ws_url = str(server.make_url('/')).replace('http', 'ws')
+        async with aiohttp.ClientSession() as session:
+            pool = WebSocketPool(session, size=1)
+            try:
+                return await asyncio.gather(*[
+                    pool.call(ws_url, json.dumps({
+                        'jsonrpc': '2.0', 'id': 'client', 'method': 'eth_call', 'params': [value]
+                    }).encode())
+                    for value in ('a', 'b')
+                ])
+            finally:
+                await pool.close()
+                await server.close()
+
+    responses = [json.loads(response) for response in run(scenario())]
+    assert responses == [
+        {'jsonrpc': '2.0', 'id': 'client', 'result': 'a'},
+        {'jsonrpc': '2.0', 'id': 'client', 'result': 'b'},
+    ]
+    # client ids are replaced with ids unique on the connection
+    assert sorted(payload['id'] for payload in received) == [1, 2]
+
+
+@pytest.mark.parametrize('body', [
+    b'[{"jsonrpc": "2.0", "id": 1, "method": "eth_call", "params": []}]',
+    b'{"jsonrpc": "2.0", "method": "eth_call", "params": []}',
+    b'not json',
+])
+def test_batches_and_notifications_are_not_multiplexed(body):
+    pool = WebSocketPool(session=None)
+    assert run(pool.call('ws://node', body)) is None
+    assert pool.connections == {}
+
+
+def test_pending_requests_fail_when_connection_drops():
+    async def handle_ws(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.receive()
+        await ws.close()
+        return ws
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/', handle_ws)
+        server = TestServer(app)
+        await server.start_server()
+        ws_url = str(server.make_url('/')).replace('http', 'ws')
+        async with aiohttp.ClientSession() as session:
+            pool = WebSocketPool(session, size=1)
+            try:
+                await pool.call(ws_url, b'{"jsonrpc": "2.0", "id": 1, "method": "eth_call"}')
+            finally:
+                await pool.close()
+                await server.close()
+
+    with pytest.raises(aiohttp.ClientError):
+        run(scenario())
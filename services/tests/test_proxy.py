@@ -0,0 +1,829 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer, make_mocked_request
+from aioresponses import CallbackResult, aioresponses
+from handlers.lib.balancer import LeastOutstanding
+from handlers.lib.breaker import STATE_TTL
+from handlers.lib.cache import head_cache_key
+from handlers.lib.instrumentation import (CANCELLED, REQUEST_DURATION,
+                                          UPSTREAM_DURATION)
+from handlers.lib.routing import DEFAULT_POOL, HEAVY_POOL, request_pool
+from handlers.lib.rpc import with_id
+from handlers.proxy import NoUpstreamError, Proxy, make_app, make_metrics_app
+
+from .conftest import run
+from .test_subscriptions import FakeNode
+
+url1 = 'http://url1'
+url2 = 'http://url2'
+url3 = 'http://url3'
+leader = 'https://infura.io/key'
+
+
+def backend(url, healthy=True, is_leader=False, pool=None, block_number=None):
+    return {
+        'url': url,
+        'is_healthy': healthy,
+        'is_leader': is_leader,
+        'pool': pool,
+        'block_number': block_number
+    }
+
+
+@pytest.fixture
+def backends():
+    return [
+        backend(url1, block_number=100),
+        backend(url2, block_number=100),
+        backend(leader, is_leader=True, block_number=110)
+    ]
+
+
+@pytest.fixture
+def proxy(backends):
+    proxy = Proxy(load_backends=lambda: backends)
+    run(proxy.start())
+    yield proxy
+    run(proxy.close())
+
+
+def test_start_loads_backends(proxy):
+    assert proxy.pools == {DEFAULT_POOL: [url1, url2], HEAVY_POOL: [url1, url2]}
+
+
+def test_update_backends_swaps_in_place(proxy):
+    proxy.update_backends([backend(url1, healthy=False), backend(url2)])
+    assert proxy.pools[DEFAULT_POOL] == [url2]
+
+    proxy.update_backends([backend(url1, healthy=False), backend(leader, is_leader=True)])
+    assert proxy.pools[DEFAULT_POOL] == [leader]
+
+
+def test_update_backends_with_heavy_pool(proxy):
+    proxy.update_backends([backend(url1), backend(url2), backend(url3, pool=HEAVY_POOL)])
+    assert proxy.pools == {DEFAULT_POOL: [url1, url2], HEAVY_POOL: [url3]}
+
+    # default pool borrows heavy nodes rather than going to the leader
+    proxy.update_backends([
+        backend(url1, healthy=False),
+        backend(url3, pool=HEAVY_POOL),
+        backend(leader, is_leader=True)
+    ])
+    assert proxy.pools == {DEFAULT_POOL: [url3], HEAVY_POOL: [url3]}
+
+
+@pytest.mark.parametrize('payload,expected', [
+    ({'method': 'eth_blockNumber'}, DEFAULT_POOL),
+    ({'method': 'eth_getLogs'}, HEAVY_POOL),
+    ({'method': 'trace_block'}, HEAVY_POOL),
+    ({'method': 'debug_traceTransaction'}, HEAVY_POOL),
+    ([{'method': 'eth_call'}, {'method': 'trace_filter'}], HEAVY_POOL),
+    ([{'method': 'eth_call'}, 'garbage'], DEFAULT_POOL),
+    ({'method': None}, DEFAULT_POOL),
+])
+def test_request_pool(payload, expected):
+    assert request_pool(payload) == expected
+
+
+def test_forward_to_pool(proxy):
+    proxy.update_backends([backend(url1), backend(url3, pool=HEAVY_POOL)])
+    with aioresponses() as responses:
+        responses.post(url3, body=b'{"result": []}')
+
+        assert run(proxy.forward(b'{}', HEAVY_POOL)) == (200, b'{"result": []}')
+
+
+def test_forward_round_robin(proxy):
+    with aioresponses() as responses:
+        responses.post(url1, body=b'{"result": "0x1"}')
+        responses.post(url2, body=b'{"result": "0x2"}')
+
+        first = run(proxy.forward(b'{}'))
+        second = run(proxy.forward(b'{}'))
+
+    assert sorted([first, second]) == [
+        (200, b'{"result": "0x1"}'),
+        (200, b'{"result": "0x2"}'),
+    ]
+
+
+def test_forward_tries_next_upstream(proxy):
+    with aioresponses() as responses:
+        responses.post(url1, exception=asyncio.TimeoutError(), repeat=True)
+        responses.post(url2, body=b'{"result": "0x2"}', repeat=True)
+
+        assert run(proxy.forward(b'{}')) == (200, b'{"result": "0x2"}')
+        assert run(proxy.forward(b'{}')) == (200, b'{"result": "0x2"}')
+
+
+def test_forward_all_upstreams_failing(proxy):
+    with aioresponses() as responses:
+        responses.post(url1, exception=aiohttp.ClientConnectionError())
+        responses.post(url2, exception=aiohttp.ClientConnectionError())
+
+        with pytest.raises(aiohttp.ClientConnectionError):
+            run(proxy.forward(b'{}'))
+
+
+def test_forward_without_upstreams(proxy):
+    proxy.update_backends([])
+    with pytest.raises(NoUpstreamError):
+        run(proxy.forward(b'{}'))
+
+
+def test_finalized_block_number(proxy):
+    assert proxy.finalized_block_number == 100
+
+    proxy.update_backends([backend(url1, block_number=120)])
+    assert proxy.finalized_block_number == 110
+
+
+def receipt_request(request_id):
+    return {
+        'jsonrpc': '2.0',
+        'id': request_id,
+        'method': 'eth_getTransactionReceipt',
+        'params': ['0xabc']
+    }
+
+
+def test_call_caches_finalized_results(proxy):
+    receipt = {'jsonrpc': '2.0', 'id': 1, 'result': {'blockNumber': hex(90)}}
+    with aioresponses() as responses:
+        responses.post(url1, payload=receipt)
+        responses.post(url2, payload=receipt)
+
+        first = run(proxy.call(receipt_request(1), b'{}'))
+        second = run(proxy.call(receipt_request(2), b'{}'))
+
+    assert json.loads(first[1]) == receipt
+    assert json.loads(second[1]) == dict(receipt, id=2)
+    assert proxy.cache.hits == 1
+    assert proxy.cache.misses == 1
+
+
+def test_call_doesnt_cache_recent_results(proxy):
+    receipt = {'jsonrpc': '2.0', 'id': 1, 'result': {'blockNumber': hex(105)}}
+    with aioresponses() as responses:
+        responses.post(url1, payload=receipt, repeat=True)
+        responses.post(url2, payload=receipt, repeat=True)
+
+        run(proxy.call(receipt_request(1), b'{}'))
+        run(proxy.call(receipt_request(1), b'{}'))
+
+    assert len(proxy.cache) == 0
+    assert proxy.cache.misses == 2
+
+
+def block_number_request(request_id):
+    return {'jsonrpc': '2.0', 'id': request_id, 'method': 'eth_blockNumber', 'params': []}
+
+
+def test_call_caches_head_state_until_new_head(proxy):
+    with aioresponses() as responses:
+        responses.post(url1, payload={'jsonrpc': '2.0', 'id': 1, 'result': '0x6e'}, repeat=True)
+        responses.post(url2, payload={'jsonrpc': '2.0', 'id': 1, 'result': '0x6e'}, repeat=True)
+
+        run(proxy.call(block_number_request(1), b'{}'))
+        status, response = run(proxy.call(block_number_request(2), b'{}'))
+        assert json.loads(response) == {'jsonrpc': '2.0', 'id': 2, 'result': '0x6e'}
+        assert proxy.head_cache.hits == 1
+
+        proxy.update_backends([backend(url1, block_number=111)])
+        run(proxy.call(block_number_request(3), b'{}'))
+        assert proxy.head_cache.misses == 2
+
+
+def test_call_doesnt_answer_notifications_from_cache(proxy):
+    proxy.head_cache.set(head_cache_key({'method': 'eth_blockNumber', 'params': []}), b'"0x6e"')
+    notification = {'jsonrpc': '2.0', 'method': 'eth_blockNumber', 'params': []}
+    with aioresponses() as responses:
+        responses.post(url1, status=204, body=b'', repeat=True)
+        responses.post(url2, status=204, body=b'', repeat=True)
+
+        assert run(proxy.call(notification, b'{}')) == (204, b'')
+    assert proxy.head_cache.hits == 0
+
+
+def test_collect_metrics(proxy):
+    proxy.cache.hits = 3
+    assert [(m['MetricName'], m['Value']) for m in proxy.collect_metrics()] == [
+        ('Response cache hits', 3),
+        ('Response cache misses', 0),
+        ('Response cache evictions', 0),
+        ('Head cache hits', 0),
+        ('Head cache misses', 0),
+        ('Head cache evictions', 0),
+        ('Coalesced requests', 0),
+        ('Response cache size', 0),
+        ('Head cache size', 0),
+    ]
+    proxy.cache.hits = 5
+    assert proxy.collect_metrics()[0]['Value'] == 2
+
+
+def test_call_coalesces_identical_requests(proxy):
+    balance_request = {
+        'jsonrpc': '2.0',
+        'method': 'eth_getBalance',
+        'params': ['0xabc', '0x10']
+    }
+    with aioresponses() as responses:
+        responses.post(url1, payload={'jsonrpc': '2.0', 'id': 1, 'result': '0x1'})
+        responses.post(url2, payload={'jsonrpc': '2.0', 'id': 1, 'result': '0x1'})
+
+        results = run(asyncio.gather(*[
+            proxy.call(dict(balance_request, id=request_id), b'{}')
+            for request_id in range(1, 4)
+        ]))
+        upstream_calls = sum(len(calls) for calls in responses.requests.values())
+
+    assert upstream_calls == 1
+    assert [json.loads(response)['id'] for status, response in results] == [1, 2, 3]
+    assert proxy.single_flight.coalesced == 2
+    assert proxy.single_flight.calls == {}
+
+
+def test_call_doesnt_coalesce_state_changing_requests(proxy):
+    filter_request = {'jsonrpc': '2.0', 'id': 1, 'method': 'eth_newFilter', 'params': [{}]}
+    with aioresponses() as responses:
+        responses.post(url1, payload={'jsonrpc': '2.0', 'id': 1, 'result': '0x1'}, repeat=True)
+        responses.post(url2, payload={'jsonrpc': '2.0', 'id': 1, 'result': '0x2'}, repeat=True)
+
+        run(asyncio.gather(*[proxy.call(filter_request, b'{}') for _ in range(2)]))
+
+    assert proxy.single_flight.coalesced == 0
+
+
+@pytest.mark.parametrize('response,expected', [
+    (b'{"id": 1, "result": "0x1"}', {'id': 2, 'result': '0x1'}),
+    (b'{"id": 2, "result": "0x1"}', {'id': 2, 'result': '0x1'}),
+])
+def test_with_id(response, expected):
+    assert json.loads(with_id(response, 2)) == expected
+
+
+def test_with_id_keeps_unparsable_response():
+    assert with_id(b'Bad gateway', 2) == b'Bad gateway'
+
+
+def echo_batch(url, data, **kwargs):
+    return CallbackResult(payload=[
+        {'jsonrpc': '2.0', 'id': request['id'], 'result': url.human_repr()}
+        for request in json.loads(data)
+        if 'id' in request
+    ])
+
+
+def test_call_batch_splits_across_nodes(proxy, monkeypatch):
+    monkeypatch.setattr('handlers.proxy.BATCH_MAX_SIZE', 2)
+    batch = [
+        {'jsonrpc': '2.0', 'id': 'a', 'method': 'eth_getCode', 'params': ['0x1', '0x1']},
+        {'jsonrpc': '2.0', 'id': 'a', 'method': 'eth_getCode', 'params': ['0x2', '0x1']},
+        {'jsonrpc': '2.0', 'method': 'eth_getCode', 'params': ['0x3', '0x1']},
+        {'jsonrpc': '2.0', 'id': 7, 'method': 'eth_getCode', 'params': ['0x4', '0x1']},
+    ]
+    with aioresponses() as responses:
+        responses.post(url1, callback=echo_batch, repeat=True)
+        responses.post(url2, callback=echo_batch, repeat=True)
+
+        status, response = run(proxy.call_batch(batch))
+
+    response = json.loads(response)
+    assert status == 200
+    assert [r['id'] for r in response] == ['a', 'a', 7]
+    # two sub-batches, one per node
+    assert response[0]['result'] == response[1]['result']
+    assert response[0]['result'] != response[2]['result']
+
+
+def test_call_batch_partial_failures(proxy):
+    batch = [
+        {'jsonrpc': '2.0', 'id': 1, 'method': 'eth_blockNumber', 'params': []},
+        'garbage',
+        {'jsonrpc': '2.0', 'id': 2, 'method': 'eth_gasPrice', 'params': []},
+    ]
+    with aioresponses() as responses:
+        responses.post(url1, payload=[{'jsonrpc': '2.0', 'id': 0, 'result': '0x1'}], repeat=True)
+        responses.post(url2, payload=[{'jsonrpc': '2.0', 'id': 0, 'result': '0x1'}], repeat=True)
+
+        status, response = run(proxy.call_batch(batch))
+
+    assert json.loads(response) == [
+        {'jsonrpc': '2.0', 'id': 1, 'result': '0x1'},
+        {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': 'Invalid Request'}},
+        {'jsonrpc': '2.0', 'id': 2, 'error': {'code': -32603, 'message': 'Upstream error'}},
+    ]
+
+
+def test_call_batch_of_notifications_gets_no_response(proxy):
+    proxy.head_cache.set(head_cache_key({'method': 'eth_blockNumber', 'params': []}), b'"0x6e"')
+    batch = [
+        {'jsonrpc': '2.0', 'method': 'eth_blockNumber', 'params': []},
+        {'jsonrpc': '2.0', 'method': 'eth_gasPrice', 'params': []},
+    ]
+    with aioresponses() as responses:
+        responses.post(url1, status=204, body=b'', repeat=True)
+        responses.post(url2, status=204, body=b'', repeat=True)
+
+        assert run(proxy.call_batch(batch)) == (204, b'')
+
+
+def test_call_batch_uses_cache(proxy):
+    proxy.head_cache.set(head_cache_key({'method': 'eth_blockNumber', 'params': []}), b'"0x6e"')
+    batch = [{'jsonrpc': '2.0', 'id': 5, 'method': 'eth_blockNumber', 'params': []}]
+
+    status, response = run(proxy.call_batch(batch))
+
+    assert json.loads(response) == [{'jsonrpc': '2.0', 'id': 5, 'result': '0x6e'}]
+
+
+def test_call_batch_cached_notification_gets_no_response(proxy):
+    proxy.head_cache.set(head_cache_key({'method': 'eth_blockNumber', 'params': []}), b'"0x6e"')
+    batch = [
+        {'jsonrpc': '2.0', 'method': 'eth_blockNumber', 'params': []},
+        {'jsonrpc': '2.0', 'id': 5, 'method': 'eth_blockNumber', 'params': []},
+    ]
+
+    status, response = run(proxy.call_batch(batch))
+
+    assert json.loads(response) == [{'jsonrpc': '2.0', 'id': 5, 'result': '0x6e'}]
+
+
+def new_filter_callback(url, **kwargs):
+    return CallbackResult(payload={'jsonrpc': '2.0', 'id': 1, 'result': f'0x{url.host[-1]}'})
+
+
+def test_filters_are_pinned_to_their_node(proxy):
+    new_filter = {'jsonrpc': '2.0', 'id': 1, 'method': 'eth_newFilter', 'params': [{}]}
+    with aioresponses() as responses:
+        responses.post(url1, callback=new_filter_callback, repeat=True)
+        responses.post(url2, callback=new_filter_callback, repeat=True)
+
+        _, response = run(proxy.call(new_filter, json.dumps(new_filter), 'client'))
+        created = json.loads(response)['result']
+        # a filter id doesn't say which node created it
+        assert proxy.filters[created] == f'http://url{created[-1]}'
+
+        for _ in range(3):
+            changes = {'jsonrpc': '2.0', 'id': 2, 'method': 'eth_getFilterChanges',
+                       'params': [created]}
+            run(proxy.call(changes, json.dumps(changes), 'another client'))
+    requests = [
+        (str(url), len(calls)) for (_, url), calls in responses.requests.items()
+    ]
+    assert requests == [(proxy.filters[created], 4)]
+
+
+def test_sticky_clients_get_repinned_when_node_goes_away(proxy):
+    proxy.filters['0x1'] = url1
+    payload = {'jsonrpc': '2.0', 'id': 1, 'method': 'eth_sendRawTransaction', 'params': ['0xf8']}
+    owner = proxy.ring.walk('client')[0]
+    assert all(proxy.sticky_order(payload, 'client')[0] == owner for _ in range(3))
+
+    proxy.update_backends([backend(url1, healthy=False), backend(url2)])
+    assert proxy.filters == {}
+    assert proxy.sticky_order(payload, 'client') == [url2]
+
+    proxy.update_backends([])
+    with pytest.raises(NoUpstreamError):
+        proxy.sticky_order(payload, 'client')
+
+
+def test_call_batch_pins_sticky_entries(proxy):
+    batch = [
+        {'jsonrpc': '2.0', 'id': 1, 'method': 'eth_blockNumber', 'params': []},
+        {'jsonrpc': '2.0', 'id': 2, 'method': 'eth_getTransactionCount',
+         'params': ['0xabc', 'pending']},
+    ]
+
+    def echo(url, data, **kwargs):
+        if isinstance(json.loads(data), list):
+            return echo_batch(url, data)
+        # sticky entries are sent on their own
+        return CallbackResult(payload={'jsonrpc': '2.0', 'id': 2, 'result': url.human_repr()})
+
+    with aioresponses() as responses:
+        responses.post(url1, callback=echo, repeat=True)
+        responses.post(url2, callback=echo, repeat=True)
+
+        status, response = run(proxy.call_batch(batch, 'client'))
+
+    response = json.loads(response)
+    assert [r['id'] for r in response] == [1, 2]
+    assert response[1]['result'] == proxy.ring.walk('client')[0] + '/'
+
+
+def test_least_outstanding_order():
+    balancer = LeastOutstanding(decay=0.5)
+    balancer.seed(url1, 0.1)
+    balancer.seed(url2, 0.3)
+    assert balancer.order([url2, url1]) == [url1, url2]
+
+    balancer.started(url1)
+    balancer.started(url1)
+    balancer.started(url1)
+    assert balancer.order([url1, url2]) == [url2, url1]
+
+    balancer.finished(url1, 0.5)
+    assert balancer.latency[url1] == pytest.approx(0.3)
+    assert balancer.outstanding[url1] == 2
+
+
+def test_forward_prefers_fast_nodes(proxy, monkeypatch):
+    monkeypatch.setattr('handlers.proxy.BALANCING_MODE', 'least_conn')
+    proxy.update_backends([
+        dict(backend(url1), response_time=500),
+        dict(backend(url2), response_time=20),
+    ])
+    with aioresponses() as responses:
+        responses.post(url2, body=b'{"result": "0x2"}', repeat=True)
+
+        for _ in range(3):
+            assert run(proxy.forward(b'{}')) == (200, b'{"result": "0x2"}')
+    assert proxy.balancer.outstanding[url2] == 0
+
+
+def test_failing_node_gets_ejected_and_readmitted(backends, monkeypatch):
+    # handlers import their libraries as top level `lib`
+    monkeypatch.setattr('lib.breaker.CONSECUTIVE_FAILURES', 2)
+    monkeypatch.setattr('lib.breaker.OPEN_DURATION', 0)
+    monkeypatch.setattr('lib.breaker.PROBES', 2)
+    saved = []
+
+    async def scenario():
+        proxy = Proxy(load_backends=lambda: backends, save_circuit_state=lambda *args: saved.append(args))
+        await proxy.start()
+        with aioresponses() as responses:
+            responses.post(url1, status=500, repeat=True)
+            responses.post(url2, body=b'{"result": "0x2"}', repeat=True)
+            for _ in range(4):
+                await proxy.forward(b'{}')
+            assert proxy.upstream_order() == [url2]
+
+        with aioresponses() as responses:
+            responses.post(url1, body=b'{"result": "0x1"}', repeat=True)
+            await proxy.probe(url1)
+        # let executor calls finish
+        await asyncio.sleep(0.1)
+        await proxy.close()
+        return proxy
+
+    proxy = run(scenario())
+
+    assert proxy.breaker(url1).allow()
+    assert saved == [(url1, True), (url1, False)]
+    assert proxy.saved_circuits == {}
+
+
+def test_open_circuits_are_saved_again_before_they_expire(backends):
+    saved = []
+
+    async def scenario():
+        proxy = Proxy(load_backends=lambda: backends, save_circuit_state=lambda *args: saved.append(args))
+        proxy.saved_circuits = {url1: time.monotonic() - STATE_TTL, url2: time.monotonic()}
+        proxy.refresh_circuits()
+        await asyncio.sleep(0.1)
+        return proxy
+
+    proxy = run(scenario())
+
+    assert saved == [(url1, True)]
+    assert time.monotonic() - proxy.saved_circuits[url1] < 1
+
+
+def post_to_proxy(proxy, data):
+    async def post():
+        server = TestServer(make_app(proxy))
+        await server.start_server()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(server.make_url('/'), data=data) as response:
+                    return response.status, await response.read()
+        finally:
+            await server.close()
+    return run(post())
+
+
+def test_streams_heavy_responses(proxy):
+    body = b'{"jsonrpc": "2.0", "id": 1, "result": [' + b','.join([b'"0x00"'] * 50000) + b']}'
+    request = b'{"jsonrpc": "2.0", "id": 1, "method": "eth_getLogs", "params": [{}]}'
+    with aioresponses(passthrough=['http://127.0.0.1']) as responses:
+        responses.post(url1, exception=aiohttp.ClientConnectionError())
+        responses.post(url2, body=body)
+
+        assert post_to_proxy(proxy, request) == (200, body)
+
+
+def test_streamed_error_feeds_breaker(proxy):
+    error = b'{"jsonrpc": "2.0", "id": 1, "error": {"code": -32603, "message": "oops"}}'
+    request = b'{"jsonrpc": "2.0", "id": 1, "method": "trace_block", "params": ["0x1"]}'
+    proxy.update_backends([backend(url1)])
+    with aioresponses(passthrough=['http://127.0.0.1']) as responses:
+        responses.post(url1, body=error)
+
+        assert post_to_proxy(proxy, request) == (200, error)
+    assert proxy.breaker(url1).consecutive_failures == 1
+
+
+def test_streams_large_requests(proxy, monkeypatch):
+    monkeypatch.setattr('lib.stream.STREAM_REQUEST_SIZE', 100)
+    monkeypatch.setattr('handlers.proxy.STREAM_REQUEST_SIZE', 100)
+    request = (
+        b'{"jsonrpc": "2.0", "id": 1, "method": "eth_sendRawTransaction", "params": ["0x' +
+        b'00' * 100000 + b'"]}'
+    )
+    received = []
+
+    def record_body(url, data, **kwargs):
+        # aioresponses reads streamed bodies before calling back
+        received.append(data)
+        return CallbackResult(body=b'{"jsonrpc": "2.0", "id": 1, "result": "0x1"}')
+
+    with aioresponses(passthrough=['http://127.0.0.1']) as responses:
+        responses.post(url1, callback=record_body, repeat=True)
+        responses.post(url2, callback=record_body, repeat=True)
+
+        status, _ = post_to_proxy(proxy, request)
+
+    assert status == 200
+    assert received == [request]
+
+
+def test_api_keys_limit_requests(backends):
+    saved = []
+
+    def save_usage(api_key, count, day):
+        saved.append((api_key, count))
+        return count
+
+    proxy = Proxy(
+        load_backends=lambda: backends,
+        load_api_keys=lambda: [{'api_key': 'key1', 'burst': 2, 'rate': 0.001}],
+        save_usage=save_usage)
+    run(proxy.start())
+    request = b'{"jsonrpc": "2.0", "id": 1, "method": "eth_chainId", "params": []}'
+    batch = b'[' + b', '.join([request] * 3) + b']'
+
+    async def post_all(requests):
+        server = TestServer(make_app(proxy))
+        await server.start_server()
+        statuses = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                for headers, data in requests:
+                    async with session.post(
+                            server.make_url('/'), data=data, headers=headers) as response:
+                        statuses.append(response.status)
+        finally:
+            await server.close()
+        return statuses
+
+    with aioresponses(passthrough=['http://127.0.0.1']) as responses:
+        responses.post(url1, body=b'{"jsonrpc": "2.0", "id": 1, "result": "0x2a"}', repeat=True)
+        responses.post(url2, body=b'{"jsonrpc": "2.0", "id": 1, "result": "0x2a"}', repeat=True)
+
+        key = {'X-Api-Key': 'key1'}
+        assert run(post_all([
+            ({}, request), (key, batch), (key, request), (key, request), (key, request)
+        ])) == [401, 413, 200, 200, 429]
+
+    # usage is saved when the app shuts down
+    assert saved == [('key1', 2)]
+    assert proxy.limiter.used_today('key1') == 2
+    run(proxy.close())
+
+
+def hedged_proxy(proxy, monkeypatch):
+    monkeypatch.setattr('lib.hedge.HEDGED_METHODS', ['eth_call'])
+    proxy.update_backends([backend(url1), backend(url2)])
+    proxy._round_robin = iter(lambda: 0, 1)
+    for _ in range(20):
+        proxy.latencies.record(url1, 0.01)
+    proxy.hedge_budget.tokens = 1
+
+
+def eth_call(request_id):
+    return {
+        'jsonrpc': '2.0', 'id': request_id, 'method': 'eth_call',
+        'params': [{'to': '0x1'}, 'latest'],
+    }
+
+
+def test_hedges_slow_requests(proxy, monkeypatch):
+    hedged_proxy(proxy, monkeypatch)
+
+    async def slow(url, **kwargs):
+        await asyncio.sleep(1)
+        return CallbackResult(body=b'{"jsonrpc": "2.0", "id": 1, "result": "0x1"}')
+
+    with aioresponses() as responses:
+        responses.post(url1, callback=slow)
+        responses.post(url2, body=b'{"jsonrpc": "2.0", "id": 1, "result": "0x2"}')
+
+        payload = eth_call(1)
+        status, response = run(proxy.call(payload, json.dumps(payload).encode('utf8')))
+
+    assert json.loads(response)['result'] == '0x2'
+    assert (proxy.hedged, proxy.hedges_won) == (1, 1)
+    # the slow request was cancelled
+    assert proxy.balancer.outstanding[url1] == 0
+
+
+def test_hedging_respects_budget(proxy, monkeypatch):
+    hedged_proxy(proxy, monkeypatch)
+    proxy.hedge_budget.tokens = 0
+
+    async def slow(url, **kwargs):
+        await asyncio.sleep(0.1)
+        return CallbackResult(body=b'{"jsonrpc": "2.0", "id": 1, "result": "0x1"}')
+
+    with aioresponses() as responses:
+        responses.post(url1, callback=slow)
+
+        payload = eth_call(1)
+        status, response = run(proxy.call(payload, json.dumps(payload).encode('utf8')))
+
+    assert json.loads(response)['result'] == '0x1'
+    assert proxy.hedged == 0
+
+
+def test_records_request_and_upstream_latency(proxy):
+    request = b'{"jsonrpc": "2.0", "id": 1, "method": "eth_chainId", "params": []}'
+    with aioresponses(passthrough=['http://127.0.0.1']) as responses:
+        responses.post(url1, exception=aiohttp.ClientConnectionError())
+        responses.post(url2, payload={'jsonrpc': '2.0', 'id': 1, 'result': '0x1'})
+        assert post_to_proxy(proxy, request)[0] == 200
+
+    totals = proxy.instruments.totals
+    assert list(totals[REQUEST_DURATION]) == [(('method', 'eth_chainId'), ('status', '200'))]
+    assert sorted(totals[UPSTREAM_DURATION]) == [
+        (('backend', url1), ('status', 'error')),
+        (('backend', url2), ('status', '200')),
+    ]
+
+
+def test_roll_up_metrics(proxy):
+    proxy.instruments.observe(REQUEST_DURATION, 0.02, method='eth_call', status=200)
+    proxy.instruments.observe(REQUEST_DURATION, 0.2, method='eth_call', status=502)
+    proxy.instruments.observe(UPSTREAM_DURATION, 0.02, backend=url1, status=CANCELLED)
+
+    metrics = proxy.roll_up_metrics()
+    assert [
+        (m['MetricName'], m['Dimensions'][1]['Value'], m.get('Value'), m['Unit'])
+        for m in metrics
+    ] == [
+        ('Requests', 'eth_call', 2, 'Count'),
+        ('Requests errors', 'eth_call', 1, 'Count'),
+        ('Requests latency', 'eth_call', None, 'Milliseconds'),
+        ('Requests p50 latency', 'eth_call', 25.0, 'Milliseconds'),
+        ('Requests p99 latency', 'eth_call', 200.0, 'Milliseconds'),
+        ('Upstream requests', url1, 1, 'Count'),
+        ('Upstream requests errors', url1, 0, 'Count'),
+        ('Upstream requests latency', url1, None, 'Milliseconds'),
+        ('Upstream requests p50 latency', url1, 20.0, 'Milliseconds'),
+        ('Upstream requests p99 latency', url1, 20.0, 'Milliseconds'),
+    ]
+    assert metrics[0]['Dimensions'][1]['Name'] == 'Method'
+    assert metrics[2]['StatisticValues'] == {
+        'SampleCount': 2, 'Sum': pytest.approx(220), 'Minimum': 20, 'Maximum': 200}
+    assert proxy.roll_up_metrics() == []
+
+
+def test_metrics_endpoint(proxy):
+    proxy.instruments.observe(REQUEST_DURATION, 0.02, method='eth_call', status=200)
+
+    async def scrape():
+        server = TestServer(make_metrics_app(proxy))
+        await server.start_server()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(server.make_url('/metrics')) as response:
+                    return response.status, response.headers['Content-Type'], await response.text()
+        finally:
+            await server.close()
+
+    status, content_type, text = run(scrape())
+    assert status == 200
+    assert content_type.startswith('text/plain; version=0.0.4')
+    assert 'jsonrpc_request_duration_seconds_count{method="eth_call",status="200"} 1' in text
+
+
+def test_forwards_over_upstream_websocket(monkeypatch, backends):
+    monkeypatch.setattr('handlers.proxy.UPSTREAM_WEBSOCKETS', True)
+
+    async def handle_ws(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for message in ws:
+            payload = json.loads(message.data)
+            await ws.send_json({'jsonrpc': '2.0', 'id': payload['id'], 'result': '0xws'})
+        return ws
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/', handle_ws)
+        server = TestServer(app)
+        await server.start_server()
+        ws_url = str(server.make_url('/')).replace('http', 'ws')
+        proxy = Proxy(load_backends=lambda: [
+            dict(backend(url1, block_number=100), ws_url=ws_url)])
+        await proxy.start()
+        try:
+            return await proxy.forward(
+                b'{"jsonrpc": "2.0", "id": 7, "method": "eth_call", "params": []}')
+        finally:
+            await proxy.close()
+            await server.close()
+
+    status, response = run(scenario())
+    assert status == 200
+    assert json.loads(response) == {'jsonrpc': '2.0', 'id': 7, 'result': '0xws'}
+
+
+def test_client_websocket(backends):
+    node = FakeNode()
+
+    async def scenario():
+        ws_url = await node.start()
+        proxy = Proxy(load_backends=lambda: [
+            dict(backend(url1, block_number=100), ws_url=ws_url),
+            backend(url2, block_number=100),
+        ])
+        server = TestServer(make_app(proxy))
+        await server.start_server()
+        try:
+            async with aiohttp.ClientSession() as session:
+                clients = [await session.ws_connect(server.make_url('/')) for _ in range(2)]
+                ids = []
+                for client in clients:
+                    await client.send_json(
+                        {'jsonrpc': '2.0', 'id': 1, 'method': 'eth_subscribe',
+                         'params': ['newHeads']})
+                    ids.append((await client.receive_json())['result'])
+                await node.publish('0x1', {'number': '0x10'})
+                notifications = [await client.receive_json() for client in clients]
+
+                await clients[0].send_json(
+                    {'jsonrpc': '2.0', 'id': 2, 'method': 'eth_chainId', 'params': []})
+                response = await clients[0].receive_json()
+                await clients[0].send_json(
+                    {'jsonrpc': '2.0', 'id': 3, 'method': 'eth_unsubscribe', 'params': [ids[1]]})
+                unsubscribed = await clients[0].receive_json()
+                for client in clients:
+                    await client.close()
+            return ids, notifications, response, unsubscribed
+        finally:
+            await server.close()
+            await node.close()
+
+    with aioresponses(passthrough=['http://127.0.0.1', 'ws://127.0.0.1']) as responses:
+        responses.post(url1, payload={'jsonrpc': '2.0', 'id': 2, 'result': '0x2a'})
+        responses.post(url2, payload={'jsonrpc': '2.0', 'id': 2, 'result': '0x2a'})
+        ids, notifications, response, unsubscribed = run(scenario())
+
+    assert node.subscribed == [['newHeads']]
+    assert [n['params'] for n in notifications] == [
+        {'subscription': ids[0], 'result': {'number': '0x10'}},
+        {'subscription': ids[1], 'result': {'number': '0x10'}},
+    ]
+    assert response == {'jsonrpc': '2.0', 'id': 2, 'result': '0x2a'}
+    # somebody else's subscription
+    assert unsubscribed == {'jsonrpc': '2.0', 'id': 3, 'result': False}
+
+
+@pytest.mark.parametrize('payload,expected', [
+    ({'jsonrpc': '2.0', 'id': 1, 'method': 'eth_chainId'},
+     {'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32603, 'message': 'Upstream error'}}),
+    ([{'jsonrpc': '2.0', 'id': 1, 'method': 'eth_chainId'},
+      {'jsonrpc': '2.0', 'method': 'eth_chainId'},
+      'garbage'],
+     [{'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32603, 'message': 'Upstream error'}},
+      {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': 'Invalid Request'}}]),
+])
+def test_ws_call_without_upstreams(proxy, payload, expected):
+    proxy.update_backends([])
+    request = make_mocked_request('GET', '/')
+
+    response = run(proxy.ws_call(request, None, json.dumps(payload).encode('utf8')))
+
+    assert json.loads(response) == expected
+
+
+def test_plain_get_is_404(proxy):
+    async def get():
+        server = TestServer(make_app(proxy))
+        await server.start_server()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(server.make_url('/')) as response:
+                    return response.status
+        finally:
+            await server.close()
+
+    assert run(get()) == 404
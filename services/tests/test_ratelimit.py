@@ -0,0 +1,71 @@
+import pytest
+from handlers.lib.ratelimit import (ALLOWED, BATCH_TOO_LARGE, OVER_QUOTA,
+                                    RATE_LIMITED, UNKNOWN_KEY, RateLimiter,
+                                    TokenBucket)
+from handlers.lib.routing import DEFAULT_POOL, HEAVY_POOL
+
+
+@pytest.fixture
+def limiter(clock):
+    limiter = RateLimiter(clock=clock, today=lambda: '20180702')
+    limiter.update_keys([
+        {'api_key': 'key1', 'rate': 1, 'burst': 2, 'heavy_rate': 1, 'heavy_burst': 1},
+        {'api_key': 'key2', 'daily_quota': 3},
+        {'api_key': 'disabled', 'enabled': False},
+    ])
+    return limiter
+
+
+def test_token_bucket_refills(clock):
+    bucket = TokenBucket(rate=2, burst=4, clock=clock)
+    bucket.tokens = 0
+    clock.now = 1
+    assert bucket.refill() == 2
+    clock.now = 10
+    assert bucket.refill() == 4
+
+
+def test_unknown_and_disabled_keys(limiter):
+    assert limiter.check(None, {DEFAULT_POOL: 1}) == UNKNOWN_KEY
+    assert limiter.check('disabled', {DEFAULT_POOL: 1}) == UNKNOWN_KEY
+
+
+def test_limits_per_method_class(limiter, clock):
+    assert limiter.check('key1', {DEFAULT_POOL: 2}) == ALLOWED
+    assert limiter.check('key1', {DEFAULT_POOL: 1}) == RATE_LIMITED
+    # heavy methods have a bucket of their own
+    assert limiter.check('key1', {HEAVY_POOL: 1}) == ALLOWED
+    assert limiter.check('key1', {HEAVY_POOL: 1}) == RATE_LIMITED
+    clock.now = 1
+    assert limiter.check('key1', {DEFAULT_POOL: 1, HEAVY_POOL: 1}) == ALLOWED
+
+
+def test_batch_is_admitted_whole_or_not_at_all(limiter):
+    assert limiter.check('key1', {HEAVY_POOL: 1}) == ALLOWED
+    assert limiter.check('key1', {DEFAULT_POOL: 1, HEAVY_POOL: 1}) == RATE_LIMITED
+    assert limiter.check('key1', {DEFAULT_POOL: 2}) == ALLOWED
+
+
+def test_batch_over_burst_is_rejected(limiter, clock):
+    clock.now = 1000
+    assert limiter.check('key1', {DEFAULT_POOL: 1, HEAVY_POOL: 2}) == BATCH_TOO_LARGE
+    assert limiter.check('key1', {DEFAULT_POOL: 3}) == BATCH_TOO_LARGE
+    assert limiter.rejected[BATCH_TOO_LARGE] == 2
+    # no tokens are taken
+    assert limiter.check('key1', {DEFAULT_POOL: 2, HEAVY_POOL: 1}) == ALLOWED
+
+
+def test_daily_quota_includes_other_proxies(limiter):
+    limiter.set_saved_usage('key2', '20180702', 2)
+    assert limiter.check('key2', {DEFAULT_POOL: 1}) == ALLOWED
+    assert limiter.check('key2', {DEFAULT_POOL: 1}) == OVER_QUOTA
+    assert limiter.drain_usage() == {'key2': 1}
+    # usage saved on another day doesn't count
+    limiter.set_saved_usage('key2', '20180701', 3)
+    assert limiter.check('key2', {DEFAULT_POOL: 1}) == ALLOWED
+
+
+def test_changed_limits_apply(limiter):
+    assert limiter.check('key1', {DEFAULT_POOL: 2}) == ALLOWED
+    limiter.update_keys([{'api_key': 'key1', 'rate': 1, 'burst': 5}])
+    assert limiter.check('key1', {DEFAULT_POOL: 5}) == ALLOWED
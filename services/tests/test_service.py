@@ -1,10 +1,13 @@
+import hashlib
 import textwrap
 from unittest import mock
 
 import pytest
+from botocore.exceptions import ClientError
 from handlers.service import (empty_config, generate_nginx_config,
-                              load_balancing_config, single_host_config,
-                              update_service)
+                              load_balancing_config, method_routing_config,
+                              single_host_config, update_service,
+                              upload_service_config)
 
 
 def test_single_host():
@@ -12,10 +15,20 @@ def test_single_host():
     config = single_host_config(url)
     expected = textwrap.dedent(
         '''
+        upstream single {
+          server infura.com:443;
+          keepalive 32;
+        }
+
         server {
           listen 80;
           location / {
-            proxy_pass https://infura.com/aaa;
+            proxy_pass https://single/aaa;
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+            proxy_set_header Host infura.com;
+            proxy_ssl_server_name on;
+            proxy_ssl_name infura.com;
           }
         }
         '''
@@ -23,7 +36,16 @@ def test_single_host():
     assert config == expected
 
 
-def test_load_balancing():
+def test_single_host_plain_http():
+    config = single_host_config('http://my-host1.com:200')
+    assert '  server my-host1.com:200;\n' in config
+    assert '    proxy_pass http://single;\n' in config
+    assert '    proxy_set_header Host my-host1.com:200;\n' in config
+    assert 'proxy_ssl' not in config
+
+
+def test_load_balancing(monkeypatch):
+    monkeypatch.setattr('handlers.service.STICKY_METHODS', [])
     urls = ['http://my-host1.com:200', 'http://my-host2.com']
     config = load_balancing_config(urls)
     expected = textwrap.dedent(
@@ -31,6 +53,7 @@ def test_load_balancing():
         upstream service {
           server my-host1.com:200;
           server my-host2.com;
+          keepalive 32;
         }
 
         server {
@@ -38,6 +61,8 @@ def test_load_balancing():
 
           location / {
             proxy_pass http://service;
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
             proxy_redirect off;
             proxy_next_upstream error timeout;
           }
@@ -47,14 +72,129 @@ def test_load_balancing():
     assert config == expected
 
 
+def test_method_routing(monkeypatch):
+    monkeypatch.setattr('handlers.service.STICKY_METHODS', [])
+    config = method_routing_config(['http://my-host1.com:200'], ['http://my-host2.com'])
+    expected = textwrap.dedent(
+        '''
+        map $request_body $rpc_pool {
+          default service;
+          '~"method"\\s*:\\s*"(eth_getLogs|trace_[^"]*|debug_traceTransaction)"' heavy;
+        }
+
+        upstream service {
+          server my-host1.com:200;
+          keepalive 32;
+        }
+
+        upstream heavy {
+          server my-host2.com;
+          keepalive 32;
+        }
+
+        server {
+          listen 80;
+          client_body_buffer_size 1m;
+          client_body_in_single_buffer on;
+
+          location / {
+            mirror /_read_body;
+            mirror_request_body on;
+            proxy_pass http://$rpc_pool;
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+            proxy_redirect off;
+            proxy_next_upstream error timeout;
+          }
+
+          location = /_read_body {
+            internal;
+            return 204;
+          }
+        }
+        '''
+    )
+    assert config == expected
+
+
+def test_load_balancing_pins_stateful_methods():
+    config = load_balancing_config(['http://my-host1.com:200', 'http://my-host2.com'], least_conn=True)
+    expected = textwrap.dedent(
+        '''
+        map $request_body $rpc_pool {
+          default service;
+          '~"method"\\s*:\\s*"(eth_newFilter|eth_newBlockFilter|eth_newPendingTransactionFilter|eth_getFilterChanges|eth_getFilterLogs|eth_uninstallFilter|eth_sendRawTransaction|eth_sendTransaction)"|"method"\\s*:\\s*"eth_getTransactionCount".*"pending"|"pending".*"method"\\s*:\\s*"eth_getTransactionCount"' sticky;
+        }
+
+        map "$http_x_api_key$arg_api_key" $sticky_key {
+          default "$http_x_api_key$arg_api_key";
+          '' $http_x_forwarded_for;
+        }
+
+        upstream service {
+          least_conn;
+          server my-host1.com:200;
+          server my-host2.com;
+          keepalive 32;
+        }
+
+        upstream sticky {
+          hash $sticky_key consistent;
+          server my-host1.com:200;
+          server my-host2.com;
+          keepalive 32;
+        }
+
+        server {
+          listen 80;
+          client_body_buffer_size 1m;
+          client_body_in_single_buffer on;
+
+          location / {
+            mirror /_read_body;
+            mirror_request_body on;
+            proxy_pass http://$rpc_pool;
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+            proxy_redirect off;
+            proxy_next_upstream error timeout;
+          }
+
+          location = /_read_body {
+            internal;
+            return 204;
+          }
+        }
+        '''
+    )
+    assert config == expected
+
+
+def test_method_routing_pins_stateful_methods_before_heavy_ones():
+    config = method_routing_config(['http://my-host1.com:200'], ['http://my-host2.com'])
+    routes = config.split('}')[0].splitlines()
+    assert routes[-2].endswith(' sticky;')
+    assert routes[-1].endswith(' heavy;')
+    assert textwrap.dedent(
+        '''
+        upstream sticky {
+          hash $sticky_key consistent;
+          server my-host1.com:200;
+          keepalive 32;
+        }
+        '''
+    ) in config
+
+
 urls = [f'http://url{i}' for i in range(4)]
 
 
-def backend(url, healthy, is_leader):
+def backend(url, healthy, is_leader, pool=None):
     return {
         'url': url,
         'is_healthy': healthy,
-        'is_leader': is_leader
+        'is_leader': is_leader,
+        'pool': pool
     }
 
 
@@ -98,6 +238,35 @@ def backend(url, healthy, is_leader):
         ],
         empty_config()
     ),
+    (
+        # heavy methods routed to a dedicated pool
+        [
+            backend(urls[0], True, False, pool='heavy'),
+            backend(urls[1], True, False),
+            backend(urls[2], True, False),
+            backend(urls[3], True, True)
+        ],
+        method_routing_config([urls[1], urls[2]], [urls[0]])
+    ),
+    (
+        # unhealthy heavy pool falls back to default pool
+        [
+            backend(urls[0], False, False, pool='heavy'),
+            backend(urls[1], True, False),
+            backend(urls[2], True, False),
+            backend(urls[3], True, True)
+        ],
+        load_balancing_config([urls[1], urls[2]])
+    ),
+    (
+        # heavy pool serves everything when default pool is down
+        [
+            backend(urls[0], True, False, pool='heavy'),
+            backend(urls[1], False, False),
+            backend(urls[2], True, True)
+        ],
+        single_host_config(urls[0])
+    ),
 
 ])
 def test_generate_config(backends, expected):
@@ -157,3 +326,177 @@ def test_update_service(monkeypatch):
         assert ecs.deregister_task_definition.call_args == mock.call(
             taskDefinition='arn0'
         )
+
+
+def test_update_service_skips_deployed_config(monkeypatch):
+    monkeypatch.setenv('TASK_DEFINITION_FAMILY', 'task-family')
+    monkeypatch.setenv('CLUSTER_ARN', 'cluster-arn')
+    monkeypatch.setenv('CF_Service', 'service-arn')
+
+    event = {
+        'Records': [{
+            's3': {
+                'bucket': {'name': 'bucketName'},
+                'object': {'key': 'fileName'}
+            }
+        }]
+    }
+    with mock.patch('boto3.client') as m:
+        ecs = m.return_value
+        ecs.describe_task_definition.return_value = {
+            'taskDefinition': {
+                'taskDefinitionArn': 'arn1',
+                'containerDefinitions': [{
+                    'environment': [
+                        {'name': 'S3_CONFIG_PATH', 'value': 's3://bucketName/fileName'}
+                    ]
+                }]
+            }
+        }
+
+        update_service(event, context={})
+
+        assert not ecs.register_task_definition.called
+        assert not ecs.update_service.called
+
+
+@pytest.fixture
+def upload_env(monkeypatch):
+    monkeypatch.setenv('TASK_DEFINITION_FAMILY', 'task-family')
+    monkeypatch.setenv('NGINX_CONFIG_BUCKET_NAME', 'bucketName')
+    monkeypatch.setattr('handlers.service.get_table', lambda: None)
+    monkeypatch.setattr('handlers.service.scan_items', lambda table: [
+        {'url': 'http://node1', 'is_leader': False, 'is_healthy': True},
+    ])
+    body = bytes(single_host_config('http://node1'), 'utf8')
+    return body, hashlib.sha256(body).hexdigest() + '_nginx.conf'
+
+
+def deployed(path):
+    return {
+        'taskDefinition': {
+            'containerDefinitions': [{
+                'environment': [{'name': 'S3_CONFIG_PATH', 'value': path}]
+            }]
+        }
+    }
+
+
+def test_upload_service_config_uses_content_hash(upload_env):
+    body, file_name = upload_env
+    with mock.patch('boto3.client') as m:
+        client = m.return_value
+        client.describe_task_definition.return_value = deployed('s3://bucketName/other_nginx.conf')
+
+        upload_service_config({}, context=None)
+
+        assert client.put_object.call_args_list == [
+            mock.call(Bucket='bucketName', Body=body, Key=file_name),
+            mock.call(Bucket='bucketName', Body=bytes(file_name, 'utf8'), Key='current_config'),
+        ]
+
+
+def test_upload_service_config_skips_deployed_config(upload_env):
+    body, file_name = upload_env
+    with mock.patch('boto3.client') as m:
+        client = m.return_value
+        client.describe_task_definition.return_value = deployed(f's3://bucketName/{file_name}')
+
+        upload_service_config({}, context=None)
+
+        assert not client.put_object.called
+
+
+def test_upload_service_config_hot_reload_follows_pointer(monkeypatch, upload_env):
+    monkeypatch.setattr('handlers.service.NGINX_HOT_RELOAD', True)
+    body, file_name = upload_env
+    with mock.patch('boto3.client') as m:
+        client = m.return_value
+        client.get_object.return_value = {'Body': mock.Mock(read=lambda: bytes(file_name, 'utf8'))}
+
+        upload_service_config({}, context=None)
+
+        assert not client.describe_task_definition.called
+        assert not client.put_object.called
+
+
+@pytest.mark.parametrize('code', ['NoSuchKey', 'AccessDenied'])
+def test_upload_service_config_hot_reload_writes_first_pointer(monkeypatch, upload_env, code):
+    monkeypatch.setattr('handlers.service.NGINX_HOT_RELOAD', True)
+    body, file_name = upload_env
+    with mock.patch('boto3.client') as m:
+        client = m.return_value
+        client.get_object.side_effect = ClientError({'Error': {'Code': code}}, 'GetObject')
+
+        upload_service_config({}, context=None)
+
+        assert client.put_object.call_args_list == [
+            mock.call(Bucket='bucketName', Body=body, Key=file_name),
+            mock.call(Bucket='bucketName', Body=bytes(file_name, 'utf8'), Key='current_config'),
+        ]
+
+
+def test_upload_service_config_hot_reload_raises_other_errors(monkeypatch, upload_env):
+    monkeypatch.setattr('handlers.service.NGINX_HOT_RELOAD', True)
+    with mock.patch('boto3.client') as m:
+        client = m.return_value
+        client.get_object.side_effect = ClientError({'Error': {'Code': 'SlowDown'}}, 'GetObject')
+
+        with pytest.raises(ClientError):
+            upload_service_config({}, context=None)
+        assert not client.put_object.called
+
+
+@pytest.mark.parametrize('setting', ['NGINX_HOT_RELOAD', 'NATIVE_PROXY'])
+def test_update_service_doesnt_redeploy(monkeypatch, setting):
+    # hot reloaded nginx and the native proxy don't need a new task definition
+    monkeypatch.setattr(f'handlers.service.{setting}', True)
+    event = {
+        'Records': [{
+            's3': {
+                'bucket': {'name': 'bucketName'},
+                'object': {'key': 'fileName'}
+            }
+        }]
+    }
+    with mock.patch('boto3.client') as m:
+        update_service(event, context={})
+
+        assert not m.return_value.register_task_definition.called
+        assert not m.return_value.update_service.called
+
+
+def test_load_balancing_weighted_least_conn():
+    urls = ['http://my-host1.com:200', 'http://my-host2.com']
+    weights = {'http://my-host1.com:200': 10, 'http://my-host2.com': 3}
+    config = load_balancing_config(urls, weights, least_conn=True)
+    assert textwrap.dedent(
+        '''
+        upstream service {
+          least_conn;
+          server my-host1.com:200 weight=10;
+          server my-host2.com weight=3;
+          keepalive 32;
+        }
+        '''
+    ) in config
+
+
+def test_keepalive_can_be_disabled(monkeypatch):
+    monkeypatch.setattr('handlers.service.UPSTREAM_KEEPALIVE', 0)
+    config = load_balancing_config(['http://my-host1.com:200'])
+    assert 'keepalive' not in config
+
+
+@pytest.mark.parametrize('mode,least_conn', [('weighted', False), ('least_conn', True)])
+def test_generate_config_weighted(monkeypatch, mode, least_conn):
+    monkeypatch.setattr('handlers.service.BALANCING_MODE', mode)
+    backends = [
+        dict(backend(urls[0], True, False), response_time=100, block_number=20),
+        dict(backend(urls[1], True, False), response_time=400, block_number=20),
+        dict(backend(urls[2], True, False), response_time=100, block_number=19),
+        dict(backend(urls[3], True, True), response_time=50, block_number=20),
+    ]
+    expected_weights = {urls[0]: 10, urls[1]: 2, urls[2]: 5}
+    assert generate_nginx_config(backends) == load_balancing_config(
+        urls[:3], expected_weights, least_conn)
@@ -0,0 +1,56 @@
+import pytest
+from handlers.lib.sticky import HashRing, filter_id, is_sticky, sticky_methods_regex
+
+
+@pytest.mark.parametrize('payload,expected', [
+    ({'method': 'eth_newFilter', 'params': [{}]}, True),
+    ({'method': 'eth_getFilterChanges', 'params': ['0x1']}, True),
+    ({'method': 'eth_sendRawTransaction', 'params': ['0xf8']}, True),
+    ({'method': 'eth_getTransactionCount', 'params': ['0xabc', 'pending']}, True),
+    ({'method': 'eth_getTransactionCount', 'params': ['0xabc', 'latest']}, False),
+    ({'method': 'eth_getTransactionCount', 'params': ['0xabc']}, False),
+    ({'method': 'eth_call', 'params': [{}, 'pending']}, False),
+    ({'method': None}, False),
+])
+def test_is_sticky(payload, expected):
+    assert is_sticky(payload) == expected
+
+
+@pytest.mark.parametrize('payload,expected', [
+    ({'method': 'eth_getFilterChanges', 'params': ['0x1']}, '0x1'),
+    ({'method': 'eth_uninstallFilter', 'params': ['0x2']}, '0x2'),
+    ({'method': 'eth_getFilterLogs', 'params': []}, None),
+    ({'method': 'eth_getFilterLogs', 'params': [1]}, None),
+    ({'method': 'eth_newFilter', 'params': ['0x1']}, None),
+])
+def test_filter_id(payload, expected):
+    assert filter_id(payload) == expected
+
+
+def test_ring_walks_all_nodes_from_the_owner():
+    ring = HashRing(['a', 'b', 'c'])
+    assert sorted(ring.walk('client')) == ['a', 'b', 'c']
+    assert ring.walk('client') == HashRing(['c', 'b', 'a']).walk('client')
+    assert HashRing([]).walk('client') == []
+
+
+def test_removing_a_node_moves_only_its_keys():
+    keys = [f'client{i}' for i in range(1000)]
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b'])
+    owners = {key: before.walk(key)[0] for key in keys}
+    assert set(owners.values()) == {'a', 'b', 'c'}
+    for key in keys:
+        if owners[key] == 'c':
+            assert after.walk(key)[0] == before.walk(key)[1]
+        else:
+            assert after.walk(key)[0] == owners[key]
+
+
+def test_sticky_methods_regex(monkeypatch):
+    monkeypatch.setattr('handlers.lib.sticky.STICKY_METHODS', ['eth_newFilter'])
+    assert sticky_methods_regex() == (
+        '"method"\\s*:\\s*"(eth_newFilter)"|'
+        '"method"\\s*:\\s*"eth_getTransactionCount".*"pending"|'
+        '"pending".*"method"\\s*:\\s*"eth_getTransactionCount"'
+    )
@@ -0,0 +1,51 @@
+import pytest
+from handlers.lib.routing import DEFAULT_POOL, HEAVY_POOL
+from handlers.lib.stream import ResponseScanner, is_streamed, prefix_pool
+
+
+def scan(body, scan_size=64):
+    scanner = ResponseScanner(scan_size=scan_size)
+    for start in range(0, len(body), 10):
+        scanner.feed(body[start:start + 10])
+    return scanner
+
+
+def large_result():
+    return b'[' + b','.join([b'{"id": 5, "data": "0x00"}'] * 20) + b']'
+
+
+@pytest.mark.parametrize('body, expected', [
+    (b'{"jsonrpc": "2.0", "id": 7, "result": ' + large_result() + b'}', 7),
+    (b'{"jsonrpc": "2.0", "result": ' + large_result() + b', "id": "a\\"b"}', 'a"b'),
+    (b'{"result": ' + large_result() + b', "jsonrpc": "2.0"}', None),
+    (b'{"jsonrpc": "2.0", "id": 3, "result": "0x1"}', 3),
+])
+def test_response_id(body, expected):
+    assert scan(body).response_id() == expected
+
+
+def test_keeps_bounded_memory():
+    scanner = scan(b'{"id": 1, "result": ' + large_result() * 10 + b'}')
+    assert len(scanner.head) == 64
+    assert len(scanner.tail) == 64
+    assert not scanner.is_complete
+
+
+def test_is_node_failure():
+    error = b'{"id": 1, "error": {"code": -32603, "message": "internal"}}'
+    assert scan(error, scan_size=1024).is_node_failure(200)
+    assert not scan(b'{"id": 1, "error": {"code": -32000}}', scan_size=1024).is_node_failure(200)
+    assert not scan(b'{"id": 1, "result": ' + large_result() + b'}').is_node_failure(200)
+    assert scan(b'bad gateway').is_node_failure(502)
+
+
+def test_is_streamed():
+    assert is_streamed({'method': 'eth_getLogs'})
+    assert is_streamed({'method': 'trace_block'})
+    assert not is_streamed({'method': 'eth_call'})
+    assert not is_streamed({'method': None})
+
+
+def test_prefix_pool():
+    assert prefix_pool(b'{"id": 1, "method": "eth_getLogs", "params": [') == HEAVY_POOL
+    assert prefix_pool(b'{"id": 1, "method": "eth_sendRawTransaction", "params": ["0x') == DEFAULT_POOL
@@ -0,0 +1,185 @@
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from handlers.lib.subscriptions import (NoNodeError, Subscriber,
+                                        SubscriptionError, SubscriptionHub)
+
+from .conftest import run
+
+url1 = 'http://url1'
+url2 = 'http://url2'
+
+
+class FakeNode:
+    def __init__(self):
+        self.subscribed = []
+        self.unsubscribed = []
+        self.sockets = []
+        self.server = None
+
+    async def handle_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        async for message in ws:
+            payload = json.loads(message.data)
+            if payload['method'] == 'eth_subscribe':
+                if payload['params'][0] == 'bogus':
+                    await ws.send_json({
+                        'jsonrpc': '2.0', 'id': payload['id'],
+                        'error': {'code': -32602, 'message': 'invalid subscription'}})
+                    continue
+                self.subscribed.append(payload['params'])
+                await ws.send_json({
+                    'jsonrpc': '2.0', 'id': payload['id'],
+                    'result': f'0x{len(self.subscribed)}'})
+            elif payload['method'] == 'eth_unsubscribe':
+                self.unsubscribed.append(payload['params'][0])
+                await ws.send_json({'jsonrpc': '2.0', 'id': payload['id'], 'result': True})
+        return ws
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/', self.handle_ws)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return str(self.server.make_url('/')).replace('http', 'ws')
+
+    async def publish(self, subscription, result):
+        for ws in self.sockets:
+            if not ws.closed:
+                await ws.send_json({
+                    'jsonrpc': '2.0', 'method': 'eth_subscription',
+                    'params': {'subscription': subscription, 'result': result}})
+        await asyncio.sleep(0.05)
+
+    async def close(self):
+        await self.server.close()
+
+
+def received(subscriber):
+    messages = []
+    while not subscriber.queue.empty():
+        messages.append(json.loads(subscriber.queue.get_nowait()))
+    return messages
+
+
+def scenario(test, nodes=1):
+    async def run_test():
+        fake_nodes = [FakeNode() for _ in range(nodes)]
+        ws_urls = [await node.start() for node in fake_nodes]
+        async with aiohttp.ClientSession() as session:
+            hub = SubscriptionHub(session)
+            hub.update_nodes(dict(zip([url1, url2], ws_urls)))
+            try:
+                return await test(hub, fake_nodes)
+            finally:
+                await hub.close()
+                for node in fake_nodes:
+                    await node.close()
+    return run(run_test())
+
+
+def test_identical_subscriptions_are_shared():
+    async def test(hub, nodes):
+        first, second = Subscriber(on_overflow=None), Subscriber(on_overflow=None)
+        filter1 = ['logs', {'address': '0xabc', 'topics': ['0x1']}]
+        filter2 = ['logs', {'topics': ['0x1'], 'address': '0xabc'}]
+        id1 = await hub.subscribe(first, filter1)
+        id2 = await hub.subscribe(second, filter2)
+        await nodes[0].publish('0x1', {'logIndex': '0x0'})
+
+        assert id1 != id2
+        assert nodes[0].subscribed == [filter1]
+        assert received(first) == [{
+            'jsonrpc': '2.0', 'method': 'eth_subscription',
+            'params': {'subscription': id1, 'result': {'logIndex': '0x0'}}}]
+        assert received(second)[0]['params']['subscription'] == id2
+
+    scenario(test)
+
+
+def test_last_unsubscribe_drops_node_subscription():
+    async def test(hub, nodes):
+        first, second = Subscriber(on_overflow=None), Subscriber(on_overflow=None)
+        id1 = await hub.subscribe(first, ['newHeads'])
+        id2 = await hub.subscribe(second, ['newHeads'])
+
+        assert not hub.unsubscribe(second, id1)
+        assert hub.unsubscribe(first, id1)
+        await asyncio.sleep(0.05)
+        assert nodes[0].unsubscribed == []
+        hub.drop(second)
+        await asyncio.sleep(0.05)
+        assert nodes[0].unsubscribed == ['0x1']
+        assert hub.shared == {} and hub.by_id == {}
+        assert not hub.unsubscribe(second, id2)
+
+    scenario(test)
+
+
+def test_subscriptions_move_when_node_is_ejected():
+    async def test(hub, nodes):
+        subscriber = Subscriber(on_overflow=None)
+        subscription_id = await hub.subscribe(subscriber, ['newHeads'])
+        used, other = (nodes[0], nodes[1]) if nodes[0].subscribed else (nodes[1], nodes[0])
+        ws_url = str(other.server.make_url('/')).replace('http', 'ws')
+        url = url1 if other is nodes[0] else url2
+
+        hub.update_nodes({url: ws_url})
+        await asyncio.sleep(0.1)
+        assert other.subscribed == [['newHeads']]
+        await other.publish('0x1', {'number': '0x10'})
+        await used.publish('0x1', {'number': '0x11'})
+
+        assert received(subscriber) == [{
+            'jsonrpc': '2.0', 'method': 'eth_subscription',
+            'params': {'subscription': subscription_id, 'result': {'number': '0x10'}}}]
+
+    scenario(test, nodes=2)
+
+
+def test_subscriptions_move_when_connection_drops():
+    async def test(hub, nodes):
+        subscriber = Subscriber(on_overflow=None)
+        subscription_id = await hub.subscribe(subscriber, ['newHeads'])
+        await nodes[0].sockets[0].close()
+        await asyncio.sleep(0.1)
+        # the same node is the only one left, a new connection is opened to it
+        assert nodes[0].subscribed == [['newHeads'], ['newHeads']]
+        await nodes[0].publish('0x2', {'number': '0x10'})
+        assert received(subscriber)[0]['params']['subscription'] == subscription_id
+
+    scenario(test)
+
+
+def test_node_errors_are_passed_on():
+    async def test(hub, nodes):
+        with pytest.raises(SubscriptionError) as e:
+            await hub.subscribe(Subscriber(on_overflow=None), ['bogus'])
+        assert e.value.error['code'] == -32602
+        assert hub.shared == {}
+
+    scenario(test)
+
+
+def test_no_nodes():
+    async def test(hub, nodes):
+        hub.update_nodes({})
+        with pytest.raises(NoNodeError):
+            await hub.subscribe(Subscriber(on_overflow=None), ['newHeads'])
+
+    scenario(test)
+
+
+def test_slow_subscriber_overflows():
+    overflows = []
+    subscriber = Subscriber(on_overflow=lambda: overflows.append(1), queue_size=2)
+    for message in (b'1', b'2', b'3', b'4'):
+        subscriber.send(message)
+    assert overflows == [1]
+    assert subscriber.queue.qsize() == 2